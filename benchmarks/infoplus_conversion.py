@@ -0,0 +1,130 @@
+"""
+Benchmark of the Info+ conversion
+=================================
+
+Measures the time and the peak memory of the conversion of the fixed width Info+ files of a timetable zip file
+to CSV (infoplus.file_filter), on synthetic BFKOORD-like members, e.g.
+`
+    python benchmarks/infoplus_conversion.py --lines 1000000 --members 4
+`
+Every conversion runs in its own process, so that its peak memory (max RSS) is measured on its own.
+The engines are:
+- `streaming`: the members are converted one after the other by one process
+- `parallel`: the members are converted by a pool of processes (the peak memory is the one of the main process)
+- `parquet`: like `streaming`, with a typed Parquet file written besides the CSV file (needs pyarrow)
+- `legacy`: the former implementation, which read and decoded every member at once, reopening the zip file
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import zipfile
+
+import unicodecsv
+
+from ckanext.switzerland.harvester import infoplus
+
+MEMBER = 'BFKOORD_%d'
+COLUMNS = [
+    {'from': 1, 'to': 7, 'name': 'StationID', 'type': 'int'},
+    {'from': 8, 'to': 18, 'name': 'Longitude', 'type': 'float'},
+    {'from': 20, 'to': 29, 'name': 'Latitude', 'type': 'float'},
+    {'from': 31, 'to': 36, 'name': 'Height', 'type': 'int'},
+    {'from': 40, 'to': -1, 'name': 'Remark'},
+]
+NAMES = [u'Bern B\xfcmpliz S\xfcd', u'Basel SBB', u'Z\xfcrich HB', u'Gen\xe8ve', u'La Sarraz, Couronne']
+
+
+def create_zip(workingdir, lines, members):
+    path = os.path.join(workingdir, 'FP2016_Fahrplan.zip')
+    member = os.path.join(workingdir, 'member')
+    with open(member, 'wb') as f:
+        for i in range(lines):
+            line = u'%07d %10.6f %10.6f %-6d %% %s\n' % (
+                i, random.uniform(5, 11), random.uniform(45, 48), random.randint(0, 4000), random.choice(NAMES))
+            f.write(line.encode('utf-8'))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for i in range(members):
+            z.write(member, MEMBER % i)
+    os.remove(member)
+    return os.path.basename(path)
+
+
+def legacy_file_filter(harvester_obj, config):
+    with zipfile.ZipFile(os.path.join(harvester_obj['tmpfolder'], harvester_obj['file']), 'r') as z:
+        data = z.read(harvester_obj['infoplus_filename']).decode('utf-8')
+    path = os.path.join(harvester_obj['tmpfolder'], harvester_obj['infoplus_filename'] + '.csv')
+    with open(path, 'wb') as f:
+        writer = unicodecsv.writer(f, encoding='utf-8')
+        columns = config['infoplus']['files'][harvester_obj['infoplus_filename']]
+        writer.writerow([col['name'] for col in columns])
+        for line in data.split('\n'):
+            row = []
+            for column in columns:
+                to_pos = column['to'] if column['to'] != -1 else len(line)
+                row.append(line[column['from'] - 1:to_pos].strip())
+            writer.writerow(row)
+    harvester_obj['file'] = path
+    return harvester_obj
+
+
+ENGINES = {
+    'streaming': (infoplus.file_filter, {'processes': 1}),
+    'parallel': (infoplus.file_filter, {'processes': multiprocessing.cpu_count()}),
+    'parquet': (infoplus.file_filter, {'processes': 1, 'formats': ['parquet']}),
+    'legacy': (legacy_file_filter, {}),
+}
+
+
+def convert(engine, workingdir, zip_filename, members, results):
+    file_filter, settings = ENGINES[engine]
+    config = {'infoplus': dict(settings, files=dict((MEMBER % i, COLUMNS) for i in range(members)))}
+    start = time.time()
+    for member in sorted(config['infoplus']['files']):
+        file_filter({'tmpfolder': workingdir, 'file': zip_filename, 'infoplus_filename': member}, config)
+    elapsed = time.time() - start
+    for member in config['infoplus']['files']:
+        for extension in ['.csv'] + [infoplus.COLUMNAR_FORMATS[f] for f in settings.get('formats', [])]:
+            os.remove(os.path.join(workingdir, member + extension))
+    # ru_maxrss is in KB on Linux
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def run(engine, workingdir, zip_filename, members):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=convert, args=(engine, workingdir, zip_filename, members, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the conversion of Info+ files to CSV')
+    parser.add_argument('--lines', type=int, default=1000000, help='Number of lines of each Info+ file')
+    parser.add_argument('--members', type=int, default=1, help='Number of Info+ files in the zip file')
+    parser.add_argument('--engines', default='streaming,parallel,legacy', help='Engines to test')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of conversions per engine')
+    args = parser.parse_args()
+
+    workingdir = tempfile.mkdtemp()
+    try:
+        print('Creating %d Info+ files with %d lines...' % (args.members, args.lines))
+        zip_filename = create_zip(workingdir, args.lines, args.members)
+
+        print('%10s %10s %10s %14s' % ('engine', 'seconds', 'lines/s', 'peak RSS (MB)'))
+        for engine in args.engines.split(','):
+            results = [run(engine, workingdir, zip_filename, args.members) for _ in range(args.repeat)]
+            elapsed = min(r[0] for r in results)
+            peak_memory = max(r[1] for r in results)
+            print('%10s %10.2f %10d %14.1f' % (engine, elapsed, args.lines * args.members / elapsed, peak_memory))
+    finally:
+        shutil.rmtree(workingdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark of the Ist-File filter
+================================
+
+Measures the time and the peak memory of the Ist-File filter (ist_file.filter_ist_file) on a synthetic Ist-File,
+e.g.
+`
+    python benchmarks/ist_file_filter.py --lines 3000000 --processes 1,4
+`
+Every filter runs in its own process, on its own copy of the file, so that its peak memory (max RSS) is measured
+on its own. The `legacy` engine is the former implementation, which filtered the file row by row with the csv
+module; the chunked engine runs with every given number of processes (the peak memory is the one of the main
+process).
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+from ckanext.switzerland.harvester import ist_file
+
+HEADING = ('BETRIEBSTAG;FAHRT_BEZEICHNER;BETREIBER_ID;BETREIBER_ABK;BETREIBER_NAME;PRODUKT_ID;LINIEN_ID;'
+           'LINIEN_TEXT;UMLAUF_ID;VERKEHRSMITTEL_TEXT;ZUSATZFAHRT_TF;FAELLT_AUS_TF;BPUIC;HALTESTELLEN_NAME;'
+           'ANKUNFTSZEIT;AN_PROGNOSE;AN_PROGNOSE_STATUS;ABFAHRTSZEIT;AB_PROGNOSE;AB_PROGNOSE_STATUS;DURCHFAHRT_TF\n')
+LINE = ('25.09.2016;85:11:%(trip)d:001;85:11;SBB;Schweizerische Bundesbahnen SBB;Zug;%(trip)d;S16;;S;false;false;'
+        '%(bpuic)s;%(name)s;25.09.2016 17:39;25.09.2016 17:40:35;GESCHAETZT;25.09.2016 17:39;25.09.2016 17:40:56;'
+        'GESCHAETZT;false\n')
+NAMES = ['Z\xc3\xbcrich Hardbr\xc3\xbccke', 'Basel Bad Bf', 'Schl\xc3\xbcsselacher', 'Weil am Rhein', 'Bern']
+
+
+def create_file(path, lines):
+    with open(path, 'wb') as f:
+        f.write(HEADING)
+        for i in range(lines):
+            # about 80% swiss stations, some with a platform appended to the BPUIC
+            prefix = '85' if random.random() < 0.8 else '80'
+            bpuic = prefix + '%05d' % random.randint(0, 99999) + random.choice(['', '', '02', '89'])
+            f.write(LINE % {'trip': i // 20, 'bpuic': bpuic, 'name': random.choice(NAMES)})
+
+
+def legacy_filter(path):
+    temp_file = path + '.tmp'
+    with open(temp_file, 'w') as fout, open(path) as fin:
+        writer = csv.writer(fout, delimiter=';')
+        reader = csv.reader(fin, delimiter=';')
+        heading = reader.next()
+        column_index = heading.index('BPUIC')
+        writer.writerow(heading)
+        for line in reader:
+            bpuic = line[column_index]
+            if not bpuic.startswith('85'):
+                continue
+            line[column_index] = bpuic[:7]
+            writer.writerow(line)
+    os.remove(path)
+    os.rename(temp_file, path)
+
+
+def run_filter(engine, path, results):
+    start = time.time()
+    if engine == 'legacy':
+        legacy_filter(path)
+    else:
+        ist_file.filter_ist_file(path, processes=int(engine))
+    elapsed = time.time() - start
+    # ru_maxrss is in KB on Linux
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def run(engine, source, workingdir):
+    path = os.path.join(workingdir, 'istdaten.csv')
+    shutil.copyfile(source, path)
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_filter, args=(engine, path, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result, path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Ist-File filter')
+    parser.add_argument('--lines', type=int, default=3000000, help='Number of lines of the Ist-File')
+    parser.add_argument('--processes', default='1,%d' % multiprocessing.cpu_count(),
+                        help='Numbers of processes of the chunked filter')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of filters per engine')
+    parser.add_argument('--no-legacy', action='store_true', help='Do not run the former implementation')
+    args = parser.parse_args()
+
+    workingdir = tempfile.mkdtemp()
+    try:
+        print('Creating an Ist-File with %d lines...' % args.lines)
+        source = os.path.join(workingdir, 'source.csv')
+        create_file(source, args.lines)
+
+        engines = args.processes.split(',')
+        if not args.no_legacy:
+            engines.append('legacy')
+        outputs = {}
+        print('%10s %10s %10s %14s' % ('processes', 'seconds', 'lines/s', 'peak RSS (MB)'))
+        for engine in engines:
+            results = []
+            for _ in range(args.repeat):
+                result, path = run(engine, source, workingdir)
+                results.append(result)
+            with open(path, 'rb') as f:
+                outputs[engine] = hash(f.read())
+            elapsed = min(r[0] for r in results)
+            peak_memory = max(r[1] for r in results)
+            print('%10s %10.2f %10d %14.1f' % (engine, elapsed, args.lines / elapsed, peak_memory))
+
+        if len(set(outputs.values())) > 1:
+            print('The filtered files differ between the engines!')
+    finally:
+        shutil.rmtree(workingdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
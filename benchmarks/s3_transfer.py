@@ -0,0 +1,110 @@
+"""
+Benchmark of the S3StorageAdapter downloads
+===========================================
+
+Measures the download throughput of S3StorageAdapter.fetch for different transfer settings
+(part_size, max_concurrency, multipart_threshold, use_threads) against a local S3 stand-in, e.g.
+`
+    pip install "moto[server]"
+    moto_server s3 -p 5000 &
+    python benchmarks/s3_transfer.py --endpoint-url http://127.0.0.1:5000 --size 512
+`
+Any S3 compatible storage (e.g. MinIO) can be used instead, as long as the bucket can be created.
+"""
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import time
+
+import boto3
+
+from ckanext.switzerland.harvester.s3_storage_adapter import S3StorageAdapter
+
+MB = 1024 * 1024
+BUCKET = 'ckanext-switzerland-benchmark'
+KEY = 'benchmark/archive.zip'
+
+
+class DictConfigResolver(object):
+    """ Resolves the CKAN configuration from a dict instead of the ini file """
+
+    def __init__(self, config):
+        self._config = config
+
+    def get(self, key, default_value):
+        return self._config.get(key, default_value)
+
+
+def upload_test_file(client, size):
+    client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': client.meta.region_name})
+    with tempfile.TemporaryFile() as f:
+        for _ in range(size):
+            f.write(os.urandom(MB))
+        f.seek(0)
+        client.upload_fileobj(f, BUCKET, KEY)
+
+
+def fetch(endpoint_url, localpath, part_size, max_concurrency, multipart_threshold, use_threads):
+    prefix = 'ckan.s3.benchmark.'
+    config_resolver = DictConfigResolver({
+        prefix + 'bucket_name': BUCKET,
+        prefix + 'access_key': 'benchmark',
+        prefix + 'secret_key': 'benchmark',
+        prefix + 'region_name': 'eu-central-1',
+        prefix + 'localpath': localpath,
+        prefix + 'remotedirectory': '/',
+        prefix + 'endpoint_url': endpoint_url,
+        prefix + 'part_size': str(part_size),
+        prefix + 'max_concurrency': str(max_concurrency),
+        prefix + 'multipart_threshold': str(multipart_threshold),
+        prefix + 'use_threads': str(use_threads),
+    })
+    target = os.path.join(localpath, 'archive.zip')
+    with S3StorageAdapter(config_resolver, {'bucket': 'benchmark'}, '/benchmark/') as storage:
+        start = time.time()
+        storage.fetch('archive.zip', target)
+        elapsed = time.time() - start
+    os.remove(target)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the S3 transfer settings of the S3StorageAdapter')
+    parser.add_argument('--endpoint-url', default='http://127.0.0.1:5000', help='URL of the local S3 stand-in')
+    parser.add_argument('--size', type=int, default=256, help='Size of the test file in MB')
+    parser.add_argument('--part-sizes', default='8,32,64', help='Part sizes to test, in MB')
+    parser.add_argument('--concurrencies', default='1,4,10', help='Max concurrencies to test')
+    parser.add_argument('--multipart-threshold', type=int, default=8, help='Multipart threshold in MB')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of downloads per setting')
+    args = parser.parse_args()
+
+    client = boto3.client('s3', endpoint_url=args.endpoint_url, region_name='eu-central-1',
+                          aws_access_key_id='benchmark', aws_secret_access_key='benchmark')
+    print('Uploading a %d MB test file...' % args.size)
+    upload_test_file(client, args.size)
+
+    localpath = tempfile.mkdtemp()
+    try:
+        print('%10s %12s %8s %10s' % ('part size', 'concurrency', 'threads', 'MB/s'))
+        settings = itertools.product(
+            [int(x) for x in args.part_sizes.split(',')],
+            [int(x) for x in args.concurrencies.split(',')],
+        )
+        for part_size, max_concurrency in settings:
+            use_threads = max_concurrency > 1
+            elapsed = min(
+                fetch(args.endpoint_url, localpath, part_size * MB, max_concurrency,
+                      args.multipart_threshold * MB, use_threads)
+                for _ in range(args.repeat)
+            )
+            print('%8d MB %12d %8s %10.1f' % (part_size, max_concurrency, use_threads, args.size / elapsed))
+    finally:
+        shutil.rmtree(localpath, ignore_errors=True)
+        client.delete_object(Bucket=BUCKET, Key=KEY)
+        client.delete_bucket(Bucket=BUCKET)
+
+
+if __name__ == '__main__':
+    main()
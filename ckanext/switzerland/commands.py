@@ -7,6 +7,8 @@ from datetime import datetime
 import ckan.logic as logic
 import ckan.model as model
 from ckan.lib.cli import CkanCommand
+from ckanext.switzerland import identifier_index
+from ckanext.switzerland.harvester import filestore_gc, harvest_state
 
 
 class OgdchCommands(CkanCommand):
@@ -19,6 +21,10 @@ class OgdchCommands(CkanCommand):
         # Show this help
         paster ogdch help
 
+        # Create or upgrade the database tables of the extension, run it
+        # after every install or upgrade of the extension
+        paster ogdch initdb
+
         # Cleanup datastore
         paster ogdch cleanup_datastore
 
@@ -29,6 +35,15 @@ class OgdchCommands(CkanCommand):
         #   database will remain unchanged
         paster ogdch cleanup_harvestjobs
             [{source_id}] [--keep={n}] [--dryrun]
+
+        # Remove the files of the harvested resource revisions marked by
+        # the harvesters with the defer_file_cleanup option:
+        # - the files are removed in batches of n, at most r per second
+        # - an interrupted run is resumed by the next one
+        # - with --scan, the whole filestore is then scanned for the files
+        #   of resources which do not exist or are not active anymore
+        paster ogdch gc_filestore
+            [--batch-size={n}] [--rate-limit={r}] [--scan] [--dryrun]
     """
 
     summary = __doc__.split("\n")[0]
@@ -52,6 +67,31 @@ class OgdchCommands(CkanCommand):
             help="dryrun of cleanup harvestjobs and "
             "publish_scheduled_datasets",
         )
+        self.parser.add_option(
+            "--batch-size",
+            action="store",
+            type="int",
+            dest="batch_size",
+            default=100,
+            help="The number of files removed per batch by gc_filestore",
+        )
+        self.parser.add_option(
+            "--rate-limit",
+            action="store",
+            type="float",
+            dest="rate_limit",
+            default=None,
+            help="The maximal number of files removed per second "
+            "by gc_filestore",
+        )
+        self.parser.add_option(
+            "--scan",
+            action="store_true",
+            dest="scan",
+            default=False,
+            help="Scan the whole filestore for the files of the resources "
+            "which do not exist or are not active anymore in gc_filestore",
+        )
 
     def command(self):
         # load pylons config
@@ -59,7 +99,9 @@ class OgdchCommands(CkanCommand):
         options = {
             "cleanup_datastore": self.cleanup_datastore,
             "help": self.help,
+            "initdb": self.initdb,
             "cleanup_harvestjobs": self.cleanup_harvestjobs,
+            "gc_filestore": self.gc_filestore,
         }
 
         cmd = self.args[0]
@@ -68,6 +110,16 @@ class OgdchCommands(CkanCommand):
     def help(self):
         print(self.__doc__)
 
+    def initdb(self):
+        """
+        command creating or upgrading the database tables and indexes of the
+        extension
+        """
+        harvest_state.setup()
+        filestore_gc.setup()
+        identifier_index.setup()
+        print("The database tables of ckanext-switzerland are up to date")
+
     def cleanup_datastore(self):
         user = logic.get_action("get_site_user")({"ignore_auth": True}, {})
         context = {
@@ -189,6 +241,45 @@ class OgdchCommands(CkanCommand):
         # print the result of the harvest job cleanup
         self._print_clean_harvestjobs_result(result, data_dict)
 
+    def gc_filestore(self):
+        """
+        command for the removal of the marked resource files, and with --scan
+        of all the files of resources which are not active
+        """
+        processed, deleted = filestore_gc.collect(
+            batch_size=self.options.batch_size,
+            rate_limit=self.options.rate_limit,
+            dryrun=self.options.dryrun,
+        )
+        if self.options.dryrun:
+            print(
+                "%s marked resource files are waiting to be removed." % processed
+            )
+        else:
+            print(
+                "Processed %s marked resources, removed %s files "
+                "from the filestore" % (processed, deleted)
+            )
+
+        if self.options.scan:
+            scanned, removed = filestore_gc.scan(
+                batch_size=self.options.batch_size,
+                rate_limit=self.options.rate_limit,
+                dryrun=self.options.dryrun,
+            )
+            print(
+                "Scanned %s files of the filestore, %s %s files of "
+                "resources which do not exist or are not active"
+                % (scanned, "found" if self.options.dryrun else "removed",
+                   removed)
+            )
+
+        if self.options.dryrun:
+            print(
+                "This has been a dry run: run this again without the "
+                "option --dryrun to remove them!"
+            )
+
     def _print_clean_harvestjobs_result(self, result, data_dict):
         print(
             "\nCleaning up jobs for harvest sources:\n{}\nConfiguration:".format(
@@ -13,13 +13,18 @@ table.
 """
 
 import cgi
+import fcntl
 import ftplib  # for errors only
+import hashlib
 import logging
 import shutil
+import threading
 import time
 import traceback
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
+from operator import itemgetter
 
 import os
 import sys
@@ -28,14 +33,13 @@ import json
 
 from ckan import model
 from ckan.lib import helpers
-from ckan.lib import uploader
-from ckan.lib.dictization.model_dictize import resource_dictize
 from ckan.lib.helpers import json
 from ckan.lib.munge import munge_filename, munge_name
 from ckan.logic import NotFound
 from ckan.logic import get_action, check_access
 from ckan.model import Session
 from ckanext.harvest.harvesters.base import HarvesterBase
+from ckanext.harvest.model import HarvestObject
 from ckanext.switzerland.helpers import resource_filename
 from ckan.plugins.toolkit import config as ckanconf
 from simplejson.scanner import JSONDecodeError
@@ -44,10 +48,26 @@ from ckan.lib import search
 from sqlalchemy.sql import update, bindparam
 
 from storage_adapter_factory import StorageAdapterFactory
+from streaming_file import StreamingFile
+from resource_ordering import get_resource_ordering
+from harvest_logging import setup_job_logging
+from lru_cache import LRUCache
+import harvest_logging
+import harvest_state
+import filestore_gc
 
 
 log = logging.getLogger(__name__)
 
+SOURCE_CONFIG_CACHE_SIZE = 100
+# file of the working folder of a job, locked during the prefetch of the files of the job, then listing the
+# prefetched files, see BaseSBBHarvester._prefetch_job_files
+PREFETCH_FILENAME = '.prefetch'
+
+# validated configs of the harvest sources, see BaseSBBHarvester._load_source_config
+_source_configs = LRUCache(SOURCE_CONFIG_CACHE_SIZE)
+
+
 def validate_regex(regex):
     try:
         re.compile(regex)
@@ -56,6 +76,49 @@ def validate_regex(regex):
     return regex
 
 
+# the blocks of deferred_indexing running in the process, see deferred_indexing
+_deferred_indexing_lock = threading.Lock()
+_deferred_indexing_blocks = 0
+_automatic_indexing = None
+
+
+@contextmanager
+def deferred_indexing(enabled=True):
+    """
+    Suppress the automatic search indexing of the packages modified in the block, e.g. by every resource_create.
+    The packages need to be indexed explicitly with search.rebuild, the finalizer does it once per dataset.
+
+    The setting ckan.search.automatic_indexing is global to the process: the packages modified by other threads
+    during the block are not indexed either. The harvest consumers import one harvest object at a time in their
+    own process, so only the harvest objects are affected there. The blocks running at the same time share the
+    override, the setting is restored by the last one.
+
+    :param enabled: False to keep the automatic indexing
+    :type enabled: bool
+    """
+    if not enabled:
+        yield
+        return
+
+    global _deferred_indexing_blocks, _automatic_indexing
+    key = 'ckan.search.automatic_indexing'
+    with _deferred_indexing_lock:
+        if not _deferred_indexing_blocks:
+            _automatic_indexing = ckanconf.get(key)
+            ckanconf[key] = 'false'
+        _deferred_indexing_blocks += 1
+    try:
+        yield
+    finally:
+        with _deferred_indexing_lock:
+            _deferred_indexing_blocks -= 1
+            if not _deferred_indexing_blocks:
+                if _automatic_indexing is None:
+                    del ckanconf[key]
+                else:
+                    ckanconf[key] = _automatic_indexing
+
+
 class BaseSBBHarvester(HarvesterBase):
     """
     A Base SBB Harvester for harvesting data from ftp/s3 aws server.
@@ -64,6 +127,7 @@ class BaseSBBHarvester(HarvesterBase):
     """
 
     config = None  # ckan harvester config, not ftp/s3 config
+    _regexes = {}  # compiled regexes of the config, see _load_source_config
 
     api_version = 2
     action_api_version = 3
@@ -77,6 +141,8 @@ class BaseSBBHarvester(HarvesterBase):
     default_format = 'TXT'
     default_mimetype = 'TXT'
     default_mimetype_inner = 'TXT'
+    # formats of the files harvested by the child classes, which are not in the resource formats of ckan
+    additional_formats = ()
 
     tmpfolder_prefix = "%d%m%Y-%H%M-"
 
@@ -188,6 +254,14 @@ class BaseSBBHarvester(HarvesterBase):
             'storage_adapter': basestring,
             'bucket': basestring,
             voluptuous.Required('date_pattern', default=None): basestring,
+            'fetch_concurrency': voluptuous.All(int, voluptuous.Range(min=1)),
+            voluptuous.Required('fetch_retries', default=2): voluptuous.All(int, voluptuous.Range(min=0)),
+            voluptuous.Required('streaming', default=False): bool,
+            voluptuous.Required('change_detection', default='modified_date'): voluptuous.Any('modified_date', 'hash'),
+            voluptuous.Required('grouped_import', default=False): bool,
+            voluptuous.Required('defer_indexing', default=True): bool,
+            voluptuous.Required('defer_file_cleanup', default=False): bool,
+            voluptuous.Required('log_mode', default='verbose'): voluptuous.Any('verbose', 'quiet'),
         })
 
     def load_config(self, config_str):
@@ -195,6 +269,30 @@ class BaseSBBHarvester(HarvesterBase):
         data = json.loads(config_str)
         return schema(data)
 
+    def _load_source_config(self, source):
+        """
+        Get the validated config of a harvest source, it is only parsed and validated again when it changed.
+        The regexes of the config (the keys ending with _regex) are compiled once into self._regexes.
+
+        :param source: The harvest source
+        :type source: HarvestSource
+
+        :returns: A copy of the validated config, as the storage adapters add their settings to it
+        :rtype: dict
+        """
+        config_hash = hashlib.sha1((source.config or '').encode('utf-8')).hexdigest()
+        key = (self.__class__.__name__, source.id, config_hash)
+        cached = _source_configs.get(key)
+        if cached is None:
+            config = self.load_config(source.config)
+            regexes = dict((name, re.compile(value)) for name, value in config.items()
+                           if name.endswith('_regex') and isinstance(value, basestring))
+            cached = (config, regexes)
+            _source_configs.set(key, cached)
+
+        config, self._regexes = cached
+        return dict(config)
+
     # tested
     def _add_harvester_metadata(self, package_dict):
         """
@@ -380,7 +478,7 @@ class BaseSBBHarvester(HarvesterBase):
         file_format = self.default_format
         mimetype = self.default_mimetype
         mimetype_inner = self.default_mimetype_inner
-        if ext and ext.lower() in helpers.resource_formats():
+        if ext and (ext.lower() in helpers.resource_formats() or ext in self.additional_formats):
             # set mime types
             file_format = mimetype = mimetype_inner = ext
         return file_format, mimetype, mimetype_inner
@@ -390,29 +488,349 @@ class BaseSBBHarvester(HarvesterBase):
             if key in resource:
                 del resource[key]
 
+    def _fetch_file(self, remotefolder, filename, targetfile, source_id):
+        """
+        Fetch a file, trying again up to `fetch_retries` times (harvester config) if the download fails.
+        Every attempt continues the partial download left by the previous one, also the first attempt of the
+        next harvest job of the source.
+
+        :param remotefolder: Remote folder of the file
+        :type remotefolder: str or unicode
+        :param filename: File to fetch
+        :type filename: str or unicode
+        :param targetfile: Local path to store the file
+        :type targetfile: str or unicode
+        :param source_id: Id of the harvest source, the partial downloads are kept by source
+        :type source_id: str or unicode
+
+        :returns: Status of the download
+        :rtype: string
+        """
+        retries = self.config.get('fetch_retries', 0)
+        for attempt in range(retries + 1):
+            try:
+                with StorageAdapterFactory(ckanconf).get_storage_adapter(remotefolder, self.config) as storage:
+                    storage.keep_partial_downloads(source_id)
+                    return storage.fetch(filename, targetfile)
+            except Exception:
+                if attempt == retries:
+                    raise
+                log.exception('Fetching %s failed, trying again (%d/%d)' % (filename, attempt + 1, retries))
+
+    def _fetch_job_file(self, harvest_object, remotefolder, filename, targetfile):
+        """
+        Fetch the file of a harvest object, unless it has been downloaded by the prefetch of the job already,
+        see _prefetch_job_files
+
+        :returns: Status of the download
+        :rtype: string
+        """
+        if filename in self._prefetch_job_files(harvest_object, remotefolder, os.path.dirname(targetfile)):
+            return '226 Transfer complete (prefetched)'
+        return self._fetch_file(remotefolder, filename, targetfile, harvest_object.job.source.id)
+
+    def _prefetch_job_files(self, harvest_object, remotefolder, workingdir):
+        """
+        Download the files of all the fetch objects of the job concurrently, if `fetch_concurrency` is set in the
+        harvester config. The first fetch object of the job downloads them, the other ones wait for it (the prefetch
+        file of the working folder is locked) and then find their file downloaded. Files that could not be
+        downloaded are fetched again by their own object.
+
+        :param harvest_object: The harvest object being fetched
+        :param remotefolder: Remote folder of the files
+        :type remotefolder: str or unicode
+        :param workingdir: Working folder of the job
+        :type workingdir: str or unicode
+
+        :returns: The files which have been downloaded successfully by the prefetch
+        :rtype: set
+        """
+        if not self.config.get('fetch_concurrency'):
+            return set()
+
+        with open(os.path.join(workingdir, PREFETCH_FILENAME), 'a+') as prefetch_file:
+            fcntl.flock(prefetch_file, fcntl.LOCK_EX)
+            prefetch_file.seek(0)
+            content = prefetch_file.read()
+            if content:
+                # prefetched by another object of the job
+                return set(json.loads(content))
+
+            filelist = self._get_job_files_to_fetch(harvest_object, remotefolder, workingdir)
+            fetched_files = self._prefetch_files(remotefolder, filelist, workingdir, harvest_object.job.source.id)
+            prefetch_file.write(json.dumps(sorted(fetched_files)))
+            return fetched_files
+
+    def _get_job_files_to_fetch(self, harvest_object, remotefolder, workingdir):
+        """
+        Get the files to download of the fetch objects of the job, see _prefetch_job_files
+
+        :param harvest_object: The harvest object being fetched
+        :param remotefolder: Remote folder of the files
+        :type remotefolder: str or unicode
+        :param workingdir: Working folder of the job
+        :type workingdir: str or unicode
+
+        :returns: The files
+        :rtype: list
+        """
+        filelist = set()
+        query = Session.query(HarvestObject.content) \
+            .filter(HarvestObject.harvest_job_id == harvest_object.job.id)
+        for content, in query:
+            try:
+                data = json.loads(content)
+            except (TypeError, ValueError):
+                continue
+            # the objects which have been fetched already have no working folder any more
+            if data.get('type') == 'file' and data.get('workingdir') == workingdir and \
+                    data.get('remotefolder') == remotefolder and not self._is_streamed(data):
+                filelist.add(data['file'])
+        return sorted(filelist)
+
+    def _prefetch_files(self, remotefolder, filelist, workingdir, source_id):
+        """
+        Download files concurrently, see _prefetch_job_files
+
+        :param remotefolder: Remote folder of the files
+        :type remotefolder: str or unicode
+        :param filelist: Files to download
+        :type filelist: list
+        :param workingdir: Local folder to store the files
+        :type workingdir: str or unicode
+        :param source_id: Id of the harvest source, the partial downloads are kept by source
+        :type source_id: str or unicode
+
+        :returns: The files which have been downloaded successfully
+        :rtype: set
+        """
+        concurrency = self.config.get('fetch_concurrency')
+        if not filelist:
+            return set()
+
+        log.info('Fetching %d files with %d connections', len(filelist), concurrency)
+
+        storage = StorageAdapterFactory(ckanconf).get_storage_adapter(remotefolder, self.config)
+        storage.keep_partial_downloads(source_id)
+        start = time.time()
+        results = storage.fetch_many(filelist, workingdir, concurrency)
+        elapsed = time.time() - start
+
+        fetched_files = set()
+        for filename, status in results.iteritems():
+            if isinstance(status, basestring) and '226' in status:
+                fetched_files.add(filename)
+            else:
+                # the file is fetched again by its own object, where a failure is stored as object error
+                log.warning('Could not fetch %s [%s], retrying with its harvest object', filename, str(status))
+
+        log.info('Fetched %d of %d files in %ds', len(fetched_files), len(filelist), elapsed)
+        return fetched_files
+
+    def _skip_unchanged_files(self, harvest_job, filelist_with_dataset, remote_files, file_hashes):
+        """
+        Remove the files which did not change since they were last imported by the harvest source,
+        according to the harvest state stored by the finalizer. A file is only skipped if its resource still exists.
+        Files without a harvest state (imported before the harvest state was stored) are skipped if the dataset
+        has a resource for the file which was created after the file was modified, their state is stored then.
+
+        :param harvest_job: Harvester job
+        :param filelist_with_dataset: The remote files with the dataset they are imported into
+        :type filelist_with_dataset: list of (filename, dataset) tuples
+        :param remote_files: The metadata of the remote files by filename, see get_remote_file_metadata
+        :type remote_files: dict
+        :param file_hashes: The content hash of the remote files by filename, see get_remote_file_hash
+        :type file_hashes: dict
+
+        :returns: The files to harvest, with their dataset
+        :rtype: list of (filename, dataset) tuples
+        """
+        file_states = harvest_state.get_file_states(harvest_job.source.id)
+
+        changed_files = []
+        unchanged_files = {}  # resource id by filename
+        unknown_files = []
+        for filename, dataset in filelist_with_dataset:
+            remote_file = remote_files[filename]
+            file_state = file_states.get(filename)
+            if file_state is None:
+                unknown_files.append((filename, dataset))
+            elif file_state.resource_id and harvest_state.is_unchanged(
+                    file_state, remote_file.size, file_hashes.get(filename), remote_file.modified_date):
+                unchanged_files[filename] = file_state.resource_id
+            else:
+                changed_files.append((filename, dataset))
+
+        # only skip when the resource of the file still exists (deleted by max_resources is fine)
+        existing_resource_ids = set()
+        if unchanged_files:
+            query = Session.query(model.Resource.id).filter(model.Resource.id.in_(set(unchanged_files.values())))
+            existing_resource_ids = set(row.id for row in query)
+        for filename, dataset in filelist_with_dataset:
+            if filename in unchanged_files and unchanged_files[filename] not in existing_resource_ids:
+                changed_files.append((filename, dataset))
+
+        if unknown_files:
+            changed_files.extend(self._skip_imported_files(harvest_job, unknown_files, remote_files, file_hashes))
+
+        log.info('%d of %d files changed since they were last harvested',
+                 len(changed_files), len(filelist_with_dataset))
+        return sorted(changed_files)
+
+    def _skip_imported_files(self, harvest_job, filelist_with_dataset, remote_files, file_hashes):
+        """
+        Remove the files without harvest state which have a resource created after the file was modified,
+        and store their harvest state for the next harvest jobs.
+
+        :returns: The files to harvest, with their dataset
+        :rtype: list of (filename, dataset) tuples
+        """
+        existing_resources = self._get_existing_resources(set(map(itemgetter(1), filelist_with_dataset)))
+        changed_files = []
+        imported_file_states = []
+        for filename, dataset in filelist_with_dataset:
+            remote_file = remote_files[filename]
+            resource = existing_resources[dataset].get(munge_filename(os.path.basename(filename)))
+            if resource is None or not remote_file.modified_date or remote_file.modified_date >= resource.created:
+                changed_files.append((filename, dataset))
+                continue
+
+            file_state = self._get_file_state_data(remote_file, file_hashes.get(filename))
+            file_state['modified_date'] = remote_file.modified_date
+            file_state['resource_id'] = resource.id
+            imported_file_states.append(file_state)
+
+        harvest_state.save_file_states(harvest_job.source.id, imported_file_states)
+        return changed_files
+
+    def _get_existing_resources(self, datasets):
+        """
+        Get the resources of several datasets, with one search for the datasets and one query for their resources
+
+        :param datasets: Identifiers of the datasets
+        :type datasets: set
+
+        :returns: The resources by filename (see _get_resources_by_filename) of every dataset,
+                  empty for the datasets which do not exist yet
+        :rtype: dict
+        """
+        packages = get_action('ogdch_datasets_by_identifier')({}, {'identifiers': list(datasets)})
+        package_datasets = dict((package['id'], dataset) for dataset, package in packages.iteritems())
+
+        resources_by_dataset = defaultdict(list)
+        if package_datasets:
+            query = Session.query(model.Resource).filter(model.Resource.package_id.in_(package_datasets.keys()))
+            for resource in query:
+                resources_by_dataset[package_datasets[resource.package_id]].append(resource)
+
+        return dict((dataset, self._get_resources_by_filename(resources_by_dataset[dataset])) for dataset in datasets)
+
+    def _get_resources_by_filename(self, resources):
+        """
+        Get the current resource of every file of a dataset, including the ones deleted by max_resources
+
+        :param resources: All the resources of the dataset, e.g. package.resources_all
+        :type resources: list of model.Resource
+
+        :returns: The active resource of every filename, or the latest deleted one
+        :rtype: dict
+        """
+        resources_by_filename = {}
+        for resource in sorted(resources, key=lambda r: (r.state == 'active', r.created)):
+            resources_by_filename[resource_filename(resource.url)] = resource
+        return resources_by_filename
+
+    def _get_file_state_data(self, remote_file, file_hash):
+        """
+        Get the state of a remote file, stored by the finalizer for the change detection of the next harvest jobs
+
+        :param remote_file: The metadata of the remote file, see get_remote_file_metadata
+        :type remote_file: RemoteFile
+        :param file_hash: The content hash of the remote file, None if unknown
+        :type file_hash: str
+
+        :rtype: dict
+        """
+        return {
+            'filename': remote_file.name,
+            'size': remote_file.size,
+            'hash': file_hash,
+            'modified_date': remote_file.modified_date.isoformat() if remote_file.modified_date else None,
+        }
+
+    def _save_file_states(self, harvest_object, dataset, package_id):
+        """
+        Store the harvest state of the files of a dataset imported by the harvest job, with the id of their resource.
+        The state is taken from the harvest objects of the job which have been imported successfully.
+
+        :param harvest_object: The finalizer harvest object
+        :param dataset: Identifier of the dataset
+        :type dataset: str
+        :param package_id: Id of the dataset
+        :type package_id: str
+        """
+        resources = self._get_resources_by_filename(model.Package.get(package_id).resources_all)
+
+        file_states = []
+        query = Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id == harvest_object.job.id) \
+            .filter(HarvestObject.state == 'COMPLETE')
+        for imported_object in query:
+            try:
+                data = json.loads(imported_object.content)
+            except (TypeError, ValueError):
+                continue
+            if 'file_state' not in data or data.get('dataset') != dataset:
+                continue
+
+            file_state = dict(data['file_state'])
+            modified_date = file_state['modified_date']
+            if modified_date:
+                file_state['modified_date'] = datetime.strptime(modified_date[:19], '%Y-%m-%dT%H:%M:%S')
+            resource = resources.get(munge_filename(os.path.basename(file_state['filename'])))
+            file_state['resource_id'] = resource.id if resource else None
+            file_states.append(file_state)
+
+        harvest_state.save_file_states(harvest_object.source.id, file_states)
+
+    def _get_file_harvest_object_data(self, filename, dataset, workingdir, remotefolder):
+        """
+        Get the content of the harvest object that imports a remote file
+
+        :returns: Harvest object content
+        :rtype: dict
+        """
+        return {
+            'type': 'file',
+            'file': filename,
+            'workingdir': workingdir,
+            'remotefolder': remotefolder,
+            'dataset': dataset,
+        }
+
     def _setup_logging(self, harvest_job):
         log_dir = os.path.join('/etc/ckan/harvester_logs', munge_filename(harvest_job.source.title))
+        log_file = os.path.join(log_dir, '{}.log'.format(harvest_job.created.strftime('%Y-%m-%d_%H-%M-%S')))
         try:
-            os.makedirs(log_dir)
-        except os.error:
-            pass  # directory already exists
-        file_handler = logging.FileHandler(os.path.join(
-            log_dir, '{}.log'.format(harvest_job.created.strftime('%Y-%m-%d_%H-%M-%S'))), 'a')
-        file_formatter = logging.Formatter('%(asctime)s %(levelname)-5.5s [%(name)s] %(message)s')
-        file_handler.setFormatter(file_formatter)
-        stdout_handler = logging.StreamHandler(stream=sys.stdout)
-        stdout_formatter = logging.Formatter('[%(name)s] %(message)s')
-        stdout_handler.setFormatter(stdout_formatter)
-
-        for name, logger in logging.Logger.manager.loggerDict.items():
-            if isinstance(logger, logging.Logger):
-                if name.startswith('ckan'):
-                    logger.setLevel(logging.DEBUG)
-                if logger.handlers:
-                    for handler in logger.handlers[:]:
-                        logger.removeHandler(handler)
-                    logger.addHandler(file_handler)
-                    logger.addHandler(stdout_handler)
+            quiet = self._load_source_config(harvest_job.source)['log_mode'] == 'quiet'
+        except Exception:
+            quiet = False  # the error is stored by the stage
+        # the loggers are only set up by the first stage of the job
+        setup_job_logging(harvest_job.id, log_file, logging.INFO if quiet else logging.DEBUG)
+
+    def _log_detail(self, msg, *args):
+        """
+        Log the details of a harvest object, at INFO level in the verbose log mode, at DEBUG level in the quiet one.
+        The message is only formatted if it is logged.
+        """
+        quiet = self.config is not None and self.config.get('log_mode') == 'quiet'
+        log.log(logging.DEBUG if quiet else logging.INFO, msg, *args)
+
+    def _count(self, harvest_object, dataset, **values):
+        """
+        Add values to the counters of a dataset, logged by its finalizer
+        """
+        harvest_logging.count(harvest_object.job_id, dataset, **values)
 
     # =======================================================================
     # GATHER Stage
@@ -468,7 +886,9 @@ class BaseSBBHarvester(HarvesterBase):
             self._save_object_error('Unable to decode harvester info: %s' % str(e), harvest_object.content, stage)
             return False
 
-        log.info('Harvest object json: %s', harvest_object.content)
+        self.config = self._load_source_config(harvest_object.job.source)
+
+        self._log_detail('Harvest object json: %s', harvest_object.content)
 
         if obj['type'] != 'file':
             return True
@@ -493,57 +913,121 @@ class BaseSBBHarvester(HarvesterBase):
                                     harvest_object, stage)
             return False
 
-        log.info("Remote directory: %s", remotefolder)
-        log.info("Local directory: %s", tmpfolder)
-        
-        # Here we removed "validate configuration". This is now done inside of the StorageAdapter, that knows what it needs
-        self.config = self.load_config(harvest_object.job.source.config)
+        self._log_detail("Remote directory: %s", remotefolder)
+        self._log_detail("Local directory: %s", tmpfolder)
+
+        if self._is_streamed(obj):
+            # the import stage streams the file from the storage into the filestore, without a local copy.
+            self._log_detail('Streaming file %s during import', f)
+            return self._save_fetched_object(harvest_object, obj, {
+                'type': 'file',
+                'file': os.path.join(tmpfolder, f),
+                'tmpfolder': tmpfolder,
+                'remotefolder': remotefolder,
+                'stream': True,
+                'dataset': obj['dataset'],
+            })
+
+        targetfile = self._download_file(harvest_object, obj, tmpfolder, remotefolder)
+        if not targetfile:
+            return False
+
+        # store the info for the next step
+        return self._save_fetched_object(harvest_object, obj, {
+            'type': 'file',
+            'file': targetfile,
+            'tmpfolder': tmpfolder,
+            'dataset': obj['dataset'],
+        })
+
+    def _is_streamed(self, harvest_object_data):
+        """
+        Whether the file of a harvest object is streamed into the filestore by the import stage instead of being
+        downloaded by the fetch stage (`streaming` in the harvester config). Filtered files and the files used by
+        other objects (e.g. the Info+ zip file) are still downloaded, as they are read from the local file.
+
+        :param harvest_object_data: The content of the gathered harvest object
+        :type harvest_object_data: dict
 
+        :rtype: bool
+        """
+        return (self.config['streaming'] and 'filter' not in harvest_object_data
+                and not harvest_object_data.get('download'))
+
+    def _download_file(self, harvest_object, harvest_object_data, tmpfolder, remotefolder):
+        """
+        Download the file of a harvest object into the working folder of the job
+
+        :param harvest_object: HarvesterObject instance
+        :param harvest_object_data: The content of the gathered harvest object
+        :type harvest_object_data: dict
+        :param tmpfolder: Working folder of the job
+        :type tmpfolder: str
+        :param remotefolder: Remote folder of the file
+        :type remotefolder: str
+
+        :returns: The path of the downloaded file, None if the download failed (the object error is stored)
+        :rtype: str
+        """
+        stage = 'Fetch'
+        f = harvest_object_data['file']
         try:
-            with StorageAdapterFactory(ckanconf).get_storage_adapter(remotefolder, self.config) as storage:
+            # fetching file
+            # -------------------------------------------------------------------
+            # full path of the destination file
+            targetfile = os.path.join(tmpfolder, f)
 
-                # fetching file
-                # -------------------------------------------------------------------
-                # full path of the destination file
-                targetfile = os.path.join(tmpfolder, f)
+            self._log_detail('Fetching file: %s', f)
 
-                log.info('Fetching file: %s' % str(f))
+            start = time.time()
+            # 226 Transfer complete
+            status = self._fetch_job_file(harvest_object, remotefolder, f, targetfile)
+            elapsed = time.time() - start
 
-                start = time.time()
-                status = storage.fetch(f, targetfile)  # 226 Transfer complete
-                elapsed = time.time() - start
+            self._log_detail("Fetched %s [%s] in %ds", f, status, elapsed)
 
-                log.info("Fetched %s [%s] in %ds" % (f, str(status), elapsed))
+            if '226' not in status:
+                self._save_object_error('Download error for file %s: %s' % (f, str(status)), harvest_object, stage)
+                return None
 
-                if '226' not in status:
-                    self._save_object_error('Download error for file %s: %s' % (f, str(status)), harvest_object, stage)
-                    return False
+            self._count(harvest_object, harvest_object_data['dataset'], files_fetched=1,
+                        fetch_ms=int(elapsed * 1000), bytes_fetched=os.path.getsize(targetfile))
 
         except ftplib.all_errors:
             log.exception('Ftplib error')
             self._save_object_error('Ftplib error: {}'.format(traceback.format_exc()), harvest_object, stage)
             self.cleanup_after_error(tmpfolder)
-            return False
+            return None
 
         except Exception:
             log.exception('An error occurred')
             self._save_object_error('An error occurred: {}'.format(traceback.format_exc()), harvest_object, stage)
             self.cleanup_after_error(tmpfolder)
-            return False
+            return None
 
-        # store the info for the next step
-        retobj = {
-            'type': 'file',
-            'file': targetfile,
-            'tmpfolder': tmpfolder,
-            'dataset': obj['dataset'],
-        }
-        if 'filter' in obj:
-            retobj['filter'] = obj['filter']
+        return targetfile
+
+    def _save_fetched_object(self, harvest_object, harvest_object_data, content):
+        """
+        Store the content of a fetched harvest object for the import stage, with the filter and the file state
+        of the gathered content
+
+        :param harvest_object: HarvesterObject instance
+        :param harvest_object_data: The content of the gathered harvest object
+        :type harvest_object_data: dict
+        :param content: The content for the import stage
+        :type content: dict
+
+        :returns: True
+        :rtype: bool
+        """
+        for key in ['filter', 'file_state']:
+            if key in harvest_object_data:
+                content[key] = harvest_object_data[key]
 
         # Save the directory listing and other info in the HarvestObject
         # serialise the dictionary
-        harvest_object.content = json.dumps(retobj)
+        harvest_object.content = json.dumps(content)
         harvest_object.save()
         return True
 
@@ -589,13 +1073,19 @@ class BaseSBBHarvester(HarvesterBase):
             self._save_object_error('Unable to decode harvester info: %s' % str(e), harvest_object, stage)
             return False
 
-        log.info('Harvest object json: %s', harvest_object.content)
-
         # set harvester config
-        self.config = self.load_config(harvest_object.job.source.config)
+        self.config = self._load_source_config(harvest_object.job.source)
+
+        self._log_detail('Harvest object json: %s', harvest_object.content)
 
         if obj['type'] == 'finalizer':
-            self.finalize(harvest_object, obj)
+            try:
+                with deferred_indexing(self.config['defer_indexing']):
+                    self.finalize(harvest_object, obj)
+            except Exception:
+                # the changes of the harvest job are only indexed at the end of the finalizer
+                self._rebuild_search_index(obj['dataset'])
+                raise
             return True
 
         if obj['type'] == 'remove_tempdir':
@@ -618,6 +1108,15 @@ class BaseSBBHarvester(HarvesterBase):
             self._save_object_error('Could not get path of temporary folder: %s' % tmpfolder, harvest_object, stage)
             return False
 
+        if self.config['grouped_import'] and not obj.get('stream'):
+            # the files of a dataset are imported together by its finalizer, in one package update
+            obj['grouped_import'] = True
+            harvest_object.content = json.dumps(obj)
+            harvest_object.save()
+            self._log_detail('File %s is imported with the other files of dataset %s by the finalizer', f,
+                             obj['dataset'])
+            return True
+
         context = {'model': model, 'session': Session, 'user': self._get_user_name()}
 
         now = datetime.now().isoformat()
@@ -625,286 +1124,490 @@ class BaseSBBHarvester(HarvesterBase):
         # =======================================================================
         # package
         # =======================================================================
-        resource_meta = None
+        try:
+            dataset = self._get_or_create_dataset(harvest_object, obj['dataset'], context, now)
+        except Exception:
+            log.exception('Package update/creation error')
+            self._save_object_error('Package update/creation error: {}'.format(traceback.format_exc()),
+                                    harvest_object, stage)
+            return False
+
+        # need a dataset to continue, the error has already been stored
+        if not dataset:
+            return False
+
+        # =======================================================================
+        # resource
+        # =======================================================================
+
+        self._log_detail('Importing file: %s', f)
+
+        site_url = ckanconf.get('ckan.site_url', None)
+        if not site_url:
+            self._save_object_error('Could not get site_url from CKAN config file', harvest_object, stage)
+            return False
+
+        self._log_detail("Adding %s to package with id %s", f, dataset['id'])
 
+        import_file = None
+        try:
+            # opened once, read once by the CKAN uploader while hashing it
+            import_file = self._open_file_to_import(obj)
+
+            resource_meta, old_resource_id = self._get_resource_meta(dataset, f, import_file, now)
+
+            # only the resource changes are deferred, a new dataset has been indexed when it was created
+            with deferred_indexing(self.config['defer_indexing']):
+                resource = get_action('resource_create')(context, resource_meta)
+
+                self._log_detail("Successfully created resource")
+
+                # the hash is only known once the uploader has read the file
+                self._set_resource_hash(resource['id'], import_file.hexdigest())
+
+                # delete the old version of the resource
+                if old_resource_id:
+                    log.info('Deleting old resource: %s', old_resource_id)
+
+                    self._delete_datastore(context, old_resource_id)
+
+                    get_action('resource_delete')(context, {'id': old_resource_id})
+
+            self._log_detail("Successfully harvested file %s", f)
+            self._count(harvest_object, obj['dataset'], files_imported=1, bytes_imported=import_file.bytes_read,
+                        files_streamed=1 if obj.get('stream') else 0)
+
+            # ---------------------------------------------------------------------
+
+        except Exception:
+            log.exception('Error adding resource')
+            self._save_object_error('Error adding resource: {}'.format(traceback.format_exc()),
+                                    harvest_object, stage)
+            if self.config['defer_indexing']:
+                # the finalizer might not run, the changes committed so far are indexed now
+                self._rebuild_search_index(obj['dataset'])
+            return False
+
+        finally:
+
+            # close the file pointer
+            if import_file:
+                import_file.close()
+        return True
+
+    def _get_or_create_dataset(self, harvest_object, dataset_identifier, context, now):
+        """
+        Get the dataset to import the files into, create it if it does not exist yet
+
+        :param harvest_object: HarvesterObject instance
+        :param dataset_identifier: Identifier of the dataset
+        :type dataset_identifier: str
+        :param now: Timestamp of the import, in ISO format
+        :type now: str
+
+        :returns: The dataset, None if the harvester is not allowed to create it (the object error is stored)
+        :rtype: dict
+        """
         try:
             # -----------------------------------------------------------------------
             # use the existing package dictionary (if it exists)
             # -----------------------------------------------------------------------
 
-            dataset = self._get_dataset(obj['dataset'])
+            dataset = self._get_dataset(dataset_identifier)
             log.info("Using existing package with id %s", str(dataset.get('id')))
 
             # update version of package
             dataset['version'] = now
-
-            # check if there is a resource matching the filename in the package
-            resource_meta = self.find_resource_in_package(dataset, f)
-            if resource_meta:
-                log.info('Found existing resource: %s' % str(resource_meta))
+            return dataset
 
         except NotFound:
-            # -----------------------------------------------------------------------
-            # create the package dictionary instead
-            # -----------------------------------------------------------------------
-
-            # add the metadata from the harvester
-
-            package_dict = {
-                'name': munge_name(obj['dataset']),
-                'identifier': obj['dataset']
-            }
+            pass
 
-            package_dict = self._add_harvester_metadata(package_dict)
-
-            # title of the package
-            if 'title' not in package_dict:
-                package_dict['title'] = {
-                    "de": obj['dataset'],
-                    "en": obj['dataset'],
-                    "fr": obj['dataset'],
-                    "it": obj['dataset']
-                }
-            # for DCAT schema - same info as in the title
-            if 'display_name' not in package_dict:
-                package_dict['display_name'] = package_dict['title']
-
-            package_dict['creator_user_id'] = model.User.get(context['user']).id
-
-            # fill with empty defaults
-            for key in ['issued', 'metadata_created']:
-                package_dict[key] = now
-            for key in ['resources', 'groups', 'tags', 'extras', 'contact_points', 'relations',
-                        'relationships_as_object', 'relationships_as_subject', 'publishers', 'see_alsos', 'temporals']:
-                if key not in package_dict:
-                    package_dict[key] = []
-            for key in ['keywords']:
-                if key not in package_dict:
-                    package_dict[key] = {}
-
-            package_dict['source_type'] = self.info()['name']
-
-            # count keywords or tags
-            package_dict['num_tags'] = 0
-            tags = package_dict.get('keywords') if package_dict.get('keywords', {}) else package_dict.get('tags', {})
-            # count the english tags (if available)
-            if tags and 'en' in tags and isinstance(tags['en'], list):
-                package_dict['num_tags'] = len(tags['en'])
-
-            if 'language' not in package_dict:
-                package_dict['language'] = ["en", "de", "fr", "it"]
-
-            package_dict = self._add_package_tags(package_dict)
-            package_dict = self._add_package_groups(package_dict, context)
-            source_org = model.Package.get(harvest_object.source.id).owner_org
-            package_dict = self._add_package_orgs(package_dict, context, source_org)
-            package_dict = self._add_package_extras(package_dict, harvest_object)
-
-            # version
-            package_dict['version'] = now
+        # -----------------------------------------------------------------------
+        # create the package
+        # -----------------------------------------------------------------------
 
-            # -----------------------------------------------------------------------
-            # create the package
-            # -----------------------------------------------------------------------
+        package_dict = self._create_package_dict(harvest_object, dataset_identifier, context, now)
 
-            log.debug("Package dict (pre-creation): %s" % str(package_dict))
+        log.debug("Package dict (pre-creation): %s" % str(package_dict))
 
-            # This logic action requires to call check_access to 
-            # prevent the Exception: 'Action function package_show  did not call its auth function'
-            # Adds action name onto the __auth_audit stack
-            if not check_access('package_create', context):
-                self._save_object_error('%s not authorised to create packages (object %s)' %
-                                        (self.harvester_name, harvest_object.id), harvest_object, stage)
-                return False
+        # This logic action requires to call check_access to 
+        # prevent the Exception: 'Action function package_show  did not call its auth function'
+        # Adds action name onto the __auth_audit stack
+        if not check_access('package_create', context):
+            self._save_object_error('%s not authorised to create packages (object %s)' %
+                                    (self.harvester_name, harvest_object.id), harvest_object, 'Import')
+            return None
 
-            # create the dataset
-            dataset = get_action('package_create')(context, package_dict)
+        # create the dataset
+        dataset = get_action('package_create')(context, package_dict)
 
-            log.info("Created package: %s" % str(dataset['name']))
+        log.info("Created package: %s" % str(dataset['name']))
+        return dataset
 
-        except Exception:
-            log.exception('Package update/creation error')
-            self._save_object_error('Package update/creation error: {}'.format(traceback.format_exc()),
-                                    harvest_object, stage)
-            return False
+    def _create_package_dict(self, harvest_object, dataset_identifier, context, now):
+        """
+        Create the package dictionary of a new dataset, with the metadata from the harvester
 
-        # need a dataset to continue
-        if not dataset:
-            self._save_object_error('Could not update or create package: %s' % self.harvester_name, harvest_object,
-                                    stage)
-            return False
+        :param harvest_object: HarvesterObject instance
+        :param dataset_identifier: Identifier of the dataset
+        :type dataset_identifier: str
+        :param now: Timestamp of the import, in ISO format
+        :type now: str
 
-        # =======================================================================
-        # resource
-        # =======================================================================
+        :returns: The package dictionary
+        :rtype: dict
+        """
+        # add the metadata from the harvester
 
-        log.info('Importing file: %s' % str(f))
+        package_dict = {
+            'name': munge_name(dataset_identifier),
+            'identifier': dataset_identifier
+        }
 
-        site_url = ckanconf.get('ckan.site_url', None)
-        if not site_url:
-            self._save_object_error('Could not get site_url from CKAN config file', harvest_object, stage)
-            return False
+        package_dict = self._add_harvester_metadata(package_dict)
 
-        log.info("Adding %s to package with id %s", str(f), dataset['id'])
+        # title of the package
+        if 'title' not in package_dict:
+            package_dict['title'] = {
+                "de": dataset_identifier,
+                "en": dataset_identifier,
+                "fr": dataset_identifier,
+                "it": dataset_identifier
+            }
+        # for DCAT schema - same info as in the title
+        if 'display_name' not in package_dict:
+            package_dict['display_name'] = package_dict['title']
+
+        package_dict['creator_user_id'] = model.User.get(context['user']).id
+
+        # fill with empty defaults
+        for key in ['issued', 'metadata_created']:
+            package_dict[key] = now
+        for key in ['resources', 'groups', 'tags', 'extras', 'contact_points', 'relations',
+                    'relationships_as_object', 'relationships_as_subject', 'publishers', 'see_alsos', 'temporals']:
+            if key not in package_dict:
+                package_dict[key] = []
+        for key in ['keywords']:
+            if key not in package_dict:
+                package_dict[key] = {}
+
+        package_dict['source_type'] = self.info()['name']
+
+        # count keywords or tags
+        package_dict['num_tags'] = 0
+        tags = package_dict.get('keywords') if package_dict.get('keywords', {}) else package_dict.get('tags', {})
+        # count the english tags (if available)
+        if tags and 'en' in tags and isinstance(tags['en'], list):
+            package_dict['num_tags'] = len(tags['en'])
+
+        if 'language' not in package_dict:
+            package_dict['language'] = ["en", "de", "fr", "it"]
+
+        package_dict = self._add_package_tags(package_dict)
+        package_dict = self._add_package_groups(package_dict, context)
+        source_org = model.Package.get(harvest_object.source.id).owner_org
+        package_dict = self._add_package_orgs(package_dict, context, source_org)
+        package_dict = self._add_package_extras(package_dict, harvest_object)
+
+        # version
+        package_dict['version'] = now
+        return package_dict
 
-        fp = None
-        try:
-            try:
-                size = int(os.path.getsize(f))
-            except ValueError:
-                size = None
-
-            fp = open(f, 'rb')
-
-            # -----------------------------------------------------
-            # create new resource, if there was no resource with the same filename (aka identifier)
-            # -----------------------------------------------------
-            if not resource_meta:
-                old_resource_id = None
-
-                # we already checked if there is a resource with the same filename, we now
-                # check if there is a resource another resource inside the dataset we could use as a template
-                # if we find one, we copy the metadata and set some of the fields, if not we use the metadata
-                # defined in this class (self.resource_dict_meta)
-
-                old_resources, _ = self._get_ordered_resources(dataset)
-                if len(old_resources):
-                    resource_meta = old_resources[0]
-                    self._reset_resource(resource_meta)
-                else:
-                    resource_meta = self.resource_dict_meta
-
-                # we always set this fields, even when there is and older version of this resource
-                resource_meta['identifier'] = os.path.basename(f)
-
-                # always overwrite this metadata
-                file_format, mimetype, mimetype_inner = self._get_mimetypes(f)
-                resource_meta['format'] = file_format
-                resource_meta['mimetype'] = mimetype
-                resource_meta['mimetype_inner'] = mimetype_inner
-
-                resource_meta['name'] = {
-                    "de": os.path.basename(f),
-                    "en": os.path.basename(f),
-                    "fr": os.path.basename(f),
-                    "it": os.path.basename(f)
-                }
-                resource_meta['title'] = {
-                    "de": os.path.basename(f),
-                    "en": os.path.basename(f),
-                    "fr": os.path.basename(f),
-                    "it": os.path.basename(f)
-                }
-
-                resource_meta['issued'] = now
-                resource_meta['version'] = now
-
-                # take this metadata from the old version if available
-                resource_meta['rights'] = resource_meta.get('rights', '')
-                resource_meta['license'] = resource_meta.get('license', '')
-                resource_meta['coverage'] = resource_meta.get('coverage', 'TODO')
-                resource_meta['description'] = resource_meta.get('description', {
-                        "de": "",
-                        "en": "",
-                        "fr": "",
-                        "it": ""
-                    })
-                resource_meta['relations'] = resource_meta.get('relations', [])
-
-                log_msg = "Creating new resource: %s"
-
-            # -----------------------------------------------------
-            # create the resource, but use the known metadata (of the old resource)
-            # -----------------------------------------------------
-            else:
-                old_resource_id = resource_meta['id']
+    def _get_resource_meta(self, dataset, f, import_file, now):
+        """
+        Get the metadata of the resource to create for a file, with the upload of the file.
+        The metadata of the existing resource with the same filename is used if there is one,
+        otherwise the one of another resource of the dataset, or the defaults of the harvester.
 
+        :param dataset: The dataset to import the file into
+        :type dataset: dict
+        :param f: Path of the file
+        :type f: str
+        :param import_file: The opened file, see _open_file_to_import
+        :type import_file: StreamingFile
+        :param now: Timestamp of the import, in ISO format
+        :type now: str
+
+        :returns: The resource metadata and the id of the existing resource replaced by it, if any
+        :rtype: tuple
+        """
+        resource_meta = self.find_resource_in_package(dataset, f)
+        if resource_meta:
+            self._log_detail('Found existing resource: %s', resource_meta)
+
+        # -----------------------------------------------------
+        # create new resource, if there was no resource with the same filename (aka identifier)
+        # -----------------------------------------------------
+        if not resource_meta:
+            old_resource_id = None
+
+            # we already checked if there is a resource with the same filename, we now
+            # check if there is a resource another resource inside the dataset we could use as a template
+            # if we find one, we copy the metadata and set some of the fields, if not we use the metadata
+            # defined in this class (self.resource_dict_meta)
+
+            old_resources, _ = self._get_ordered_resources(dataset)
+            if len(old_resources):
+                resource_meta = dict(old_resources[0])
                 self._reset_resource(resource_meta)
+            else:
+                resource_meta = dict(self.resource_dict_meta)
+
+            # we always set this fields, even when there is and older version of this resource
+            resource_meta['identifier'] = os.path.basename(f)
+
+            # always overwrite this metadata
+            file_format, mimetype, mimetype_inner = self._get_mimetypes(f)
+            resource_meta['format'] = file_format
+            resource_meta['mimetype'] = mimetype
+            resource_meta['mimetype_inner'] = mimetype_inner
+
+            resource_meta['name'] = {
+                "de": os.path.basename(f),
+                "en": os.path.basename(f),
+                "fr": os.path.basename(f),
+                "it": os.path.basename(f)
+            }
+            resource_meta['title'] = {
+                "de": os.path.basename(f),
+                "en": os.path.basename(f),
+                "fr": os.path.basename(f),
+                "it": os.path.basename(f)
+            }
 
-                log_msg = "Updating resource (with known metadata): %s"
+            resource_meta['issued'] = now
+            resource_meta['version'] = now
+
+            # take this metadata from the old version if available
+            resource_meta['rights'] = resource_meta.get('rights', '')
+            resource_meta['license'] = resource_meta.get('license', '')
+            resource_meta['coverage'] = resource_meta.get('coverage', 'TODO')
+            resource_meta['description'] = resource_meta.get('description', {
+                    "de": "",
+                    "en": "",
+                    "fr": "",
+                    "it": ""
+                })
+            resource_meta['relations'] = resource_meta.get('relations', [])
+
+            log_msg = "Creating new resource: %s"
+
+        # -----------------------------------------------------
+        # create the resource, but use the known metadata (of the old resource)
+        # -----------------------------------------------------
+        else:
+            old_resource_id = resource_meta['id']
 
-            resource_meta['package_id'] = dataset['id']
+            resource_meta = dict(resource_meta)
+            self._reset_resource(resource_meta)
 
-            # url parameter is ignored for resource uploads, but required by ckan
-            # this parameter will be replaced later by the resource patch with a link to the download file
-            if 'url' not in resource_meta:
-                resource_meta['url'] = 'http://dummy-value'
-                resource_meta['download_url'] = None
+            log_msg = "Updating resource (with known metadata): %s"
 
-            if size is not None:
-                resource_meta['size'] = size
-                resource_meta['byte_size'] = size
+        resource_meta['package_id'] = dataset['id']
 
-            if 'rights' not in resource_meta:
-                resource_meta['rights'] = ''
+        # url parameter is ignored for resource uploads, but required by ckan
+        # this parameter will be replaced later by the resource patch with a link to the download file
+        if 'url' not in resource_meta:
+            resource_meta['url'] = 'http://dummy-value'
+            resource_meta['download_url'] = None
 
-            log.info(log_msg % str(resource_meta))
+        if import_file.size is not None:
+            resource_meta['size'] = import_file.size
+            resource_meta['byte_size'] = import_file.size
 
-            upload = cgi.FieldStorage()
-            upload.file = open(f, 'rb')
-            upload.filename = os.path.basename(f)
-            resource_meta['upload'] = upload
-            resource_meta['modified'] = now
+        if 'rights' not in resource_meta:
+            resource_meta['rights'] = ''
 
-            get_action('resource_create')(context, resource_meta)
+        self._log_detail(log_msg, resource_meta)
 
-            log.info("Successfully created resource")
+        upload = cgi.FieldStorage()
+        upload.file = import_file
+        upload.filename = os.path.basename(f)
+        resource_meta['upload'] = upload
+        resource_meta['modified'] = now
 
-            # delete the old version of the resource
-            if old_resource_id:
-                log.info('Deleting old resource: %s', old_resource_id)
+        return resource_meta, old_resource_id
 
-                # delete the datastore table
-                try:
-                    get_action('datastore_delete')(context, {'resource_id': old_resource_id, 'force': True})
-                except NotFound:
-                    pass  # Sometimes importing the data into the datastore fails
+    def _delete_datastore(self, context, resource_id):
+        try:
+            get_action('datastore_delete')(context, {'resource_id': resource_id, 'force': True})
+        except NotFound:
+            pass  # Sometimes importing the data into the datastore fails
 
-                get_action('resource_delete')(context, {'id': old_resource_id})
+    def _import_grouped_files(self, harvest_object, dataset_identifier):
+        """
+        Import the files of a dataset which have been left to the finalizer by the import stage
+        (`grouped_import` in the harvester config): all the resources are created, and the old versions
+        they replace are deleted, with a single package update. The files are uploaded by the package update,
+        like by resource_create (CKAN 2.8+), the created resources are then matched to the files by filename.
 
-            log.info("Successfully harvested file %s" % f)
+        If the import fails, the error is stored on each of the grouped harvest objects, which were marked as
+        complete by the import stage, so that the files are harvested again by the next job.
 
-            # ---------------------------------------------------------------------
+        :param harvest_object: The finalizer harvest object
+        :param dataset_identifier: Identifier of the dataset
+        :type dataset_identifier: str
+        """
+        grouped_harvest_objects = []
+        grouped_objects = []
+        query = Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id == harvest_object.job.id) \
+            .filter(HarvestObject.state == 'COMPLETE')
+        for grouped_object in query:
+            try:
+                data = json.loads(grouped_object.content)
+            except (TypeError, ValueError):
+                continue
+            if data.get('grouped_import') and data.get('dataset') == dataset_identifier:
+                grouped_harvest_objects.append(grouped_object)
+                grouped_objects.append(data)
+        if not grouped_objects:
+            return
 
+        try:
+            self._update_grouped_dataset(harvest_object, dataset_identifier, grouped_objects)
         except Exception:
-            log.exception('Error adding resource')
-            self._save_object_error('Error adding resource: {}'.format(traceback.format_exc()),
-                                    harvest_object, stage)
-            return False
+            log.exception('Grouped import of dataset %s failed', dataset_identifier)
+            message = 'Grouped import failed: {}'.format(traceback.format_exc())
+            for grouped_object in grouped_harvest_objects:
+                self._save_object_error(message, grouped_object, 'Import')
+                grouped_object.state = 'ERROR'
+                grouped_object.save()
+            raise
+
+    def _update_grouped_dataset(self, harvest_object, dataset_identifier, grouped_objects):
+        """
+        Create the resources of the files of a grouped import with a single package update, see _import_grouped_files
+
+        :param harvest_object: The finalizer harvest object
+        :param dataset_identifier: Identifier of the dataset
+        :type dataset_identifier: str
+        :param grouped_objects: The content of the harvest objects of the files
+        :type grouped_objects: list of dict
+        """
+        context = {'model': model, 'session': Session, 'user': self._get_user_name()}
+        now = datetime.now().isoformat()
+
+        dataset = self._get_or_create_dataset(harvest_object, dataset_identifier, context, now)
+        if not dataset:
+            raise Exception('Could not update or create package: %s' % self.harvester_name)
+
+        log.info('Importing %d files into package with id %s', len(grouped_objects), dataset['id'])
 
+        import_files = []
+        try:
+            new_resources = []
+            old_resource_ids = set()
+            for data in grouped_objects:
+                import_file = self._open_file_to_import(data)
+                import_files.append(import_file)
+                resource_meta, old_resource_id = self._get_resource_meta(dataset, data['file'], import_file, now)
+                new_resources.append(resource_meta)
+                if old_resource_id:
+                    old_resource_ids.add(old_resource_id)
+
+            for old_resource_id in old_resource_ids:
+                self._delete_datastore(context, old_resource_id)
+
+            # the resources missing in the list are deleted by the package update, the new ones are uploaded by it
+            dataset['resources'] = [r for r in dataset['resources'] if r['id'] not in old_resource_ids]
+            kept_resource_ids = set(r['id'] for r in dataset['resources'])
+            dataset['resources'] += new_resources
+            dataset = get_action('package_update')(context, dataset)
+
+            # the hashes are only known once the files have been read
+            created_resources = self._get_created_resources(dataset, kept_resource_ids, grouped_objects)
+            for resource, import_file in zip(created_resources, import_files):
+                self._set_resource_hash(resource['id'], import_file.hexdigest())
+
+            log.info('Successfully harvested %d files into package %s', len(new_resources), dataset['name'])
+            self._count(harvest_object, dataset_identifier, files_imported=len(new_resources),
+                        bytes_imported=sum(import_file.bytes_read for import_file in import_files))
         finally:
+            for import_file in import_files:
+                import_file.close()
 
-            # close the file pointer
-            if fp:
-                fp.close()
-        return True
+    def _get_created_resources(self, dataset, kept_resource_ids, grouped_objects):
+        """
+        Find the resources created by the package update of a grouped import, by the filename of their upload,
+        whatever their order in the updated dataset
 
-    def _get_ordered_resources(self, package):
-        ordered_resources = []
-        unmatched_resources = []
+        :param dataset: The updated dataset
+        :type dataset: dict
+        :param kept_resource_ids: Ids of the resources of the dataset before the update, which were kept
+        :type kept_resource_ids: set
+        :param grouped_objects: The content of the harvest objects of the imported files
+        :type grouped_objects: list of dict
 
-        # get filename regex for permalink from harvester config or fallback to a catch-all
-        identifier_regex = self.config['resource_regex']
-        for resource in package['resources']:
-            log.info('Testing filename: %s', resource['identifier'])
-            if re.match(identifier_regex, resource['identifier'], re.IGNORECASE):
-                log.info('Filename %s matches regex %s', resource['identifier'], identifier_regex)
-                ordered_resources.append(resource)
-            else:
-                unmatched_resources.append(resource)
+        :returns: The created resource of each imported file, in the order of grouped_objects
+        :rtype: list of dict
+        """
+        created_resources = {}
+        for resource in dataset['resources']:
+            if resource['id'] not in kept_resource_ids:
+                created_resources[resource_filename(resource['url'])] = resource
+
+        resources = []
+        for data in grouped_objects:
+            filename = munge_filename(os.path.basename(data['file']))
+            resource = created_resources.get(filename)
+            if resource is None or resource.get('url_type') != 'upload':
+                # e.g. the upload has not been stored by package_update
+                raise Exception('The file {} has not been uploaded by the package update of dataset {}'.format(
+                    filename, dataset['name']))
+            resources.append(resource)
+        return resources
+
+    def _open_file_to_import(self, harvest_object_data):
+        """
+        Open the file of a harvest object: the fetched local file, or the remote file when streaming
 
-        if self.config['date_pattern']:
-            ordered_resources.sort(key=lambda r: re.search(self.config['date_pattern'], r['identifier']).group(),
-                                   reverse=True)
-        else:
-            ordered_resources.sort(key=lambda r: r['identifier'], reverse=True)
+        :param harvest_object_data: The content of the harvest object
+        :type harvest_object_data: dict
+
+        :returns: The file to import, the storage connection is released when it is closed
+        :rtype: StreamingFile
+        """
+        f = harvest_object_data['file']
+        if not harvest_object_data.get('stream'):
+            return StreamingFile(open(f, 'rb'), os.path.getsize(f))
+
+        storage = StorageAdapterFactory(ckanconf).get_storage_adapter(harvest_object_data['remotefolder'], self.config)
+        storage.__enter__()
+        try:
+            import_file = storage.open_remote_file(os.path.basename(f))
+        except Exception:
+            storage.__exit__(*sys.exc_info())
+            raise
+        import_file.on_close(lambda: storage.__exit__(None, None, None))
+        return import_file
 
-        return ordered_resources, unmatched_resources
+    def _set_resource_hash(self, resource_id, resource_hash):
+        """
+        Store the hash of an uploaded resource, without updating the whole package again
+
+        :param resource_id: Id of the resource
+        :type resource_id: str
+        :param resource_hash: Hash of the uploaded file
+        :type resource_hash: str
+        """
+        resource = model.Resource.get(resource_id)
+        resource.hash = resource_hash
+        model.repo.commit()
+
+    def _get_ordered_resources(self, package):
+        # get filename regex for permalink from harvester config or fallback to a catch-all
+        ordering = get_resource_ordering(self.config['resource_regex'], self.config['date_pattern'])
+        return ordering.order(package['resources'])
 
     def finalize(self, harvest_object, harvest_object_data):
         context = {'model': model, 'session': Session, 'user': self._get_user_name()}
 
         log.info('Running finalizing tasks:')
+
+        if self.config['grouped_import']:
+            self._import_grouped_files(harvest_object, harvest_object_data['dataset'])
         # ----------------------------------------------------------------------------
         # Deleting old resources, generate permalink, order resources:
         # We do this by matching a regex, defined in the `resource_regex` key of the harvester json config,
@@ -928,15 +1631,18 @@ class BaseSBBHarvester(HarvesterBase):
         max_resources = self.config.get('max_resources')
         resources_count = len(ordered_resources)
 
+        deleted_resources = []
         if max_resources and resources_count > max_resources:
             log.info('Found %s Resources, max resources is %s, deleting %s resources', resources_count, max_resources,
                      resources_count - max_resources)
 
-            for resource in ordered_resources[max_resources:]:
-                self._delete_version(context, package['id'], resource_filename(resource['url']))
-
+            deleted_resources = ordered_resources[max_resources:]
             ordered_resources = ordered_resources[:max_resources]
 
+            # delete the datastore tables while the resources still exist
+            for resource in deleted_resources:
+                self._delete_datastore(context, resource['id'])
+
         # set permalink on dataset
         if ordered_resources:
             permalink = ordered_resources[0]['url']
@@ -944,16 +1650,16 @@ class BaseSBBHarvester(HarvesterBase):
         else:
             permalink = None
 
+        # ----------------------------------------------------------------------------
+        # apply the permalink, the order and the deletions with a single package update and commit
         now = datetime.now().isoformat()
-        get_action('package_patch')(context, {'id': package['id'], 'permalink': permalink,
-                                              'modified': now, 'metadata_modified': now})
+        package['permalink'] = permalink
+        package['modified'] = now
+        package['metadata_modified'] = now
+        # not matched resources come first in the list, then the ordered, the deleted ones are left out
+        package['resources'] = unmatched_resources + ordered_resources
 
-        # reorder resources
-        # not matched resources come first in the list, then the ordered
-        get_action('package_resource_reorder')(context, {
-            'id': package['id'],
-            'order': map(lambda r: r['id'], unmatched_resources + ordered_resources)
-        })
+        get_action('package_update')(dict(context, defer_commit=True), package)
 
         from ckanext.harvest.model import harvest_object_table
         conn = Session.connection()
@@ -964,7 +1670,6 @@ class BaseSBBHarvester(HarvesterBase):
 
         harvest_object.package_id = package['id']
         harvest_object.current = True
-        harvest_object.save()
 
         # Defer constraints and flush so the dataset can be indexed with
         # the harvest object id (on the after_show hook from the harvester
@@ -973,53 +1678,95 @@ class BaseSBBHarvester(HarvesterBase):
 
         model.Session.execute('SET CONSTRAINTS harvest_object_package_id_fkey DEFERRED')
         model.Session.flush()
+        model.repo.commit()
 
-        search.rebuild(package['id'])
+        # the files of the deleted resources and of all their old revisions are removed once the update is committed
+        versions = self._get_resource_versions(package['id'])
+        if deleted_resources:
+            self._delete_version_files(versions, set(resource_filename(r['url']) for r in deleted_resources))
 
         # ----------------------------------------------------------------------------
         # delete files of old revisions if there are more than 30 revisions
-        self._cleanup_revisions(package['id'])
+        self._cleanup_revisions(versions)
+
+        # ----------------------------------------------------------------------------
+        # index the dataset once, with all the changes of the harvest job (see deferred_indexing)
+        search.rebuild(package['id'])
+
+        # ----------------------------------------------------------------------------
+        # store the harvest state of the imported files, with the resources remaining after the cleanup
+        self._save_file_states(harvest_object, harvest_object_data['dataset'], package['id'])
+
+        counters = harvest_logging.pop_counters(harvest_object.job_id, harvest_object_data['dataset'])
+        counters['resources_deleted'] += len(deleted_resources)
+        # the counters only cover the objects processed by this process
+        log.info('Harvested dataset %s (objects of this process): %s', package['name'],
+                 ', '.join('%s=%s' % (name, counters[name]) for name in sorted(counters)))
+
+    def _rebuild_search_index(self, dataset_identifier):
+        """
+        Index a dataset with the changes committed so far, after the import of a file or the finalizer failed
+        """
+        Session.rollback()
+        try:
+            search.rebuild(self._get_dataset(dataset_identifier)['id'])
+        except NotFound:
+            pass  # the dataset has not been created
+        except Exception:
+            log.exception('Could not index dataset %s', dataset_identifier)
+
+    def _get_resource_versions(self, package_id):
+        """
+        Index of the revisions of the resources of a dataset, built with one query
 
-    def _delete_version(self, context, package_id, filename):
+        :returns: The (id, created) of the current and old revisions by filename, the newest first
+        :rtype: dict
+        """
+        versions = defaultdict(list)
+        rows = Session.query(model.Resource.id, model.Resource.url, model.Resource.created) \
+            .filter(model.Resource.package_id == package_id)
+        for resource_id, url, created in rows:
+            versions[resource_filename(url)].append((resource_id, created))
+        for revisions in versions.itervalues():
+            revisions.sort(key=itemgetter(1), reverse=True)
+        return versions
+
+    def _delete_resource_files(self, resource_ids):
         """
-        delete the current and all old revisions of a resource with the given filename
+        Delete the uploaded files of the given resources from the filestore, or only mark them for the
+        gc_filestore command with the defer_file_cleanup option
         """
-        package = model.Package.get(package_id)
+        if self.config['defer_file_cleanup']:
+            marked = filestore_gc.mark(resource_ids)
+            if marked:
+                log.info('Marked %d files for removal from the filestore', marked)
+            return
 
-        for resource in package.resources_all:
-            if resource_filename(resource.url) == filename:
-                # delete the file from the filestore
-                resource_dict = resource_dictize(resource, {'model': model})
-                path = uploader.ResourceUpload(resource_dict).get_path(resource.id)
-                if os.path.exists(path):
-                    os.remove(path)
+        deleted = filestore_gc.delete_files(resource_ids)
+        if deleted:
+            log.info('Deleted %d files from the filestore', deleted)
 
-                # delete the datastore table
-                try:
-                    get_action('datastore_delete')(context, {'resource_id': resource.id, 'force': True})
-                except NotFound:
-                    pass  # Sometimes importing the data into the datastore fails
+    def _delete_version_files(self, versions, filenames):
+        """
+        Delete the files of the current and all the old revisions of the resources with the given filenames
+        from the filestore
 
-                # delete the resource itself
-                get_action('resource_delete')(context, {'id': resource.id})
+        :param versions: The index of the revisions, see _get_resource_versions
+        :type versions: dict
+        """
+        self._delete_resource_files(
+            resource_id for filename in filenames for resource_id, _ in versions.get(filename, []))
+
+    def _cleanup_revisions(self, versions):
+        """
+        Delete the files of the revisions exceeding max_revisions from the filestore
 
-    def _cleanup_revisions(self, package_id):
+        :param versions: The index of the revisions, see _get_resource_versions
+        :type versions: dict
+        """
         max_revisions = self.config.get('max_revisions')
         if not max_revisions:
             return
 
-        # group resources (=old revisions) by filename
-        versions = defaultdict(lambda: [])
-        package = model.Package.get(package_id)
-        for resource in package.resources_all:
-            filename = resource_filename(resource.url)
-            versions[filename].append(resource)
-
-        for filename, resources in versions.iteritems():
-            if len(resources) > max_revisions:
-                resources = sorted(resources, key=lambda r: r.created, reverse=True)
-                for resource in resources[max_revisions:]:
-                    resource_dict = resource_dictize(resource, {'model': model})
-                    path = uploader.ResourceUpload(resource_dict).get_path(resource.id)
-                    if os.path.exists(path):
-                        os.remove(path)
+        self._delete_resource_files(
+            resource_id for revisions in versions.itervalues() for resource_id, _ in revisions[max_revisions:])
@@ -3,8 +3,9 @@ class ConfigKey():
     type = str
     is_mandatory = False
     custom_error_message = None
+    default_value = None
 
-    def __init__(self, name, type = str, is_mandatory = False, is_valid_func = None, custom_error_message = None ):
+    def __init__(self, name, type = str, is_mandatory = False, is_valid_func = None, custom_error_message = None, default_value = None):
         self.name = name
 
         if type != str:
@@ -19,6 +20,25 @@ class ConfigKey():
         if is_valid_func is not None:
             self.is_valid = is_valid_func
 
+        if default_value is not None:
+            self.default_value = default_value
+
     def is_valid(self, value):
         return True
 
+
+def to_bool(value):
+    """
+    Convert a value of the configuration file to a bool, as type of a ConfigKey
+
+    :param value: The raw value, e.g. 'true', 'False', '0'
+    :type value: str
+
+    :returns: The boolean
+    :rtype: bool
+    """
+    if value.strip().lower() in ('true', 'yes', 'on', '1'):
+        return True
+    if value.strip().lower() in ('false', 'no', 'off', '0'):
+        return False
+    raise ValueError('Not a boolean: %s' % value)
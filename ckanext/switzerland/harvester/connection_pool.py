@@ -0,0 +1,138 @@
+"""
+Connection Pool
+===============
+
+Process-wide pool of idle storage connections.
+Connections are grouped by a key (the resolved storage configuration), so that all the StorageAdapters
+of the same process connecting to the same server can reuse each other's connections, e.g.
+`
+    connection = connection_pool.acquire(key, open_connection, is_alive, close_connection, 60)
+    ...
+    connection_pool.release(key, connection, close_connection, 4)
+`
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """ Pool of idle connections, safe to be used from multiple threads """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> list of (connection, close function, time of release), the most recently released last
+        self._idle = defaultdict(list)
+
+    def acquire(self, key, connect, is_alive, close, max_idle_time):
+        """
+        Take an idle connection out of the pool, or open a new one if there is none left.
+        Connections which have been idle for too long or which are not alive anymore are closed and discarded.
+
+        :param key: Identifies the server the connection belongs to
+        :type key: hashable
+        :param connect: Function opening a new connection
+        :type connect: function
+        :param is_alive: Function checking if a connection is still usable
+        :type is_alive: function
+        :param close: Function closing a connection
+        :type close: function
+        :param max_idle_time: Number of seconds a connection can stay idle in the pool before being discarded
+        :type max_idle_time: int
+
+        :returns: A connection
+        """
+        while True:
+            with self._lock:
+                entry = self._idle[key].pop() if self._idle[key] else None
+            if entry is None:
+                log.debug('No idle connection in the pool, opening a new one')
+                return connect()
+
+            connection, _, released_at = entry
+            if time.time() - released_at > max_idle_time:
+                log.debug('Discarding connection idle since %.1f seconds' % (time.time() - released_at))
+                self._close(connection, close)
+            elif not is_alive(connection):
+                log.debug('Discarding dead connection')
+                self._close(connection, close)
+            else:
+                return connection
+
+    def release(self, key, connection, close, max_size, max_idle_time=None):
+        """
+        Give a connection back to the pool.
+        If there are already max_size idle connections for this key, the connection is closed instead.
+
+        :param key: Identifies the server the connection belongs to
+        :type key: hashable
+        :param connection: The connection to give back
+        :param close: Function closing the connection
+        :type close: function
+        :param max_size: Maximum number of idle connections kept for this key
+        :type max_size: int
+        :param max_idle_time: If set, the idle connections of this key older than this number of seconds are closed
+        :type max_idle_time: int
+
+        :returns: None
+        :rtype: None
+        """
+        if connection is None:
+            return
+
+        now = time.time()
+        with self._lock:
+            idle = self._idle[key]
+            expired = []
+            if max_idle_time is not None:
+                expired = [entry for entry in idle if now - entry[2] > max_idle_time]
+                idle[:] = [entry for entry in idle if now - entry[2] <= max_idle_time]
+            if len(idle) < max_size:
+                idle.append((connection, close, now))
+                connection = None
+
+        for expired_connection, expired_close, _ in expired:
+            self._close(expired_connection, expired_close)
+        if connection is not None:
+            self._close(connection, close)
+
+    def clear(self):
+        """
+        Close all the idle connections of the pool
+
+        :returns: None
+        :rtype: None
+        """
+        with self._lock:
+            entries = [entry for idle in self._idle.values() for entry in idle]
+            self._idle.clear()
+
+        for connection, close, _ in entries:
+            self._close(connection, close)
+
+    def size(self, key):
+        """
+        Number of idle connections in the pool for a key
+
+        :param key: Identifies the server the connections belong to
+        :type key: hashable
+
+        :returns: Number of idle connections
+        :rtype: int
+        """
+        with self._lock:
+            return len(self._idle.get(key, []))
+
+    def _close(self, connection, close):
+        try:
+            close(connection)
+        except Exception as e:
+            # the connection is discarded anyway
+            log.debug('Error while closing a pooled connection: %s' % e)
+
+
+# shared by all the StorageAdapters of the process
+connection_pool = ConnectionPool()
@@ -0,0 +1,235 @@
+"""
+Filestore GC
+============
+
+Removal of the uploaded files of the harvested resource revisions which are not needed anymore
+(the revisions beyond max_revisions and the resources deleted because of max_resources).
+With the `defer_file_cleanup` option, the finalizer of the harvester only marks the resources, e.g.
+`
+    mark(resource_ids)
+`
+and the files are removed later in batches by the `paster ogdch gc_filestore` command, which calls
+`
+    collect(batch_size=100, rate_limit=50)
+`
+The marks are kept once the files are removed, so a revision is marked only once and an interrupted
+collection resumes with the files not removed yet.
+
+The files which were never marked (e.g. left by the revisions removed before `defer_file_cleanup`, or by resources
+deleted outside of the harvesters) are found by scanning the filestore, `paster ogdch gc_filestore --scan` calls
+`
+    scan(batch_size=100, rate_limit=50)
+`
+The table is created by the command `paster ogdch initdb`.
+"""
+import errno
+import logging
+import os
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import types, Column, Table
+
+from ckan import model
+from ckan.lib import uploader
+from ckan.model import meta, Session
+
+log = logging.getLogger(__name__)
+
+MARK_QUERY_SIZE = 1000
+# the files modified more recently are not removed by scan, their resource might not be committed yet
+SCAN_MIN_AGE = 3600
+
+filestore_gc_table = Table(
+    'ogdch_filestore_gc', meta.metadata,
+    Column('resource_id', types.UnicodeText, primary_key=True),
+    Column('marked', types.DateTime, default=datetime.utcnow),
+    Column('collected', types.DateTime, index=True),
+)
+
+
+def setup():
+    """
+    Create the table if it does not exist yet. Called by the command `paster ogdch initdb` only.
+    """
+    if not filestore_gc_table.exists(bind=meta.engine):
+        filestore_gc_table.create(bind=meta.engine)
+        log.info('Created table %s' % filestore_gc_table.name)
+
+
+def delete_files(resource_ids):
+    """
+    Delete the uploaded files of the given resources from the filestore, the missing ones are skipped
+
+    :param resource_ids: Ids of the resources
+    :type resource_ids: iterable of str
+
+    :returns: The number of deleted files
+    :rtype: int
+    """
+    # the path only depends on the id of the resource, one uploader serves all of them
+    upload = uploader.ResourceUpload({})
+    deleted = 0
+    for resource_id in resource_ids:
+        try:
+            os.remove(upload.get_path(resource_id))
+            deleted += 1
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return deleted
+
+
+def mark(resource_ids):
+    """
+    Mark the files of the given resources for removal, the resources which are already marked are skipped
+
+    :param resource_ids: Ids of the resources
+    :type resource_ids: iterable of str
+
+    :returns: The number of newly marked resources
+    :rtype: int
+    """
+    resource_ids = list(set(resource_ids))
+    if not resource_ids:
+        return 0
+
+    marked = set()
+    for i in range(0, len(resource_ids), MARK_QUERY_SIZE):
+        query = Session.query(filestore_gc_table.c.resource_id) \
+            .filter(filestore_gc_table.c.resource_id.in_(resource_ids[i:i + MARK_QUERY_SIZE]))
+        marked.update(row.resource_id for row in query)
+
+    now = datetime.utcnow()
+    new_marks = [{'resource_id': resource_id, 'marked': now} for resource_id in resource_ids
+                 if resource_id not in marked]
+    if new_marks:
+        Session.execute(filestore_gc_table.insert(), new_marks)
+        Session.commit()
+    return len(new_marks)
+
+
+def collect(batch_size=100, rate_limit=None, dryrun=False):
+    """
+    Remove the files of the marked resources, one batch after the other. Every batch is committed,
+    so the collection can be interrupted and resumed. The files of the active resources are never removed.
+
+    :param batch_size: Number of files removed per batch
+    :type batch_size: int
+    :param rate_limit: Maximal number of files removed per second, None for no limit
+    :type rate_limit: float
+    :param dryrun: Only count the marked files, without removing them
+    :type dryrun: bool
+
+    :returns: The number of marked resources processed and of files removed
+    :rtype: tuple
+    """
+    pending = Session.query(filestore_gc_table.c.resource_id, model.Resource.state) \
+        .outerjoin(model.Resource, model.Resource.id == filestore_gc_table.c.resource_id) \
+        .filter(filestore_gc_table.c.collected.is_(None)) \
+        .order_by(filestore_gc_table.c.marked, filestore_gc_table.c.resource_id)
+    if dryrun:
+        return pending.count(), 0
+
+    processed = 0
+    deleted = 0
+    while True:
+        start = time.time()
+        batch = pending.limit(batch_size).all()
+        if not batch:
+            break
+
+        deleted += delete_files(row.resource_id for row in batch if row.state != 'active')
+        Session.execute(
+            filestore_gc_table.update()
+            .where(filestore_gc_table.c.resource_id.in_([row.resource_id for row in batch]))
+            .values(collected=datetime.utcnow())
+        )
+        Session.commit()
+        processed += len(batch)
+        log.info('Processed %d marked resources, removed %d files', processed, deleted)
+
+        if rate_limit:
+            time.sleep(max(0, len(batch) / float(rate_limit) - (time.time() - start)))
+
+    return processed, deleted
+
+
+def scan(batch_size=100, rate_limit=None, dryrun=False, min_age=SCAN_MIN_AGE):
+    """
+    Remove the files of the filestore whose resource does not exist or is not active, marked or not.
+    The filestore is scanned in batches of files, the resources of a batch are looked up in one query.
+
+    :param batch_size: Number of files checked per batch
+    :type batch_size: int
+    :param rate_limit: Maximal number of files removed per second, None for no limit
+    :type rate_limit: float
+    :param dryrun: Only count the files to remove, without removing them
+    :type dryrun: bool
+    :param min_age: Number of seconds since the last modification of a file before it can be removed
+    :type min_age: int
+
+    :returns: The number of files scanned and of files removed (to remove with dryrun)
+    :rtype: tuple
+    """
+    storage_path = uploader.ResourceUpload({}).storage_path
+    if not storage_path:
+        log.warning('No ckan.storage_path configured, there is no filestore to scan')
+        return 0, 0
+
+    scanned = 0
+    removed = 0
+    files = iter_filestore(storage_path)
+    while True:
+        start = time.time()
+        batch = list(islice(files, batch_size))
+        if not batch:
+            break
+        scanned += len(batch)
+
+        active = set(row.id for row in Session.query(model.Resource.id).filter(
+            model.Resource.id.in_([resource_id for resource_id, _ in batch]), model.Resource.state == 'active'))
+        max_modified = time.time() - min_age
+        orphans = [path for resource_id, path in batch
+                   if resource_id not in active and os.path.getmtime(path) < max_modified]
+        Session.remove()  # no transaction is kept open while the files are removed
+        if not dryrun:
+            for path in orphans:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        removed += len(orphans)
+        log.info('Scanned %d files of the filestore, %s %d files', scanned,
+                 'found to remove' if dryrun else 'removed', removed)
+
+        if rate_limit and orphans and not dryrun:
+            time.sleep(max(0, len(orphans) / float(rate_limit) - (time.time() - start)))
+
+    return scanned, removed
+
+
+def iter_filestore(storage_path):
+    """
+    Iterate over the files of the filestore, stored by ckan as <storage_path>/<id[0:3]>/<id[3:6]>/<id[6:]>
+
+    :param storage_path: The resources folder of the filestore
+    :type storage_path: str
+
+    :returns: The id of the resource and the path of every file
+    :rtype: generator of tuple
+    """
+    for first in sorted(os.listdir(storage_path)):
+        first_path = os.path.join(storage_path, first)
+        if len(first) != 3 or not os.path.isdir(first_path):
+            continue
+        for second in sorted(os.listdir(first_path)):
+            second_path = os.path.join(first_path, second)
+            if len(second) != 3 or not os.path.isdir(second_path):
+                continue
+            for name in sorted(os.listdir(second_path)):
+                path = os.path.join(second_path, name)
+                if os.path.isfile(path):
+                    yield first + second + name, path
@@ -15,14 +15,18 @@ import logging
 from pprint import pformat
 
 import os
+import stat
 
 from config.config_key import ConfigKey
-from storage_adapter_base import StorageAdapterBase
+from storage_adapter_base import StorageAdapterBase, RemoteFile, DOWNLOAD_CHUNK_SIZE
+from streaming_file import StreamingFile
 from exceptions.storage_adapter_configuration_exception import StorageAdapterConfigurationException
 
 import pysftp
 import ftplib
+import calendar
 import datetime
+import shutil
 import ssl
 
 from keys import (
@@ -33,7 +37,9 @@ from keys import (
     FTP_PORT, 
     FTP_SERVER_KEY,
     LOCAL_PATH, 
-    REMOTE_DIRECTORY
+    REMOTE_DIRECTORY,
+    POOL_SIZE,
+    POOL_MAX_IDLE_TIME
 )
 
 log = logging.getLogger(__name__)
@@ -46,13 +52,19 @@ CONFIG_KEYS = [
     ConfigKey(FTP_PORT, int, True, lambda x: x > 0, 'Port should be a positive number'),
     ConfigKey(LOCAL_PATH, str, True),
     ConfigKey(REMOTE_DIRECTORY, str, True),
+    ConfigKey(POOL_SIZE, int, False, lambda x: x >= 0, 'Pool size should be zero or a positive number', 0),
+    ConfigKey(POOL_MAX_IDLE_TIME, int, False, lambda x: x > 0, 'Pool max idle time should be a positive number', 60),
 ]
 class FTPStorageAdapter(StorageAdapterBase):
     """ FTP Storage Adapter Class """
 
     ftps = None
     sftp = None
+    # set when the control connection cannot be reused, e.g. after an aborted transfer, see _disconnect
+    _discard_connection = False
     tmpfile_extension = '.TMP'
+    # FTP commands to get the hash of a file, by order of preference
+    hash_commands = ['HASH', 'XCRC']
 
     # tested
     def __init__(self, config_resolver, config, remote_folder=''):
@@ -64,6 +76,8 @@ class FTPStorageAdapter(StorageAdapterBase):
             CONFIG_KEYS, 
             'ckan.ftp'
         )
+        # the commands not supported by the server are removed
+        self._hash_commands = list(self.hash_commands)
 
     # tested
     def __enter__(self):
@@ -99,52 +113,111 @@ class FTPStorageAdapter(StorageAdapterBase):
     # tested
     def _connect(self):
         """
-        Establish an FTP connection
+        Establish an FTP connection, or reuse an idle one from the connection pool
         ftps - to connect to FTP Server using password
         sftp - to connect to SFTP Server using keyfile/password
         :returns: None
         :rtype: None
         """
+        connection = self._acquire_connection()
+        if self._is_sftp():
+            self.sftp = connection
+        else:
+            self.ftps = connection
+
+    # tested
+    def _disconnect(self):
+        """
+        Close ftp connection, or give it back to the connection pool
+
+        :returns: None
+        :rtype: None
+        """
+        connection = self.ftps or self.sftp
+        self.ftps = None
+        self.sftp = None
+        if connection:
+            if self._discard_connection:
+                self._discard_connection = False
+                # no QUIT, the server might still answer a previous command
+                connection.close()
+            else:
+                self._release_connection(connection)
 
+    def _is_sftp(self):
+        """
+        Check if the server is accessed via SFTP (port 22 or keyfile) rather than FTPS
+
+        :returns: True for SFTP
+        :rtype: bool
+        """
+        return not self._config[FTP_PASSWORD] or int(self._config[FTP_PORT]) == 22
+
+    def _open_connection(self):
+        """
+        Open a new FTPS or SFTP connection
+
+        :returns: The connection, None if neither a password nor a keyfile is configured
+        :rtype: ftplib.FTP_TLS or pysftp.Connection
+        """
         if self._config[FTP_PASSWORD]:
             # connect
             # check SFTP protocol is used, pysftp defaults to 22
             if int(self._config[FTP_PORT]) == 22:
-                self.sftp = pysftp.Connection(host=self._config[FTP_HOST],
-                                              username=self._config[FTP_USER_NAME],
-                                              password=self._config[FTP_PASSWORD],
-                                              port=int(self._config[FTP_PORT]),
-                                              )
+                return pysftp.Connection(host=self._config[FTP_HOST],
+                                         username=self._config[FTP_USER_NAME],
+                                         password=self._config[FTP_PASSWORD],
+                                         port=int(self._config[FTP_PORT]),
+                                         )
             else:
                 # overwrite the default port (21)
                 ftplib.FTP.port = int(self._config[FTP_PORT])
                 # we need to set the TLS version explicitly to allow connection
                 # to newer servers who have disabled older TLS versions (< TLSv1.2)
                 ftplib.FTP_TLS.ssl_version = ssl.PROTOCOL_TLSv1_2
-                self.ftps = ftplib.FTP_TLS(self._config[FTP_HOST],
-                                           self._config[FTP_USER_NAME],
-                                           self._config[FTP_PASSWORD])
+                ftps = ftplib.FTP_TLS(self._config[FTP_HOST],
+                                      self._config[FTP_USER_NAME],
+                                      self._config[FTP_PASSWORD])
                 # switch to secure data connection
-                self.ftps.prot_p()
+                ftps.prot_p()
+                return ftps
         elif self._config[FTP_KEY_FILE]:
             # connecting via SSH
-            self.sftp = pysftp.Connection(host=self._config[FTP_HOST],
-                                          username=self._config[FTP_USER_NAME],
-                                          private_key=self._config[FTP_KEY_FILE],
-                                          port=int(self._config[FTP_PORT]),
-                                          )
-    # tested
-    def _disconnect(self):
+            return pysftp.Connection(host=self._config[FTP_HOST],
+                                     username=self._config[FTP_USER_NAME],
+                                     private_key=self._config[FTP_KEY_FILE],
+                                     port=int(self._config[FTP_PORT]),
+                                     )
+        return None
+
+    def _is_connection_alive(self, connection):
         """
-        Close ftp connection
+        Check that a pooled connection is still usable: NOOP for FTPS, stat of the current directory for SFTP
+
+        :returns: True if the server answered
+        :rtype: bool
+        """
+        try:
+            if self._is_sftp():
+                connection.stat('.')
+            else:
+                connection.voidcmd('NOOP')
+        except Exception as e:
+            log.debug('Pooled connection is not alive anymore: %s' % e)
+            return False
+        return True
+
+    def _close_connection(self, connection):
+        """
+        Close an FTPS or SFTP connection
 
         :returns: None
         :rtype: None
         """
-        if self.ftps:
-            self.ftps.quit()  # '221 Goodbye.'
-        elif self.sftp:
-            self.sftp.close()
+        if self._is_sftp():
+            connection.close()
+        else:
+            connection.quit()  # '221 Goodbye.'
 
     # tested
     def cdremote(self, remotedir=None):
@@ -183,16 +256,74 @@ class FTPStorageAdapter(StorageAdapterBase):
             files_dirs = []
             self.ftps.retrlines(cmd, files_dirs.append)
             for file_dir in files_dirs:
-                data, filename = file_dir.split(' ', 1)
-                for kv in filter(lambda x: x, data.split(';')):
-                    key, value = kv.split('=')
-                    if key == 'type' and value == 'file':
-                        files.append(filename)
+                facts, filename = self._parse_mlsd_line(file_dir)
+                if facts.get('type') == 'file':
+                    files.append(filename)
         elif self.sftp:
             files = self.sftp.listdir(self.remote_folder)
 
         return files
 
+    def _parse_mlsd_line(self, line):
+        """
+        Parse a line of a MLSD listing
+
+        :param line: MLSD line, e.g. 'type=file;size=1024;modify=20160621123722; file.txt'
+        :type line: str or unicode
+
+        :returns: The facts (with lower case names) and the filename
+        :rtype: tuple
+        """
+        data, filename = line.split(' ', 1)
+        facts = {}
+        for kv in filter(lambda x: x, data.split(';')):
+            key, value = kv.split('=', 1)
+            facts[key.lower()] = value
+        return facts, filename
+
+    def iter_remote_files(self, folder=None):
+        """
+        Iterate over the files in the current directory, including their size and modified date.
+        The metadata is taken from the MLSD facts (FTPS) or the file attributes (SFTP)
+        of the listing, so no additional request per file is needed.
+
+        :param folder: Full path on the remote server
+        :type folder: str or unicode
+
+        :returns: Generator of the files in the directory
+        :rtype: generator of RemoteFile
+        """
+        if self.ftps:
+            cmd = 'MLSD'
+            if folder:
+                cmd += ' ' + folder
+
+            files_dirs = []
+            self.ftps.retrlines(cmd, files_dirs.append)
+            for file_dir in files_dirs:
+                facts, filename = self._parse_mlsd_line(file_dir)
+                if facts.get('type') != 'file':
+                    continue
+
+                modified_date = None
+                if 'modify' in facts:
+                    # example: '20160621123722' or '20160621123722.123'
+                    modified_date = datetime.datetime.strptime(facts['modify'][:14], '%Y%m%d%H%M%S')
+                size = int(facts['size']) if 'size' in facts else None
+
+                yield RemoteFile(filename, size, None, modified_date)
+        elif self.sftp:
+            for attributes in self.sftp.listdir_attr(folder or self.remote_folder):
+                if not stat.S_ISREG(attributes.st_mode):
+                    continue
+
+                yield RemoteFile(
+                    attributes.filename,
+                    attributes.st_size,
+                    None,
+                    datetime.datetime.fromtimestamp(attributes.st_mtime)
+                )
+
     # tested
     def get_remote_dirlist(self, folder=None):
         """
@@ -252,6 +383,39 @@ class FTPStorageAdapter(StorageAdapterBase):
         dirs.sort()
         return dirs
 
+    def get_remote_file_hash(self, remote_file):
+        """
+        Get a hash of the content of a remote file, with the HASH command or, if the server does not support it,
+        with the XCRC command. SFTP servers cannot provide a hash.
+
+        :param remote_file: The file, as returned by iter_remote_files
+        :type remote_file: RemoteFile
+
+        :returns: The hash prefixed with the name of the algorithm, e.g. 'sha-256:169cd2...', None if not supported
+        :rtype: str
+        """
+        if not self.ftps:
+            return None
+
+        for command in self._hash_commands[:]:
+            try:
+                ret = self.ftps.sendcmd('%s %s' % (command, remote_file.name))
+            except ftplib.error_perm as e:
+                # 500/502/504: the command is not supported, do not try it again for the next files
+                if str(e)[:3] in ('500', '502', '504'):
+                    self._hash_commands.remove(command)
+                    continue
+                raise
+
+            if command == 'HASH':
+                # example: '213 SHA-256 0-49 169cd22282da7f147cb491e559e9dd filename'
+                parts = ret.split(' ', 4)
+                return '%s:%s' % (parts[1].lower(), parts[3].lower())
+            # example: '250 B0B45BE4'
+            return 'crc32:%s' % ret.split(' ')[1].strip().lower()
+
+        return None
+
     def get_modified_date(self, filename, folder=None):
         """
         Get the last modified date of a remote file
@@ -293,7 +457,10 @@ class FTPStorageAdapter(StorageAdapterBase):
     # tested
     def fetch(self, filename, localpath=None):
         """
-        Fetch a single file from the remote server with ftplib and pysftp
+        Fetch a single file from the remote server with ftplib and pysftp.
+        A partial download of a previous attempt is continued: with REST for FTPS, by seeking in the remote file
+        for SFTP.
+        It is only continued if the remote file has not changed since, see _get_resume_offset.
 
         :param filename: File to fetch
         :type filename: str or unicode
@@ -306,19 +473,122 @@ class FTPStorageAdapter(StorageAdapterBase):
         if not localpath:
             localpath = os.path.join(self._config[LOCAL_PATH], filename)
 
-        localfile = open(localpath, 'wb')
+        partpath, offset = self._get_partial_download(localpath)
+        offset = self._get_resume_offset(filename, partpath, offset)
 
         if self.ftps:
-            status = self.ftps.retrbinary('RETR %s' % filename, localfile.write)
-            localfile.close()
+            try:
+                status = self._retrbinary(filename, partpath, offset)
+            except ftplib.error_perm:
+                if not offset:
+                    raise
+                # the server might not support REST, try again from the beginning
+                log.info('Could not continue download of %s, downloading it again' % filename)
+                status = self._retrbinary(filename, partpath, 0)
         elif self.sftp:
-            status = self.sftp.get(filename, localpath=localpath)
+            remotefile = self.sftp.open(filename, 'rb')
+            try:
+                remotefile.seek(offset)
+                # read ahead asynchronously, starting at the offset
+                remotefile.prefetch()
+                with open(partpath, 'ab' if offset else 'wb') as localfile:
+                    shutil.copyfileobj(remotefile, localfile, DOWNLOAD_CHUNK_SIZE)
+            finally:
+                remotefile.close()
+            status = "226 Transfer complete"
+
+        self._complete_partial_download(partpath, localpath)
+
+        return status
 
-            if status == None:
-                status = "226 Transfer complete"
+    def _get_resume_offset(self, filename, partpath, offset):
+        """
+        Check that a partial download can be continued: the remote file must not have been modified since the
+        partial download was last written (MDTM for FTPS, stat for SFTP), and must not be smaller than it
+
+        :param filename: File to fetch
+        :type filename: str or unicode
+        :param partpath: Path of the partial download
+        :type partpath: str
+        :param offset: Size of the partial download
+        :type offset: int
+
+        :returns: The offset to continue the download at, 0 to download the file again
+        :rtype: int
+        """
+        if not offset:
+            return 0
+
+        try:
+            if self.ftps:
+                self.ftps.voidcmd('TYPE I')
+                size = self.ftps.size(filename)
+                # example: '213 20160621123722' (UTC), some servers append milliseconds
+                modified_date = self.ftps.sendcmd('MDTM %s' % filename).split(' ')[1][:14]
+                modified = calendar.timegm(datetime.datetime.strptime(modified_date, '%Y%m%d%H%M%S').timetuple())
             else:
-                # something went wrong with copies a file between the remote host and the local host
-                raise
+                attributes = self.sftp.stat(filename)
+                size, modified = attributes.st_size, attributes.st_mtime
+        except (ftplib.all_errors + (ValueError, IndexError)) as e:
+            log.info('Could not check the remote file %s (%s), downloading it again' % (filename, e))
+            return 0
+
+        if size is None or size < offset:
+            log.info('Remote file %s is smaller than its partial download, downloading it again' % filename)
+            return 0
+        if modified is None or modified > os.path.getmtime(partpath):
+            log.info('Remote file %s changed since its partial download, downloading it again' % filename)
+            return 0
+        return offset
+
+    def open_remote_file(self, filename):
+        """
+        Open a file of the remote server for reading, without storing it on the local disk
 
-        return status
+        :param filename: File to open
+        :type filename: str or unicode
+
+        :returns: The remote file
+        :rtype: StreamingFile
+        """
+        if self.sftp:
+            remotefile = self.sftp.open(filename, 'rb')
+            remotefile.prefetch()
+            return StreamingFile(remotefile, remotefile.stat().st_size)
+
+        self.ftps.voidcmd('TYPE I')
+        size = self.ftps.size(filename)
+        connection = self.ftps.transfercmd('RETR %s' % filename)
+        remotefile = StreamingFile(connection.makefile('rb'), size)
+
+        def close_transfer():
+            if size is not None and remotefile.bytes_read < size:
+                # closed before the end of the file: the reply of the server to the RETR (e.g. '426 Transfer
+                # aborted') is still pending on the control connection, which cannot be given to the pool
+                log.warning('Transfer of %s aborted after %d of %d bytes' % (filename, remotefile.bytes_read, size))
+                self._discard_connection = True
+                connection.close()
+                return
+            try:
+                # same as the end of ftplib's retrbinary
+                if isinstance(connection, ssl.SSLSocket):
+                    connection.unwrap()
+                connection.close()
+                self.ftps.voidresp()  # '226 Transfer complete'
+            except ftplib.all_errors as e:
+                log.warning('Transfer of %s not completed: %s' % (filename, e))
+                self._discard_connection = True
+
+        remotefile.on_close(close_transfer)
+        return remotefile
+
+    def _retrbinary(self, filename, partpath, offset):
+        """
+        Download a file with FTPS, appending to the partial download from the given offset
+
+        :returns: Status of the FTP operation
+        :rtype: string
+        """
+        with open(partpath, 'ab' if offset else 'wb') as localfile:
+            return self.ftps.retrbinary('RETR %s' % filename, localfile.write, rest=offset or None)
 
@@ -0,0 +1,228 @@
+"""
+Harvest Logging
+===============
+
+Logging of the harvest jobs into a log file per job (and stdout), installed once per job, e.g.
+`
+    setup_job_logging(harvest_job.id, '/etc/ckan/harvester_logs/source/2016-09-01_12-00-00.log')
+`
+is called at the start of every stage, but only the first call of a job changes the loggers:
+- the `ckan*` loggers are set to DEBUG (INFO with the quiet log mode of the harvesters)
+- the handlers of the loggers which have some are replaced by one non-blocking handler, which puts the records
+  in a queue. A background thread writes them to the log file and to stdout.
+The later stages of the job (e.g. the fetch and import of every harvest object) reuse the handler, the log file
+and the listener thread. When the next job is set up (or the process exits), the levels and handlers of the loggers
+are restored.
+
+The stages also count what they did per job and dataset, e.g.
+`
+    count(harvest_job.id, dataset, files_fetched=1, bytes_fetched=size)
+`
+and the finalizer of the dataset logs the totals, see pop_counters. The counters are kept in the memory of the
+process: with several fetch and import consumers, the totals only cover the objects processed by the consumer of
+the finalizer.
+"""
+import atexit
+import copy
+import logging
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+from Queue import Queue
+
+log = logging.getLogger(__name__)
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handler putting the records in a queue, the formatting of the message is the only work done in the caller
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        # the message is formatted now, the arguments may change before the record is handled.
+        # the record is copied, the same record is passed to the handlers of the parent loggers too
+        msg = self.format(record)
+        record = copy.copy(record)
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    Background thread passing the records of a queue to the handlers
+    """
+
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name='harvest-logging')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """
+        Handle the records remaining in the queue, then stop the thread
+        """
+        if self._thread is not None:
+            self.queue.put_nowait(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
+class JobLogging(object):
+
+    def __init__(self, job_id, log_file, level=logging.DEBUG):
+        """
+        :param job_id: Id of the harvest job
+        :type job_id: str
+        :param log_file: Path of the log file of the job
+        :type log_file: str
+        :param level: Level of the ckan loggers during the job
+        :type level: int
+        """
+        self.job_id = job_id
+        self.log_file = log_file
+        self.level = level
+
+        file_handler = logging.FileHandler(log_file, 'a')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-5.5s [%(name)s] %(message)s'))
+        stdout_handler = logging.StreamHandler(stream=sys.stdout)
+        stdout_handler.setFormatter(logging.Formatter('[%(name)s] %(message)s'))
+        self._handlers = [file_handler, stdout_handler]
+
+        queue = Queue()  # not bounded, logging never blocks the harvester
+        self.handler = QueueHandler(queue)
+        self._listener = QueueListener(queue, *self._handlers)
+        self._previous_levels = {}
+        self._previous_handlers = {}
+
+    def install(self):
+        self._listener.start()
+        for name, logger in logging.Logger.manager.loggerDict.items():
+            if isinstance(logger, logging.Logger):
+                if name.startswith('ckan'):
+                    self._previous_levels[name] = logger.level
+                    logger.setLevel(self.level)
+                if logger.handlers:
+                    self._previous_handlers[name] = logger.handlers[:]
+                    logger.handlers = [self.handler]
+
+    def uninstall(self):
+        loggers = logging.Logger.manager.loggerDict
+        for name, level in self._previous_levels.items():
+            loggers[name].setLevel(level)
+        for name, handlers in self._previous_handlers.items():
+            loggers[name].handlers = handlers
+        self._previous_levels = {}
+        self._previous_handlers = {}
+
+        self._listener.stop()
+        for handler in self._handlers:
+            handler.close()
+
+
+_lock = threading.Lock()
+_job_logging = None
+
+
+def setup_job_logging(job_id, log_file, level=logging.DEBUG):
+    """
+    Install the logging of a harvest job, if it is not installed yet. The logging of the previous job is removed.
+
+    :param job_id: Id of the harvest job
+    :type job_id: str
+    :param log_file: Path of the log file of the job, its directory is created if needed
+    :type log_file: str
+    :param level: Level of the ckan loggers during the job
+    :type level: int
+
+    :rtype: JobLogging
+    """
+    global _job_logging
+    if _job_logging is not None and _job_logging.job_id == job_id:
+        return _job_logging
+
+    with _lock:
+        if _job_logging is not None:
+            if _job_logging.job_id == job_id:
+                return _job_logging
+            _job_logging.uninstall()
+            _job_logging = None
+
+        try:
+            os.makedirs(os.path.dirname(log_file))
+        except os.error:
+            pass  # directory already exists
+        job_logging = JobLogging(job_id, log_file, level)
+        job_logging.install()
+        _job_logging = job_logging
+        return job_logging
+
+
+def teardown_job_logging():
+    """
+    Remove the logging of the current harvest job, the records in the queue are written first
+    """
+    global _job_logging
+    with _lock:
+        if _job_logging is not None:
+            _job_logging.uninstall()
+            _job_logging = None
+
+
+atexit.register(teardown_job_logging)
+
+
+_counters_lock = threading.Lock()
+_counters = defaultdict(Counter)
+
+
+def count(job_id, dataset, **values):
+    """
+    Add values to the counters of a dataset in a harvest job
+
+    :param job_id: Id of the harvest job
+    :type job_id: str
+    :param dataset: Identifier of the dataset
+    :type dataset: str
+    """
+    with _counters_lock:
+        _counters[(job_id, dataset)].update(values)
+
+
+def pop_counters(job_id, dataset):
+    """
+    Get and reset the counters of a dataset in a harvest job, they only cover the objects processed by this process
+
+    :rtype: Counter
+    """
+    with _counters_lock:
+        return _counters.pop((job_id, dataset), Counter())
@@ -0,0 +1,130 @@
+"""
+Harvest State
+=============
+
+Persisted state of the remote files imported by a harvest source: the size, the content hash, the
+modification date and the resource of every file, as they were when the file was last imported.
+It is read in one query by the gather stage, to skip the files which did not change, e.g.
+`
+    file_states = get_file_states(harvest_job.source.id)
+    if is_unchanged(file_states.get(filename), remote_file.size, file_hash, remote_file.modified_date):
+        ...
+`
+and updated by the finalizer of the harvest job. Unlike the harvest jobs, the state is never cleaned up.
+The table is created (or upgraded) by the command `paster ogdch initdb`.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import types, Column, Table, inspect
+from sqlalchemy.orm import mapper
+
+from ckan.model import meta, Session, DomainObject
+
+log = logging.getLogger(__name__)
+
+harvest_file_state_table = Table(
+    'ogdch_harvest_file_state', meta.metadata,
+    Column('source_id', types.UnicodeText, primary_key=True),
+    Column('filename', types.UnicodeText, primary_key=True),
+    Column('size', types.BigInteger),
+    Column('hash', types.UnicodeText),
+    Column('modified_date', types.DateTime),
+    Column('resource_id', types.UnicodeText),
+    Column('harvested', types.DateTime, default=datetime.utcnow),
+)
+# the primary key (source_id, filename) is the index of the lookups by harvest source
+
+
+class HarvestFileState(DomainObject):
+    """ State of a remote file when it was last imported by a harvest source """
+    pass
+
+
+mapper(HarvestFileState, harvest_file_state_table)
+
+
+def setup():
+    """
+    Create the table if it does not exist yet, or add the columns missing in an older version of it.
+    Called by the command `paster ogdch initdb` only, never by the harvesters.
+    """
+    if not harvest_file_state_table.exists(bind=meta.engine):
+        harvest_file_state_table.create(bind=meta.engine)
+        log.info('Created table %s' % harvest_file_state_table.name)
+        return
+
+    existing_columns = set(c['name'] for c in inspect(meta.engine).get_columns(harvest_file_state_table.name))
+    preparer = meta.engine.dialect.identifier_preparer
+    for column in harvest_file_state_table.columns:
+        if column.name not in existing_columns:
+            meta.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                preparer.format_table(harvest_file_state_table), preparer.format_column(column),
+                column.type.compile(dialect=meta.engine.dialect)))
+            log.info('Added column %s to table %s' % (column.name, harvest_file_state_table.name))
+
+
+def get_file_states(source_id):
+    """
+    Get the state of all the files imported by a harvest source, in one query
+
+    :param source_id: Id of the harvest source
+    :type source_id: str
+
+    :returns: The state of the files by filename
+    :rtype: dict
+    """
+    query = Session.query(HarvestFileState).filter(HarvestFileState.source_id == source_id)
+    return dict((file_state.filename, file_state) for file_state in query)
+
+
+def save_file_states(source_id, file_states):
+    """
+    Store the state of the files which have been imported, in one transaction
+
+    :param source_id: Id of the harvest source
+    :type source_id: str
+    :param file_states: The state of the files, dicts with the keys
+        filename, size, hash (see get_remote_file_hash of the StorageAdapters), modified_date and resource_id.
+        The unknown values are None.
+    :type file_states: list of dict
+    """
+    if not file_states:
+        return
+    existing_states = get_file_states(source_id)
+    now = datetime.utcnow()
+    for state in file_states:
+        file_state = existing_states.get(state['filename'])
+        if file_state is None:
+            file_state = HarvestFileState(source_id=source_id, filename=state['filename'])
+            Session.add(file_state)
+        file_state.size = state['size']
+        file_state.hash = state['hash']
+        file_state.modified_date = state['modified_date']
+        file_state.resource_id = state['resource_id']
+        file_state.harvested = now
+    Session.commit()
+
+
+def is_unchanged(file_state, size, file_hash, modified_date):
+    """
+    Check if a remote file is the same as when it was imported.
+    The content hashes are compared if both are known, otherwise the size and the modification date.
+
+    :param file_state: The stored state of the file, None if the file has never been imported
+    :type file_state: HarvestFileState
+    :param size: Current size of the remote file, None if unknown
+    :type size: int
+    :param file_hash: Current content hash of the remote file, None if unknown
+    :type file_hash: str
+    :param modified_date: Current modification date of the remote file, None if unknown
+    :type modified_date: datetime
+
+    :rtype: bool
+    """
+    if file_state is None:
+        return False
+    if file_hash and file_state.hash:
+        return file_hash == file_state.hash
+    return size is not None and modified_date is not None and \
+        size == file_state.size and modified_date == file_state.modified_date
@@ -1,4 +1,11 @@
+import codecs
+import csv
+import fcntl
+import itertools
 import json
+import multiprocessing
+import tempfile
+from contextlib import contextmanager
 from zipfile import ZipFile
 import re
 import os
@@ -8,14 +15,32 @@ import unicodecsv
 import voluptuous
 from ckanext.harvest.model import HarvestObject
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # no columnar output
+
 log = logging.getLogger(__name__)
 
+CHUNK_SIZE = 1024 * 1024
+# number of lines converted at once
+BLOCK_SIZE = 10000
+# columnar output formats, with the extension of their files
+COLUMNAR_FORMATS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+# minimal number of rows of a row group of the Parquet files
+PARQUET_ROW_GROUP_SIZE = 100000
+
 
 def get_validation_schema():
     column_schema = voluptuous.Schema({
         'from': int,
         'to': int,
         'name': basestring,
+        'type': voluptuous.Any('string', 'int', 'float'),
     })
 
     def validate_infoplus(files):
@@ -30,6 +55,8 @@ def get_validation_schema():
         voluptuous.Required('files'): validate_infoplus,
         voluptuous.Required('dataset'): basestring,
         voluptuous.Required('year'): int,
+        'processes': voluptuous.All(int, voluptuous.Range(min=1)),
+        'formats': [voluptuous.Any(*COLUMNAR_FORMATS)],
     })
 
 
@@ -51,23 +78,40 @@ def get_filename(filelist_with_dataset, harvester_config):
     return files[0]
 
 
+def get_columnar_formats(infoplus_config):
+    """
+    Get the columnar formats written besides the CSV files, none if pyarrow is not installed
+
+    :rtype: list of str
+    """
+    formats = infoplus_config.get('formats', [])
+    if formats and pyarrow is None:
+        log.warning('pyarrow is not installed, the Info+ files are only converted to CSV')
+        return []
+    return formats
+
+
 def create_harvest_jobs(harvester_config, harvester_name, harvest_job, zip_filename, workingdir):
     job_ids = []
 
+    # one object per file and output format, each one is imported as a resource
+    output_formats = ['csv'] + get_columnar_formats(harvester_config['infoplus'])
     for filename in harvester_config['infoplus']['files'].keys():
-        obj = HarvestObject(guid=harvester_name, job=harvest_job)
-        # serialise and store the dirlist
-        obj.content = json.dumps({
-            'type': 'file-skip-download',
-            'file': zip_filename,
-            'tmpfolder': workingdir,
-            'dataset': harvester_config['infoplus']['dataset'],
-            'infoplus_filename': filename,
-            'filter': 'infoplus',
-        })
-        # save it for the next step
-        obj.save()
-        job_ids.append(obj.id)
+        for output_format in output_formats:
+            obj = HarvestObject(guid=harvester_name, job=harvest_job)
+            # serialise and store the dirlist
+            obj.content = json.dumps({
+                'type': 'file-skip-download',
+                'file': zip_filename,
+                'tmpfolder': workingdir,
+                'dataset': harvester_config['infoplus']['dataset'],
+                'infoplus_filename': filename,
+                'infoplus_format': output_format,
+                'filter': 'infoplus',
+            })
+            # save it for the next step
+            obj.save()
+            job_ids.append(obj.id)
 
     obj = HarvestObject(guid=harvester_name, job=harvest_job)
     obj.content = json.dumps({'type': 'finalizer', 'dataset': harvester_config['infoplus']['dataset']})
@@ -101,34 +145,321 @@ def file_filter(harvester_obj, config):
     0000007,9.733756,46.922368,744,Fideri
     0000011,7.389462,47.191804,467,Grenchen Nor
     0000016,6.513937,46.659019,499,"La Sarraz, Couronn"
+
+    With config['infoplus']['formats'], the file is converted to Parquet or Arrow files too, with the columns
+    typed by their 'type' ('string' by default, 'int' or 'float'). The objects with an infoplus_format
+    get the path of these files.
     """
-    log.info('Extracting file {} from Info+ zip file'.format(harvester_obj['infoplus_filename']))
+    tmpfolder = harvester_obj['tmpfolder']
+    member = harvester_obj['infoplus_filename']
+    if not os.path.exists(_get_csv_path(tmpfolder, member)):
+        # the first Info+ object of the job converts all the files of the zip file
+        extract_members(os.path.join(tmpfolder, harvester_obj['file']), tmpfolder,
+                        config['infoplus']['files'], config['infoplus'].get('processes', 1),
+                        get_columnar_formats(config['infoplus']))
 
-    zipfile = ZipFile(os.path.join(harvester_obj['tmpfolder'], harvester_obj['file']), 'r')
-    path = os.path.join(harvester_obj['tmpfolder'], harvester_obj['infoplus_filename'] + '.csv')
+    output_format = harvester_obj.get('infoplus_format', 'csv')
+    if output_format == 'csv':
+        harvester_obj['file'] = _get_csv_path(tmpfolder, member)
+    else:
+        harvester_obj['file'] = _get_columnar_path(tmpfolder, member, output_format)
+    return harvester_obj
 
-    fp = zipfile.open(harvester_obj['infoplus_filename'])
-    data = fp.read()
-    data = data.decode('utf-8')
-    fp.close()
 
-    with open(path, 'wb') as f:
-        writer = unicodecsv.writer(f, encoding='utf-8')
+def _get_csv_path(tmpfolder, member):
+    return os.path.join(tmpfolder, member + '.csv')
 
-        infoplus_config = config['infoplus']['files'][harvester_obj['infoplus_filename']]
 
-        headings = map(lambda col: col['name'], infoplus_config)
-        writer.writerow(headings)
+def _get_columnar_path(tmpfolder, member, output_format):
+    return os.path.join(tmpfolder, member + COLUMNAR_FORMATS[output_format])
 
-        for line in data.split('\n'):
-            row = []
-            for config in infoplus_config:
-                from_pos = config['from'] - 1
-                to_pos = config['to'] if config['to'] != -1 else len(line)
-                row.append(line[from_pos:to_pos].strip())
-            writer.writerow(row)
 
-    zipfile.close()
+def extract_members(zip_path, tmpfolder, files_config, processes=1, formats=()):
+    """
+    Convert the configured files of an Info+ zip file to CSV files in one pass. With more than one process, the files
+    are converted in parallel by a pool of processes, each process opens the zip file once. The files which are
+    already converted are skipped.
+    The zip file is locked during the conversion, the other harvest objects of the job wait for it, and every file
+    is written to a unique temporary file first.
 
-    harvester_obj['file'] = path
-    return harvester_obj
+    :param zip_path: Path of the Info+ zip file
+    :type zip_path: str
+    :param tmpfolder: Folder of the CSV files
+    :type tmpfolder: str
+    :param files_config: The column configuration by filename, see config['infoplus']['files']
+    :type files_config: dict
+    :param processes: Number of processes. With 1 process (default), the files are converted by the current process.
+        The pool is forked from the harvest worker, which runs other threads (e.g. the log listener, see
+        harvest_logging), so it is only used when configured.
+    :type processes: int
+    :param formats: The columnar formats written besides the CSV files, see COLUMNAR_FORMATS (needs pyarrow)
+    :type formats: list of str
+    """
+    with _exclusive_lock(zip_path):
+        # another harvest object of the job may have converted the files while this one waited for the lock
+        tasks = [(member, files_config[member], tmpfolder, formats) for member in sorted(files_config)
+                 if not os.path.exists(_get_csv_path(tmpfolder, member))]
+        if not tasks:
+            return
+
+        log.info('Extracting files %s from Info+ zip file with %d processes', ', '.join(t[0] for t in tasks),
+                 min(processes, len(tasks)))
+        if processes <= 1 or len(tasks) == 1:
+            with ZipFile(zip_path, 'r') as zipfile:
+                results = [_convert_member(zipfile, *task) for task in tasks]
+        else:
+            pool = multiprocessing.Pool(processes, initializer=_open_worker_zipfile, initargs=(zip_path,))
+            try:
+                results = pool.map(_convert_member_in_worker, tasks)
+                pool.close()
+            except Exception:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+    for member, rows in results:
+        log.info('Converted %d lines of Info+ file %s', rows, member)
+
+
+@contextmanager
+def _exclusive_lock(path):
+    """
+    Lock a file against the other processes (e.g. the harvest objects of the job fetched or imported at the
+    same time), the lock is released when the file is closed
+    """
+    with open(path, 'rb') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _create_temp_file(path):
+    # unique name in the folder of the file, so that it can be renamed to the file atomically
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+    os.close(fd)
+    return temp_path
+
+
+def _convert_member(zipfile, member, columns, tmpfolder, formats=()):
+    path = _get_csv_path(tmpfolder, member)
+    columnar_paths = [_get_columnar_path(tmpfolder, member, output_format) for output_format in formats]
+    temp_paths = {}
+    try:
+        for target in [path] + columnar_paths:
+            temp_paths[target] = _create_temp_file(target)
+        writers = []
+        try:
+            for columnar_path, output_format in zip(columnar_paths, formats):
+                writers.append(ColumnarWriter(temp_paths[columnar_path], output_format, columns))
+            with zipfile.open(member) as fp, open(temp_paths[path], 'wb') as f:
+                rows = convert_fixed_width(fp, f, columns, writers)
+        finally:
+            for writer in writers:
+                writer.close()
+        # the CSV file only gets its name once all the files are complete, see extract_members
+        for target in columnar_paths + [path]:
+            os.rename(temp_paths.pop(target), target)
+    finally:
+        for temp_path in temp_paths.values():
+            os.remove(temp_path)
+    return member, rows
+
+
+_worker_zipfile = None
+
+
+def _open_worker_zipfile(zip_path):
+    global _worker_zipfile
+    _worker_zipfile = ZipFile(zip_path, 'r')
+
+
+def _convert_member_in_worker(task):
+    return _convert_member(_worker_zipfile, *task)
+
+
+def _decode_latin1(error):
+    # the bytes which are not valid UTF-8 are decoded as ISO-8859-1, the encoding of older Info+ exports
+    return error.object[error.start:error.end].decode('iso-8859-1'), error.end
+
+
+codecs.register_error('infoplus_latin1', _decode_latin1)
+
+
+def get_slice_plan(columns):
+    """
+    Compile the column configuration of an Info+ file into slices of a line, once per file
+
+    :param columns: The column configuration, dicts with the keys from and to (1-based, inclusive, -1 for the end
+        of the line)
+    :type columns: list of dict
+
+    :rtype: list of slice
+    """
+    return [slice(column['from'] - 1, column['to'] if column['to'] != -1 else None) for column in columns]
+
+
+def iter_lines(fp, chunk_size=CHUNK_SIZE):
+    """
+    Read the lines of a file in chunks, decoded as UTF-8 (with the invalid bytes as ISO-8859-1).
+    Only one chunk and one line are held in memory.
+
+    :param fp: The file, e.g. a member of a zip file
+    :param chunk_size: Number of bytes read at once
+    :type chunk_size: int
+
+    :returns: The lines, without the line break
+    :rtype: generator of unicode
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='infoplus_latin1')
+    remainder = u''
+    while True:
+        chunk = fp.read(chunk_size)
+        text = remainder + decoder.decode(chunk, final=not chunk)
+        lines = text.split(u'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line
+        if not chunk:
+            break
+    if remainder:
+        yield remainder
+
+
+def convert_fixed_width(fp, out, columns, columnar_writers=()):
+    """
+    Convert a fixed width file to CSV, in blocks of lines. The cells of a block are sliced, stripped and
+    encoded column by column.
+
+    :param fp: The fixed width file
+    :param out: The CSV file, opened in binary mode
+    :param columns: The column configuration, see get_slice_plan
+    :type columns: list of dict
+    :param columnar_writers: Writers of the same columns in a columnar format, fed block by block
+    :type columnar_writers: list of ColumnarWriter
+
+    :returns: The number of converted lines
+    :rtype: int
+    """
+    unicodecsv.writer(out, encoding='utf-8').writerow([column['name'] for column in columns])
+    # the cells are already encoded, the writer of the standard library is enough
+    writer = csv.writer(out)
+
+    slices = get_slice_plan(columns)
+
+    rows = 0
+    lines = iter_lines(fp)
+    while True:
+        block = list(itertools.islice(lines, BLOCK_SIZE))
+        if not block:
+            break
+        if slices:
+            cells_by_column = _slice_columns(block, slices)
+            for columnar_writer in columnar_writers:
+                columnar_writer.write(cells_by_column)
+            writer.writerows(zip(*[_encode_cells(cells) for cells in cells_by_column]))
+        else:
+            writer.writerows([[]] * len(block))
+        rows += len(block)
+    return rows
+
+
+def _slice_columns(lines, slices):
+    return [[line[s].strip() for line in lines] for s in slices]
+
+
+def _encode_cells(cells):
+    # one encoding of the whole column instead of one per cell
+    joined = u'\x00'.join(cells)
+    if joined.count(u'\x00') != len(cells) - 1:
+        # a cell contains the separator
+        return [cell.encode('utf-8') for cell in cells]
+    return joined.encode('utf-8').split('\x00')
+
+
+class ColumnarWriter(object):
+    """
+    Writer of the columns of an Info+ file to a Parquet or Arrow IPC file, with one record batch per block of lines
+    """
+
+    def __init__(self, path, output_format, columns):
+        """
+        :param path: Path of the file
+        :type path: str
+        :param output_format: 'parquet' or 'arrow'
+        :type output_format: str
+        :param columns: The column configuration, the optional key type is 'string' (default), 'int' or 'float'
+        :type columns: list of dict
+        """
+        self.path = path
+        self.output_format = output_format
+        self.schema = pyarrow.schema([pyarrow.field(column['name'], _ARROW_TYPES[column.get('type', 'string')]())
+                                      for column in columns])
+        self._converters = [_CONVERTERS[column.get('type', 'string')] for column in columns]
+        self.invalid_cells = 0
+        self._batches = []
+        self._buffered_rows = 0
+        if output_format == 'parquet':
+            self._writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self._sink = pyarrow.OSFile(path, 'wb')
+            self._writer = pyarrow.RecordBatchFileWriter(self._sink, self.schema)
+
+    def write(self, cells_by_column):
+        """
+        :param cells_by_column: The stripped cells of a block of lines, column by column
+        :type cells_by_column: list of list of unicode
+        """
+        arrays = []
+        for cells, converter, field in zip(cells_by_column, self._converters, self.schema):
+            if converter is not None:
+                cells = [self._convert(converter, cell) for cell in cells]
+            arrays.append(pyarrow.array(cells, type=field.type))
+        batch = pyarrow.RecordBatch.from_arrays(arrays, self.schema.names)
+        if self.output_format == 'parquet':
+            # the blocks are grouped, small row groups make the Parquet files larger and slower to read
+            self._batches.append(batch)
+            self._buffered_rows += batch.num_rows
+            if self._buffered_rows >= PARQUET_ROW_GROUP_SIZE:
+                self._flush()
+        else:
+            self._writer.write_batch(batch)
+
+    def _convert(self, converter, cell):
+        if not cell:
+            return None
+        try:
+            return converter(cell)
+        except ValueError:
+            self.invalid_cells += 1
+            return None
+
+    def _flush(self):
+        if self._batches:
+            self._writer.write_table(pyarrow.Table.from_batches(self._batches, self.schema))
+            self._batches = []
+            self._buffered_rows = 0
+
+    def close(self):
+        if self.output_format == 'parquet':
+            self._flush()
+            self._writer.close()
+        else:
+            self._writer.close()
+            self._sink.close()
+        if self.invalid_cells:
+            log.warning('%d cells of %s are not valid numbers, they are written as null', self.invalid_cells,
+                        os.path.basename(self.path))
+
+
+_CONVERTERS = {
+    'string': None,
+    'int': int,
+    'float': float,
+}
+
+if pyarrow is not None:
+    _ARROW_TYPES = {
+        'string': pyarrow.string,
+        'int': pyarrow.int64,
+        'float': pyarrow.float64,
+    }
@@ -1,5 +1,43 @@
+"""
+Ist-File Filter
+===============
+
+Filter of the Ist-Daten files (actual arrival and departure times), keeping the swiss stations only, e.g.
+`
+    filter_ist_file('/tmp/2016-09-25istdaten.csv', processes=4)
+`
+By default the file is filtered by the current process. With more processes, the file is split in chunks on line
+boundaries, the chunks are filtered by a pool of processes into part files, which are concatenated in order.
+The pool is forked from the harvest worker, which runs other threads (e.g. the log listener, see harvest_logging),
+so it is only used when configured. The lines are filtered as bytes, the encoding of the file does not matter.
+
+The quoted values may contain line breaks. When a chunk boundary falls into such a value, the chunks cannot be
+filtered on their own and the whole file is filtered again by the current process.
+"""
+import codecs
 import csv
+import logging
+import multiprocessing
 import os
+import shutil
+
+log = logging.getLogger(__name__)
+
+# number of bytes of the file filtered by one task
+CHUNK_SIZE = 32 * 1024 * 1024
+# number of filtered lines written at once
+WRITE_BATCH_SIZE = 10000
+BPUIC_COLUMN = 'BPUIC'
+SWISS_PREFIX = '85'
+BPUIC_LENGTH = 7
+# parser states of the quoted fields, see _ends_in_quoted_field
+_START_FIELD, _IN_FIELD, _IN_QUOTED_FIELD, _QUOTE_IN_QUOTED_FIELD = range(4)
+
+
+class IncompleteRecord(Exception):
+    """
+    The lines of a chunk end in a quoted value, which continues in the next chunk
+    """
 
 
 def ist_file_filter(harvester_obj, config):
@@ -9,33 +47,250 @@ def ist_file_filter(harvester_obj, config):
     and trims the id to 7 digits (from the front), this strips away additional station data which are appended
     to the station id, e.g. platform.
     """
-    temp_file = harvester_obj['file'] + '.tmp'
-    with open(temp_file, 'w') as fout, open(harvester_obj['file']) as fin:
-        writer = csv.writer(fout, delimiter=';')
-        reader = csv.reader(fin, delimiter=';')
+    filter_ist_file(harvester_obj['file'], config.get('ist_file_processes', 1))
+    return harvester_obj
+
+
+def filter_ist_file(path, processes=1, chunk_size=CHUNK_SIZE):
+    """
+    Filter an Ist-File in place
+
+    :param path: Path of the Ist-File, a CSV file separated by semicolons
+    :type path: str
+    :param processes: Number of processes filtering the chunks of the file. With 1 process, the whole file is
+        filtered by the current process.
+    :type processes: int
+    :param chunk_size: Number of bytes filtered by one task
+    :type chunk_size: int
+
+    :returns: The number of records read and kept, without the heading
+    :rtype: tuple
+    """
+    temp_file = path + '.tmp'
+    with open(path, 'rb') as fin:
+        heading_line = fin.readline()
+        heading = csv.reader([heading_line], delimiter=';').next() if heading_line.strip() else []
+        column_index = get_bpuic_index(heading)
+        if column_index is None:
+            raise Exception('File {} is not a valid Ist-File, missing column BPUIC'.format(path))
+        start = fin.tell()
+        size = os.fstat(fin.fileno()).st_size
+        chunks = get_chunks(fin, start, chunk_size) if processes > 1 else [(start, size)]
+
+    tasks = _get_tasks(path, chunks, column_index, size)
+    try:
+        if len(tasks) > 1:
+            try:
+                results = _filter_in_pool(tasks, processes)
+            except IncompleteRecord:
+                log.warning('A quoted value of the Ist-File %s continues across chunks, filtering it in one process',
+                            os.path.basename(path))
+                _remove_parts(tasks)
+                tasks = _get_tasks(path, [(start, size)], column_index, size)
+                results = [_filter_chunk(tasks[0])]
+        else:
+            results = [_filter_chunk(task) for task in tasks]
+
+        with open(temp_file, 'wb') as fout:
+            csv.writer(fout, delimiter=';').writerow(heading)
+            for task in tasks:
+                with open(task[4], 'rb') as part:
+                    shutil.copyfileobj(part, fout)
+    finally:
+        _remove_parts(tasks)
+
+    os.rename(temp_file, path)
+
+    read = sum(r[0] for r in results)
+    kept = sum(r[1] for r in results)
+    log.info('Filtered Ist-File %s in %d chunks: kept %d of %d records', os.path.basename(path), len(tasks), kept,
+             read)
+    return read, kept
+
 
-        heading = reader.next()
+def _get_tasks(path, chunks, column_index, size):
+    return [(path, start, end, column_index, '%s.%d.part' % (path, i), end >= size)
+            for i, (start, end) in enumerate(chunks)]
 
-        column_index = None
-        for i, column in enumerate(heading):
-            if column.strip() == 'BPUIC':
-                column_index = i
-                break
 
-        if not column_index:
-            raise Exception('File {} if not a valid Ist-File, missing column BPUIC'.format(harvester_obj['file']))
+def _filter_in_pool(tasks, processes):
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        results = pool.map(_filter_chunk, tasks)
+        pool.close()
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
 
-        writer.writerow(heading)
 
-        for line in reader:
-            bpuic = line[column_index]
-            if not bpuic.startswith('85'):  # filter out non-swiss stations
+def _remove_parts(tasks):
+    for task in tasks:
+        if os.path.exists(task[4]):
+            os.remove(task[4])
+
+
+def get_bpuic_index(heading):
+    """
+    :param heading: The column names
+    :type heading: list of str
+
+    :returns: The index of the BPUIC column, None if it is missing
+    :rtype: int
+    """
+    for i, column in enumerate(heading):
+        if i == 0 and column.startswith(codecs.BOM_UTF8):
+            column = column[len(codecs.BOM_UTF8):]
+        if column.strip() == BPUIC_COLUMN:
+            return i
+    return None
+
+
+def get_chunks(fp, start, chunk_size):
+    """
+    Split a file in chunks of about chunk_size bytes, ending on line boundaries
+
+    :param fp: The file, opened in binary mode
+    :param start: Offset of the first chunk
+    :type start: int
+    :param chunk_size: Number of bytes of a chunk
+    :type chunk_size: int
+
+    :returns: The start and end offset of the chunks
+    :rtype: list of tuple
+    """
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    chunks = []
+    while start < size:
+        fp.seek(min(start + chunk_size, size))
+        fp.readline()  # move to the end of the line
+        end = fp.tell()
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def _filter_chunk(task):
+    path, start, end, column_index, part_path, last = task
+    with open(path, 'rb') as fin, open(part_path, 'wb') as fout:
+        fin.seek(start)
+        return filter_lines(_read_lines(fin, end - start), column_index, fout, last)
+
+
+def _read_lines(fp, size):
+    for line in fp:
+        yield line[:-1] if line.endswith('\n') else line
+        size -= len(line)
+        if size <= 0:
+            break
+
+
+def filter_lines(lines, column_index, out, last=True):
+    """
+    Write the records of swiss stations with their BPUIC trimmed to 7 digits, like the csv module would. The lines
+    without quotes are split on the separator, the other ones are parsed by the csv module, with the following lines
+    of a quoted value containing line breaks.
+
+    :param lines: The lines, without the line feed
+    :type lines: iterable of str
+    :param column_index: The index of the BPUIC column
+    :type column_index: int
+    :param out: The output file, opened in binary mode
+    :param last: False if the lines are followed by other ones, e.g. a chunk of the file which is not the last one
+    :type last: bool
+
+    :returns: The number of records read and kept
+    :rtype: tuple
+    :raises IncompleteRecord: If the lines end in a quoted value and are not the last ones
+    """
+    writer = csv.writer(out, delimiter=';')
+    buffered = []
+    read = kept = 0
+    short_lines = 0
+    for line in _records(lines, last):
+        read += 1
+        if line.endswith('\r'):
+            line = line[:-1]
+        quoted = '"' in line or '\r' in line
+        if quoted:
+            fields = csv.reader([line], delimiter=';').next()
+        else:
+            # the columns after the BPUIC are kept as they are
+            fields = line.split(';', column_index + 1)
+        if len(fields) <= column_index:
+            short_lines += 1
+            continue
+        bpuic = fields[column_index]
+        if not bpuic.startswith(SWISS_PREFIX):  # filter out non-swiss stations
+            continue
+
+        kept += 1
+        if quoted:
+            fields[column_index] = bpuic[:BPUIC_LENGTH]
+            out.write(''.join(buffered))
+            buffered = []
+            writer.writerow(fields)
+        elif len(bpuic) > BPUIC_LENGTH:
+            fields[column_index] = bpuic[:BPUIC_LENGTH]
+            buffered.append(';'.join(fields) + '\r\n')
+        else:
+            buffered.append(line + '\r\n')
+        if len(buffered) >= WRITE_BATCH_SIZE:
+            out.write(''.join(buffered))
+            buffered = []
+    out.write(''.join(buffered))
+
+    if short_lines:
+        log.warning('Skipped %d lines of the Ist-File without BPUIC column', short_lines)
+    return read, kept
+
+
+def _records(lines, last):
+    """
+    Join the lines of the records with line breaks in a quoted value
+    """
+    record_lines = None
+    for line in lines:
+        if record_lines is not None:
+            record_lines.append(line)
+            if _ends_in_quoted_field(line, _IN_QUOTED_FIELD):
                 continue
+            line = '\n'.join(record_lines)
+            record_lines = None
+        elif '"' in line and _ends_in_quoted_field(line):
+            record_lines = [line]
+            continue
+        yield line
 
-            line[column_index] = bpuic[:7]  #
-            writer.writerow(line)
+    if record_lines is not None:
+        if not last:
+            raise IncompleteRecord()
+        # the csv module ends the quoted value with the file too
+        yield '\n'.join(record_lines)
 
-    os.remove(harvester_obj['file'])
-    os.rename(temp_file, harvester_obj['file'])
 
-    return harvester_obj
+def _ends_in_quoted_field(line, state=_START_FIELD):
+    """
+    :param line: A line of the file, without the line feed
+    :type line: str
+    :param state: The parser state at the start of the line, _IN_QUOTED_FIELD for a line following a line break
+        in a quoted value
+
+    :returns: True if the line ends in a quoted value, i.e. the value contains a line break
+    :rtype: bool
+    """
+    for c in line:
+        if state == _IN_QUOTED_FIELD:
+            if c == '"':
+                state = _QUOTE_IN_QUOTED_FIELD
+        elif c == ';':
+            state = _START_FIELD
+        elif state == _QUOTE_IN_QUOTED_FIELD:
+            # a doubled quote is a quote in the value
+            state = _IN_QUOTED_FIELD if c == '"' else _IN_FIELD
+        elif state == _START_FIELD:
+            state = _IN_QUOTED_FIELD if c == '"' else _IN_FIELD
+    return state == _IN_QUOTED_FIELD
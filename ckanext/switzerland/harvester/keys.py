@@ -5,6 +5,14 @@ AWS_REGION_NAME = 'region_name'
 AWS_BUCKET_NAME = "bucket_name"
 AWS_RESPONSE_CONTENT = "Contents"
 AWS_RESPONSE_PREFIXES = "CommonPrefixes"
+AWS_RESPONSE_IS_TRUNCATED = "IsTruncated"
+AWS_RESPONSE_NEXT_CONTINUATION_TOKEN = "NextContinuationToken"
+AWS_CONTINUATION_TOKEN = "ContinuationToken"
+AWS_ENDPOINT_URL = 'endpoint_url'
+AWS_TRANSFER_MULTIPART_THRESHOLD = 'multipart_threshold'
+AWS_TRANSFER_PART_SIZE = 'part_size'
+AWS_TRANSFER_MAX_CONCURRENCY = 'max_concurrency'
+AWS_TRANSFER_USE_THREADS = 'use_threads'
 
 FTP_SERVER_KEY = 'ftp_server'
 FTP_USER_NAME = 'username'
@@ -14,4 +22,7 @@ FTP_HOST = 'host'
 FTP_PORT = 'port'
 
 REMOTE_DIRECTORY = 'remotedirectory'
-LOCAL_PATH = 'localpath'
\ No newline at end of file
+LOCAL_PATH = 'localpath'
+
+POOL_SIZE = 'pool_size'
+POOL_MAX_IDLE_TIME = 'pool_max_idle_time'
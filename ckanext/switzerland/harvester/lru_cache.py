@@ -0,0 +1,57 @@
+"""
+LRU Cache
+=========
+
+Thread-safe in-process cache of a limited size, e.g. the validated configs of the harvest sources
+`
+    cache = LRUCache(100)
+    cache.set(key, value)
+    cache.get(key)
+`
+"""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping of a limited size, the least recently used entries
+    are dropped first
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return None
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def remove_value(self, value):
+        with self._lock:
+            for key in [k for k, v in self._entries.iteritems() if v == value]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,95 @@
+"""
+Resource Ordering
+=================
+
+Order of the resources of a harvested dataset, defined by the `resource_regex` and `date_pattern` keys of the
+harvester configuration. The regexes are compiled once per configuration, e.g.
+`
+    ordering = get_resource_ordering(config['resource_regex'], config['date_pattern'])
+    ordered_resources, unmatched_resources = ordering.order(package['resources'])
+`
+"""
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+MAX_CACHED_ORDERINGS = 100
+
+
+class ResourceOrdering(object):
+
+    def __init__(self, resource_regex, date_pattern=None):
+        """
+        :param resource_regex: Regex matched against the identifier (filename) of the resources to order
+        :type resource_regex: str
+        :param date_pattern: Regex searched in the identifier to get the date of the resources, None to order by
+            identifier
+        :type date_pattern: str
+        """
+        self.resource_regex = re.compile(resource_regex, re.IGNORECASE)
+        self.date_pattern = re.compile(date_pattern) if date_pattern else None
+
+    def sort_key(self, identifier):
+        """
+        Key of a resource, computed once per resource. The resources whose identifier does not contain the
+        date pattern are ordered after the ones that do, by identifier.
+
+        :rtype: tuple
+        """
+        if self.date_pattern is None:
+            return identifier,
+        match = self.date_pattern.search(identifier)
+        if match is None:
+            return False, identifier
+        return True, match.group(), identifier
+
+    def order(self, resources):
+        """
+        Split the resources in the ones matching resource_regex, ordered by date (or identifier) descending,
+        and the other ones, in their original order
+
+        :param resources: Resource dicts with an identifier
+        :type resources: list of dict
+
+        :returns: The ordered and the unmatched resources
+        :rtype: tuple
+        """
+        keyed_resources = []
+        unmatched_resources = []
+        for resource in resources:
+            identifier = resource['identifier']
+            if self.resource_regex.match(identifier):
+                keyed_resources.append((self.sort_key(identifier), resource))
+            else:
+                unmatched_resources.append(resource)
+
+        if self.date_pattern is not None:
+            undated = [key[1] for key, _ in keyed_resources if not key[0]]
+            if undated:
+                log.warning('Date pattern %s not found in the filenames %s', self.date_pattern.pattern,
+                            ', '.join(undated))
+
+        keyed_resources.sort(key=lambda keyed_resource: keyed_resource[0], reverse=True)
+        ordered_resources = [resource for _, resource in keyed_resources]
+        log.debug('Ordered %d resources matching regex %s, %d not matching', len(ordered_resources),
+                  self.resource_regex.pattern, len(unmatched_resources))
+        return ordered_resources, unmatched_resources
+
+
+_orderings = {}
+
+
+def get_resource_ordering(resource_regex, date_pattern=None):
+    """
+    Get the ordering of a harvester configuration, its regexes are only compiled the first time
+
+    :rtype: ResourceOrdering
+    """
+    key = (resource_regex, date_pattern)
+    ordering = _orderings.get(key)
+    if ordering is None:
+        if len(_orderings) >= MAX_CACHED_ORDERINGS:
+            _orderings.clear()
+        ordering = _orderings[key] = ResourceOrdering(resource_regex, date_pattern)
+    return ordering
@@ -16,13 +16,15 @@ import datetime
 
 from dateutil.tz import tzutc
 from pprint import pformat
-from config.config_key import ConfigKey
+from config.config_key import ConfigKey, to_bool
 
 import boto3
 import boto3.session
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
-from storage_adapter_base import StorageAdapterBase
+from storage_adapter_base import StorageAdapterBase, RemoteFile, DOWNLOAD_CHUNK_SIZE
+from streaming_file import StreamingFile
 from keys import (
     AWS_SECRET_KEY,
     AWS_ACCESS_KEY,
@@ -30,13 +32,25 @@ from keys import (
     AWS_BUCKET_NAME,
     AWS_RESPONSE_CONTENT,
     AWS_RESPONSE_PREFIXES, 
+    AWS_RESPONSE_IS_TRUNCATED,
+    AWS_RESPONSE_NEXT_CONTINUATION_TOKEN,
+    AWS_CONTINUATION_TOKEN,
     LOCAL_PATH, 
     REMOTE_DIRECTORY,
-    S3_CONFIG_KEY
+    S3_CONFIG_KEY,
+    POOL_SIZE,
+    POOL_MAX_IDLE_TIME,
+    AWS_ENDPOINT_URL,
+    AWS_TRANSFER_MULTIPART_THRESHOLD,
+    AWS_TRANSFER_PART_SIZE,
+    AWS_TRANSFER_MAX_CONCURRENCY,
+    AWS_TRANSFER_USE_THREADS
 )
 
 log = logging.getLogger(__name__)
 
+MB = 1024 * 1024
+
 CONFIG_KEYS = [
     ConfigKey(AWS_BUCKET_NAME, str, True),
     ConfigKey(AWS_ACCESS_KEY, str, True),
@@ -44,6 +58,14 @@ CONFIG_KEYS = [
     ConfigKey(AWS_SECRET_KEY, str, True),
     ConfigKey(LOCAL_PATH, str, True),
     ConfigKey(REMOTE_DIRECTORY, str, True),
+    ConfigKey(POOL_SIZE, int, False, lambda x: x >= 0, 'Pool size should be zero or a positive number', 0),
+    ConfigKey(POOL_MAX_IDLE_TIME, int, False, lambda x: x > 0, 'Pool max idle time should be a positive number', 300),
+    ConfigKey(AWS_ENDPOINT_URL, str),
+    # the transfer defaults are the ones of boto3
+    ConfigKey(AWS_TRANSFER_MULTIPART_THRESHOLD, int, False, lambda x: x > 0, 'Multipart threshold should be a positive number', 8 * MB),
+    ConfigKey(AWS_TRANSFER_PART_SIZE, int, False, lambda x: x > 0, 'Part size should be a positive number', 8 * MB),
+    ConfigKey(AWS_TRANSFER_MAX_CONCURRENCY, int, False, lambda x: x > 0, 'Max concurrency should be a positive number', 10),
+    ConfigKey(AWS_TRANSFER_USE_THREADS, to_bool, False, None, None, True),
 ]
 class S3StorageAdapter(StorageAdapterBase):
     _aws_session = None
@@ -66,20 +88,28 @@ class S3StorageAdapter(StorageAdapterBase):
         return self
 
     def __exit__(self, type, value, traceback):
-        pass
+        self._disconnect()
     
     def _connect(self):
-        self._aws_session = boto3.session.Session(
+        # creating a session and a client is costly, so they are reused from the connection pool if enabled
+        self._aws_session, self._aws_client = self._acquire_connection()
+
+    def _disconnect(self):
+        # as boto3 is HTTP call based, we don't need to close anything, but the client can be given back to the pool
+        if self._aws_client is not None:
+            self._release_connection((self._aws_session, self._aws_client))
+        self._aws_session = None
+        self._aws_client = None
+
+    def _open_connection(self):
+        session = boto3.session.Session(
             aws_access_key_id=self._config[AWS_ACCESS_KEY],
             aws_secret_access_key=self._config[AWS_SECRET_KEY],
             region_name=self._config[AWS_REGION_NAME]
         )
 
-        self._aws_client = self._aws_session.client('s3')
-    
-    def _disconnect(self):
-        # as boto3 is HTTP call based, we don't need to close anything
-        pass
+        # an endpoint is only configured for S3 compatible storages, e.g. MinIO
+        return session, session.client('s3', endpoint_url=self._config[AWS_ENDPOINT_URL] or None)
 
     def cdremote(self, remotedir=None):
         # Files are stored flat on AWS. So there is no such command on S3. We just need to keep a ref to a Working Directory
@@ -119,24 +149,70 @@ class S3StorageAdapter(StorageAdapterBase):
         prefix = prefix + '/' if prefix else ""
         return prefix
 
+    def __iter_aws_responses__(self, prefix, delimiter):
+        # A listing returns at most 1000 keys, so we follow the continuation token until the listing is complete.
+        # The pages are yielded one by one to never hold the whole listing in memory.
+        params = {
+            'Bucket': self._config[AWS_BUCKET_NAME],
+            'Prefix': prefix,
+            'Delimiter': delimiter
+        }
+        while True:
+            s3_objects = self._aws_client.list_objects_v2(**params)
+            yield s3_objects
+
+            if not s3_objects.get(AWS_RESPONSE_IS_TRUNCATED):
+                break
+            params[AWS_CONTINUATION_TOKEN] = s3_objects[AWS_RESPONSE_NEXT_CONTINUATION_TOKEN]
+
+    def __iter_aws_objects__(self, prefix, delimiter):
+        for s3_objects in self.__iter_aws_responses__(prefix, delimiter):
+            for s3_object in s3_objects.get(AWS_RESPONSE_CONTENT, []):
+                yield s3_object
+
     def __clean_aws_response__(self, s3_objects):
         if not s3_objects or AWS_RESPONSE_CONTENT not in s3_objects:
             return []
         
         return map(lambda object : object['Key'], s3_objects[AWS_RESPONSE_CONTENT])
 
+    def __to_modified_date__(self, last_modified):
+        if last_modified is not None and last_modified.tzinfo is not None and last_modified.tzinfo == tzutc():
+            modified_date = str(last_modified)
+            # example: 2022-11-02 13:46:07
+            return datetime.datetime.strptime(modified_date[:-6], '%Y-%m-%d %H:%M:%S')
+
+        log.info("S3 bucket modified date information is not available or timezone is not in UTC")
+        return None
+
+    def iter_remote_files(self, folder=None):
+        prefix = self.__determine_prefix__(folder)
+
+        # By fixing the delimiter to '/', we limit the results to the current folder
+        for s3_object in self.__iter_aws_objects__(prefix, '/'):
+            name = self.__remove_prefix__(s3_object['Key'], prefix)
+            # skip the folder itself and the folder placeholders
+            if not name or name.endswith('/'):
+                continue
+
+            yield RemoteFile(
+                name,
+                s3_object.get('Size'),
+                s3_object.get('ETag', '').strip('"') or None,
+                self.__to_modified_date__(s3_object.get('LastModified'))
+            )
 
     def get_remote_dirlist(self, folder=None):  
         prefix = self.__determine_prefix__(folder)
 
+        objects = []
         # By fixing the delimiter to '/', we limit the results to the current folder
-        s3_objects = self._aws_client.list_objects(Bucket=self._config[AWS_BUCKET_NAME], Prefix=prefix, Delimiter="/")
-        
-        objects = self.__clean_aws_response__(s3_objects)
+        for s3_objects in self.__iter_aws_responses__(prefix, '/'):
+            objects.extend(self.__clean_aws_response__(s3_objects))
 
-        # But the previous call, did not return the folders (because of setting a delimiter), so lets look in the prefixes to add them
-        if AWS_RESPONSE_PREFIXES in s3_objects:
-            objects.extend(map(lambda object : object['Prefix'], s3_objects[AWS_RESPONSE_PREFIXES]))
+            # But the previous call, did not return the folders (because of setting a delimiter), so lets look in the prefixes to add them
+            if AWS_RESPONSE_PREFIXES in s3_objects:
+                objects.extend(map(lambda object : object['Prefix'], s3_objects[AWS_RESPONSE_PREFIXES]))
 
         files_and_folder = self.__prepare_for_return__(objects, prefix)
 
@@ -149,10 +225,8 @@ class S3StorageAdapter(StorageAdapterBase):
         prefix = self.__determine_prefix__(folder)
 
         # By fixing the delimiter to '', we list full depth, starting at the prefix depth
-        s3_objects = self._aws_client.list_objects(Bucket=self._config[AWS_BUCKET_NAME], Prefix=prefix, Delimiter="")
-        
-        objects = self.__clean_aws_response__(s3_objects)
-        
+        objects = (s3_object['Key'] for s3_object in self.__iter_aws_objects__(prefix, ''))
+
         return self.__prepare_for_return__(objects, prefix)
     
     def get_modified_date(self, filename, folder=None):
@@ -160,14 +234,7 @@ class S3StorageAdapter(StorageAdapterBase):
         file_full_path = os.path.join(prefix, filename)
         try:
             s3_object = self._aws_client.head_object(Bucket=self._config[AWS_BUCKET_NAME], Key=file_full_path)
-            if s3_object['LastModified'].tzinfo is not None\
-                    and s3_object['LastModified'].tzinfo == tzutc():
-                modified_date = str(s3_object['LastModified'])
-                modified_date = datetime.datetime.strptime(modified_date[:-6], '%Y-%m-%d %H:%M:%S')
-                # example: 2022-11-02 13:46:07
-                return modified_date
-            else:
-                log.info("S3 bucket modified date information is not available or timezone is not in UTC")
+            return self.__to_modified_date__(s3_object['LastModified'])
         except ClientError:
             return None
     
@@ -183,9 +250,71 @@ class S3StorageAdapter(StorageAdapterBase):
         if not os.path.exists(local_tmp_path):
             os.makedirs(local_tmp_path)
         
-        self._aws_client.download_file(self._config[AWS_BUCKET_NAME], file_full_path, localpath)
+        partpath, offset = self._get_partial_download(localpath)
+
+        if not offset or not self.__continue_download__(file_full_path, partpath, offset):
+            with open(partpath, 'wb') as localfile:
+                # the parts are downloaded concurrently, but written in order to a non seekable file object,
+                # so that the partial download can be continued if the transfer fails
+                self._aws_client.download_fileobj(
+                    self._config[AWS_BUCKET_NAME],
+                    file_full_path,
+                    _AppendOnlyFile(localfile),
+                    Config=self.__get_transfer_config__()
+                )
+
+        self._complete_partial_download(partpath, localpath)
 
         return "226 Transfer complete"
 
+    def open_remote_file(self, filename):
+        prefix = self.__determine_prefix__(None)
+        response = self._aws_client.get_object(
+            Bucket=self._config[AWS_BUCKET_NAME],
+            Key=os.path.join(prefix, filename)
+        )
+
+        return StreamingFile(response['Body'], response['ContentLength'])
+
+    def __continue_download__(self, file_full_path, partpath, offset):
+        # ranged GET of the missing bytes, only if the object did not change since the partial download was written
+        try:
+            response = self._aws_client.get_object(
+                Bucket=self._config[AWS_BUCKET_NAME],
+                Key=file_full_path,
+                Range='bytes=%d-' % offset,
+                IfUnmodifiedSince=datetime.datetime.fromtimestamp(os.path.getmtime(partpath), tzutc())
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('InvalidRange', 'PreconditionFailed'):
+                raise
+            # the partial download is complete already, or the object changed since
+            log.info('Could not continue download of %s, downloading it again' % file_full_path)
+            return False
+
+        body = response['Body']
+        with open(partpath, 'ab') as localfile:
+            for chunk in iter(lambda: body.read(DOWNLOAD_CHUNK_SIZE), b''):
+                localfile.write(chunk)
+        return True
+
+    def __get_transfer_config__(self):
+        return TransferConfig(
+            multipart_threshold=self._config[AWS_TRANSFER_MULTIPART_THRESHOLD],
+            multipart_chunksize=self._config[AWS_TRANSFER_PART_SIZE],
+            max_concurrency=self._config[AWS_TRANSFER_MAX_CONCURRENCY],
+            use_threads=self._config[AWS_TRANSFER_USE_THREADS]
+        )
+
+
+class _AppendOnlyFile(object):
+    """ Write only file object. As it cannot seek, boto3 writes the downloaded parts in order """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def write(self, data):
+        return self._fileobj.write(data)
+
         
 
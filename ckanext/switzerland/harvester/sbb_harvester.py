@@ -4,16 +4,12 @@ import tempfile
 import traceback
 from datetime import datetime
 import os
-import re
+from operator import itemgetter
 
 import voluptuous
 from ckan.lib.helpers import json
-from ckan.lib.munge import munge_filename
-from ckan.logic import NotFound
-from ckan.model import Session
 from ckan.plugins.toolkit import config as ckanconf
-from ckan import model
-from ckanext.harvest.model import HarvestJob, HarvestObject
+from ckanext.harvest.model import HarvestObject
 from ckanext.switzerland.harvester.base_sbb_harvester import BaseSBBHarvester, validate_regex
 from ckanext.switzerland.harvester.ist_file import ist_file_filter
 
@@ -49,6 +45,7 @@ class SBBHarvester(BaseSBBHarvester):
         return schema.extend({
             voluptuous.Required('filter_regex', default='.*'): validate_regex,
             voluptuous.Required('ist_file', default=False): bool,
+            'ist_file_processes': voluptuous.All(int, voluptuous.Range(min=1)),
         })
 
     def gather_stage_impl(self, harvest_job):
@@ -64,9 +61,7 @@ class SBBHarvester(BaseSBBHarvester):
         log.info('In %s Harvester gather_stage' % self.harvester_name)  # harvest_job.source.url
 
         # set harvester config
-        self.config = self.load_config(harvest_job.source.config)
-
-        modified_dates = {}
+        self.config = self._load_source_config(harvest_job.source)
 
         # get a listing of all files in the target directory
 
@@ -75,14 +70,15 @@ class SBBHarvester(BaseSBBHarvester):
 
         try:
             with StorageAdapterFactory(ckanconf).get_storage_adapter(remotefolder, self.config) as storage:
-                filelist = storage.get_remote_filelist()
-                log.info("Remote dirlist: %s" % str(filelist))
-
-                filelist = filter(lambda filename: re.match(self.config['filter_regex'], filename), filelist)
+                # get the files matching the filter and their last-modified date from a single listing
+                remote_files = storage.get_remote_file_metadata(filter_regex=self._regexes['filter_regex'])
+                filelist = sorted(remote_files.keys())
+                log.info('Found %d remote files', len(filelist))
+                self._log_detail('Remote dirlist: %s', filelist)
 
-                # get last-modified date of each file
-                for f in filelist:
-                    modified_dates[f] = storage.get_modified_date(f)
+                file_hashes = {}
+                if self.config['change_detection'] == 'hash':
+                    file_hashes = dict((f, storage.get_remote_file_hash(remote_files[f])) for f in filelist)
 
                 # store some config for the next step
 
@@ -122,42 +118,16 @@ class SBBHarvester(BaseSBBHarvester):
         object_ids = []
 
         # ------------------------------------------------------
-        # 1: only download the resources that have been modified
-        # has there been a previous run and was it successful?
-        previous_job = Session.query(HarvestJob) \
-            .filter(HarvestJob.source == harvest_job.source) \
-            .filter(HarvestJob.gather_finished.isnot(None)) \
-            .filter(HarvestJob.id != harvest_job.id) \
-            .order_by(HarvestJob.gather_finished.desc()) \
-            .limit(1).first()
-        if previous_job and not previous_job.gather_errors and previous_job.gather_started:
-            # optional 'force_all' config setting can be used to always download all files
-            force_all = self.config['force_all']
-
-            if not force_all:
-                try:
-                    existing_dataset = self._get_dataset(self.config['dataset'])
-                    package = model.Package.get(existing_dataset['id'])
-                    existing_resources = map(lambda r: os.path.basename(r.url), package.resources_all)
-                    # Request only the resources modified since last harvest job
-                    for f in filelist[:]:
-                        modified_date = modified_dates.get(f)
-                        # skip file if its older than last harvester run date and it actually exists on the dataset
-                        # only skip when file was already downloaded once
-                        if modified_date and modified_date < previous_job.gather_started and \
-                                munge_filename(os.path.basename(f)) in existing_resources:
-                            # do not run the harvest for this file
-                            filelist.remove(f)
-
-                    if not len(filelist):
-                        log.info('No files have been updated on the ftp/s3 aws server since the last harvest job')
-                        return []  # no files to harvest this time
-                except NotFound:  # dataset does not exist yet, download all files
-                    pass
-            else:
-                log.warning('force_all is activated, downloading all files from ftp/s3 without modification date checking')
-
-            # ------------------------------------------------------
+        # 1: only download the resources that have changed since they were last harvested
+        # optional 'force_all' config setting can be used to always download all files
+        if not self.config['force_all']:
+            filelist = map(itemgetter(0), self._skip_unchanged_files(
+                harvest_job, [(f, self.config['dataset']) for f in filelist], remote_files, file_hashes))
+            if not len(filelist):
+                log.info('No files have been updated on the ftp/s3 aws server since the last harvest job')
+                return []  # no files to harvest this time
+        else:
+            log.warning('force_all is activated, downloading all files from ftp/s3 without change detection')
 
         # ------------------------------------------------------
         # 2: download all resources
@@ -165,13 +135,9 @@ class SBBHarvester(BaseSBBHarvester):
             obj = HarvestObject(guid=self.harvester_name, job=harvest_job)
             # serialise and store the dirlist
 
-            data = {
-                'type': 'file',
-                'file': f,
-                'workingdir': workingdir,
-                'remotefolder': remotefolder,
-                'dataset': self.config['dataset'],
-            }
+            data = self._get_file_harvest_object_data(f, self.config['dataset'], workingdir, remotefolder)
+
+            data['file_state'] = self._get_file_state_data(remote_files[f], file_hashes.get(f))
 
             if self.config['ist_file']:
                 data['filter'] = 'ist_file'
@@ -185,12 +151,13 @@ class SBBHarvester(BaseSBBHarvester):
         # ------------------------------------------------------
         # 3: Add finalizer tasks to queue
         obj = HarvestObject(guid=self.harvester_name, job=harvest_job)
-        obj.content = json.dumps({'type': 'remove_tempdir', 'tempdir': tmpdirbase})
+        obj.content = json.dumps({'type': 'finalizer', 'dataset': self.config['dataset']})
         obj.save()
         object_ids.append(obj.id)
 
+        # the files are removed after the finalizer, which imports them with grouped_import
         obj = HarvestObject(guid=self.harvester_name, job=harvest_job)
-        obj.content = json.dumps({'type': 'finalizer', 'dataset': self.config['dataset']})
+        obj.content = json.dumps({'type': 'remove_tempdir', 'tempdir': tmpdirbase})
         obj.save()
         object_ids.append(obj.id)
         # ------------------------------------------------------
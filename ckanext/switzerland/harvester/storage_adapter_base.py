@@ -2,16 +2,32 @@ from pprint import pformat
 import os
 import logging
 import errno
+import re
+import threading
+import Queue
 import zipfile
+from collections import namedtuple
 from exceptions.storage_adapter_configuration_exception import StorageAdapterConfigurationException
-from keys import (LOCAL_PATH)
+from connection_pool import connection_pool
+from keys import (LOCAL_PATH, POOL_SIZE, POOL_MAX_IDLE_TIME)
 
 log = logging.getLogger(__name__)
 
+# Extension of a file being downloaded. It is kept when the download fails, so that the next attempt continues it.
+PARTIAL_DOWNLOAD_EXTENSION = '.part'
+# Folder of the local path in which the partial downloads of a harvest source are kept across harvest jobs
+PARTIAL_DOWNLOAD_FOLDER = 'partial_downloads'
+# Size of the blocks copied from the remote file to the local file
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# A file entry of a remote listing. Attributes the storage cannot provide within the listing are None.
+RemoteFile = namedtuple('RemoteFile', ['name', 'size', 'etag', 'modified_date'])
+
 class StorageAdapterBase(object):
     _config = None
     _ckan_config_resolver= None
     remote_folder = None
+    partial_download_dir = None
     _config_keys = []
 
     def __init__(self, ckan_config_resolver, config, remote_folder='', root_config_key = None, config_keys = [], config_key_prefix = ''):
@@ -70,6 +86,75 @@ class StorageAdapterBase(object):
         """
         raise NotImplementedError('_disconnect')
 
+    def _open_connection(self):
+        """
+        Open a new connection to the storage.
+
+        :returns: The connection
+        """
+        raise NotImplementedError('_open_connection')
+
+    def _is_connection_alive(self, connection):
+        """
+        Check that a pooled connection can still be used.
+
+        :returns: True if the connection is usable
+        :rtype: bool
+        """
+        return True
+
+    def _close_connection(self, connection):
+        """
+        Close a connection to the storage.
+        """
+        pass
+
+    def _get_pool_key(self):
+        """
+        Key under which the connections of this StorageAdapter are pooled.
+        All the StorageAdapters with the same resolved storage configuration share their connections.
+
+        :returns: The key
+        :rtype: tuple
+        """
+        return (self.__class__.__name__,) + tuple(self._config.get(config_key.name) for config_key in self._config_keys)
+
+    def _acquire_connection(self):
+        """
+        Get a connection from the process-wide connection pool, or a new connection if pooling is disabled (pool_size = 0)
+
+        :returns: The connection
+        """
+        if not self._config.get(POOL_SIZE):
+            return self._open_connection()
+
+        return connection_pool.acquire(
+            self._get_pool_key(),
+            self._open_connection,
+            self._is_connection_alive,
+            self._close_connection,
+            self._config[POOL_MAX_IDLE_TIME]
+        )
+
+    def _release_connection(self, connection):
+        """
+        Give a connection back to the process-wide connection pool, or close it if pooling is disabled (pool_size = 0)
+
+        :returns: None
+        :rtype: None
+        """
+        if not self._config.get(POOL_SIZE):
+            self._close_connection(connection)
+            return
+
+        connection_pool.release(
+            self._get_pool_key(),
+            connection,
+            self._close_connection,
+            self._config[POOL_SIZE],
+            self._config[POOL_MAX_IDLE_TIME]
+        )
+
     # tested
     def __enter__(self):
         """
@@ -160,6 +245,19 @@ class StorageAdapterBase(object):
         """
         raise NotImplementedError('get_remote_filelist')
 
+    def iter_remote_files(self, folder=None):
+        """
+        Iterate lazily over the files in the current directory
+
+        :param folder: Full path on the remote server
+        :type folder: str or unicode
+
+        :returns: Generator of the files in the directory (excluding '.' and '..')
+        :rtype: generator of RemoteFile
+        """
+        for filename in self.get_remote_filelist(folder):
+            yield RemoteFile(filename, None, None, None)
+
     def get_remote_dirlist(self, folder=None):
         """
         List files and sub-directories in the current directory
@@ -214,6 +312,46 @@ class StorageAdapterBase(object):
         """
         raise NotImplementedError('get_modified_date')
 
+    def get_remote_file_metadata(self, folder=None, filter_regex=None):
+        """
+        Get the metadata of all files in a remote folder from a single listing,
+        instead of requesting the modified date of each file separately
+
+        :param folder: Remote folder
+        :type folder: str or unicode
+        :param filter_regex: Only files matching this regex are returned
+        :type filter_regex: str or unicode or compiled regex
+
+        :returns: Metadata of the files by filename
+        :rtype: dict of RemoteFile
+        """
+        metadata = {}
+        for remote_file in self.iter_remote_files(folder):
+            if filter_regex and not re.match(filter_regex, remote_file.name):
+                continue
+
+            # fall back to a request per file if the listing does not contain the modified date
+            if remote_file.modified_date is None:
+                remote_file = remote_file._replace(modified_date=self.get_modified_date(remote_file.name, folder))
+
+            metadata[remote_file.name] = remote_file
+        return metadata
+
+    def get_remote_file_hash(self, remote_file):
+        """
+        Get a hash of the content of a remote file, prefixed with the name of the algorithm (e.g. 'etag:d5100e...')
+        By default the ETag of the listing is used, if the storage provides one.
+
+        :param remote_file: The file, as returned by iter_remote_files
+        :type remote_file: RemoteFile
+
+        :returns: The hash, None if the storage cannot provide one
+        :rtype: str
+        """
+        if remote_file.etag:
+            return 'etag:%s' % remote_file.etag
+        return None
+
     def get_local_path(self):
         return self._config[LOCAL_PATH]
 
@@ -235,7 +373,9 @@ class StorageAdapterBase(object):
 
     def fetch(self, filename, localpath=None):
         """
-        Fetch a single file from the remote server
+        Fetch a single file from the remote server.
+        The file is downloaded to localpath + PARTIAL_DOWNLOAD_EXTENSION first and continued there by the next call
+        if the download fails.
 
         :param filename: File to fetch
         :type filename: str or unicode
@@ -247,6 +387,139 @@ class StorageAdapterBase(object):
         """
         raise NotImplementedError('fetch')
 
+    def open_remote_file(self, filename):
+        """
+        Open a file of the remote server for reading, without storing it on the local disk.
+        The connection is busy with the transfer until the file is closed.
+
+        :param filename: File to open
+        :type filename: str or unicode
+
+        :returns: The remote file
+        :rtype: StreamingFile
+        """
+        raise NotImplementedError('open_remote_file')
+
+    def _get_partial_download(self, localpath):
+        """
+        Get the path of the partial download of a local file, and the number of bytes already downloaded
+
+        :param localpath: Local path of the file to download
+        :type localpath: str or unicode
+
+        :returns: The path of the partial download and the offset to continue the download at
+        :rtype: tuple
+        """
+        if self.partial_download_dir:
+            partpath = os.path.join(self.partial_download_dir, os.path.basename(localpath) + PARTIAL_DOWNLOAD_EXTENSION)
+        else:
+            partpath = localpath + PARTIAL_DOWNLOAD_EXTENSION
+        if os.path.isfile(partpath):
+            offset = os.path.getsize(partpath)
+            if offset:
+                log.info('Continuing download of %s at byte %d' % (localpath, offset))
+            return partpath, offset
+        return partpath, 0
+
+    def _complete_partial_download(self, partpath, localpath):
+        """
+        Move a finished partial download to its final path
+
+        :returns: None
+        :rtype: None
+        """
+        os.rename(partpath, localpath)
+
+    def keep_partial_downloads(self, key):
+        """
+        Keep the partial downloads in a folder of the local path that is not removed at the end of a harvest job,
+        instead of next to the downloaded files. A download that failed can then be continued by the next job.
+        Whether it is continued is still checked against the size and the modification date of the remote file.
+
+        :param key: Key of the folder, e.g. the id of the harvest source
+        :type key: str or unicode
+
+        :returns: None
+        :rtype: None
+        """
+        self.partial_download_dir = os.path.join(self.get_local_path(), PARTIAL_DOWNLOAD_FOLDER, key)
+        self.create_local_dir(self.partial_download_dir)
+
+    def fetch_many(self, filenames, target_dir, concurrency=4):
+        """
+        Fetch multiple files concurrently from the remote server.
+        Each worker thread opens its own connection once and keeps it for all the files it fetches.
+
+        :param filenames: Files to fetch
+        :type filenames: list
+        :param target_dir: Local folder to store the files
+        :type target_dir: str or unicode
+        :param concurrency: Number of worker threads (and connections)
+        :type concurrency: int
+
+        :returns: Status of the operation by filename. If a file could not be fetched, the status is the exception.
+        :rtype: dict
+        """
+        pending = Queue.Queue()
+        for filename in filenames:
+            pending.put(filename)
+
+        results = {}
+
+        workers = []
+        for i in range(max(1, min(concurrency, len(filenames)))):
+            thread = threading.Thread(target=self._clone()._fetch_pending, args=(pending, target_dir, results),
+                                      name='fetch-worker-%d' % i)
+            thread.start()
+            workers.append(thread)
+        for thread in workers:
+            thread.join()
+
+        # files that have not been fetched because all workers failed to connect
+        for filename in filenames:
+            if filename not in results:
+                results[filename] = Exception('File {} has not been fetched'.format(filename))
+
+        return results
+
+    def _fetch_pending(self, pending, target_dir, results):
+        """
+        Worker of fetch_many: connect once, then fetch the files of the queue until it is empty
+
+        :param pending: Files to fetch, shared by the workers
+        :type pending: Queue.Queue
+        :param target_dir: Local folder to store the files
+        :type target_dir: str or unicode
+        :param results: Status of the operation by filename, or the exception, filled by the workers
+        :type results: dict
+        """
+        try:
+            with self:
+                while True:
+                    try:
+                        filename = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        results[filename] = self.fetch(filename, os.path.join(target_dir, filename))
+                    except Exception as e:
+                        log.exception('Error fetching file %s' % filename)
+                        results[filename] = e
+        except Exception:
+            # the worker could not connect, the remaining workers continue with the pending files
+            log.exception('Error connecting fetch worker')
+
+    def _clone(self):
+        """
+        Create a new, not yet connected, instance of this StorageAdapter with the same configuration
+
+        :returns: Instance of the same StorageAdapter class
+        :rtype: StorageAdapterBase
+        """
+        clone = self.__class__(self._ckan_config_resolver, self._config, self.remote_folder)
+        clone.partial_download_dir = self.partial_download_dir
+        return clone
+
     # tested
     def unzip(self, filepath):
         """
@@ -276,6 +549,7 @@ class StorageAdapterBase(object):
         For each config_key in the array config_keys, this method will
             - Read the raw value from the CKAN configuration file, using the prefix to create the correct name (eg: ckan.ftp.main_server.host)
             - If the config key is marked as mandatory, it will validate that there is a value, raise an error otherwise
+            - If there is no value and the config key has a default value, the default value is stored
             - Try to convert the value to the required type, raise an error otherwise
             - Validate constraints, if exists, on the value (eg: x > 0), raise an error otherwise. 
             - Store the converted value in the config object if none of the above raised an error
@@ -288,6 +562,11 @@ class StorageAdapterBase(object):
             if config_key.is_mandatory and (raw_value is None or len(raw_value) == 0):
                 configuration_errors.append("Configuration is missing the field {key}".format(key=config_key.name))
                 continue
+
+            # optional fields with a default value do not need to be present in the configuration file
+            if config_key.default_value is not None and (raw_value is None or len(raw_value) == 0):
+                self._config[config_key.name] = config_key.default_value
+                continue
             
             converted_value = None
             
@@ -0,0 +1,94 @@
+"""
+Streaming File
+==============
+
+Read only file object over a byte stream of known size (a remote file or a local one),
+computing the hash and counting the bytes while they are read, e.g.
+`
+    upload = cgi.FieldStorage()
+    upload.file = StreamingFile(response['Body'], response['ContentLength'])
+`
+The CKAN uploader seeks to the end of the file to get its size, and back to the start before copying it.
+These are the only moves supported, so the stream is read only once, sequentially.
+"""
+import hashlib
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+class StreamingFile(object):
+
+    def __init__(self, stream, size, hash_algorithm='md5'):
+        """
+        :param stream: Object with a read method, e.g. a socket file or the body of a S3 response
+        :param size: Number of bytes of the stream, None if unknown
+        :type size: int
+        :param hash_algorithm: Name of the hashlib algorithm used to compute the hash
+        :type hash_algorithm: str
+        """
+        self.size = size
+        self.bytes_read = 0
+        self._stream = stream
+        self._hash = hashlib.new(hash_algorithm)
+        self._position = 0
+        self._close_callbacks = []
+
+    def read(self, size=-1):
+        """
+        Read at most size bytes, all the remaining ones if size is negative
+
+        :raises IOError: if the stream ends before the expected size
+        """
+        if size is None or size < 0:
+            data = self._stream.read()
+        else:
+            data = self._stream.read(size)
+
+        if not data and size != 0 and self.size is not None and self.bytes_read < self.size:
+            raise IOError('Stream ended after %d bytes, %d bytes expected' % (self.bytes_read, self.size))
+
+        self._hash.update(data)
+        self.bytes_read += len(data)
+        self._position = self.bytes_read
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END and offset == 0:
+            self._position = self.size
+        elif whence == os.SEEK_SET and offset == self.bytes_read:
+            self._position = offset
+        else:
+            raise IOError('A StreamingFile can only seek to its end or to the current read position')
+
+    def tell(self):
+        return self._position
+
+    def hexdigest(self):
+        """
+        Hash of the bytes read so far
+
+        :rtype: str
+        """
+        return self._hash.hexdigest()
+
+    def on_close(self, callback):
+        """
+        Register a function called when the file is closed, e.g. to release the storage connection
+        """
+        self._close_callbacks.append(callback)
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            for callback in self._close_callbacks:
+                callback()
+            self._close_callbacks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -6,14 +6,9 @@ from datetime import datetime
 from operator import itemgetter
 
 import os
-import re
 from ckan.lib.helpers import json
-from ckan.lib.munge import munge_filename
-from ckan.logic import NotFound
-from ckan.model import Session
-from ckan import model
 from ckan.plugins.toolkit import config as ckanconf
-from ckanext.harvest.model import HarvestJob, HarvestObject
+from ckanext.harvest.model import HarvestObject
 from ckanext.switzerland.harvester.base_sbb_harvester import validate_regex
 from ckanext.switzerland.harvester.sbb_harvester import SBBHarvester
 from ckanext.switzerland.harvester import infoplus
@@ -30,6 +25,7 @@ class TimetableHarvester(SBBHarvester):
     filters = {
         'infoplus': infoplus.file_filter,
     }
+    additional_formats = tuple(extension.lstrip('.').upper() for extension in infoplus.COLUMNAR_FORMATS.values())
 
     # tested
     def info(self):
@@ -66,9 +62,7 @@ class TimetableHarvester(SBBHarvester):
         log.info('In %s Harvester gather_stage' % self.harvester_name)  # harvest_job.source.url
 
         # set harvester config
-        self.config = self.load_config(harvest_job.source.config)
-
-        modified_dates = {}
+        self.config = self._load_source_config(harvest_job.source)
 
         # get a listing of all files in the target directory
 
@@ -77,14 +71,15 @@ class TimetableHarvester(SBBHarvester):
 
         try:
             with StorageAdapterFactory(ckanconf).get_storage_adapter(remotefolder, self.config) as storage:
-                filelist = storage.get_remote_filelist()
-                log.info("Remote dirlist: %s" % str(filelist))
-
-                filelist = filter(lambda filename: re.match(self.config['filter_regex'], filename), filelist)
+                # get the files matching the filter and their last-modified date from a single listing
+                remote_files = storage.get_remote_file_metadata(filter_regex=self._regexes['filter_regex'])
+                filelist = sorted(remote_files.keys())
+                log.info('Found %d remote files', len(filelist))
+                self._log_detail('Remote dirlist: %s', filelist)
 
-                # get last-modified date of each file
-                for f in filelist:
-                    modified_dates[f] = storage.get_modified_date(f)
+                file_hashes = {}
+                if self.config['change_detection'] == 'hash':
+                    file_hashes = dict((f, storage.get_remote_file_hash(remote_files[f])) for f in filelist)
 
                 # store some config for the next step
 
@@ -121,7 +116,7 @@ class TimetableHarvester(SBBHarvester):
 
         filelist_with_dataset = []
         for filename in filelist:
-            match = re.match(self.config['timetable_regex'], filename)
+            match = self._regexes['timetable_regex'].match(filename)
             if match:
                 dataset = self.config['dataset'].format(year=match.group(1))
                 filelist_with_dataset.append((filename, dataset))
@@ -131,50 +126,16 @@ class TimetableHarvester(SBBHarvester):
         object_ids = []
 
         # ------------------------------------------------------
-        # 1: only download the resources that have been modified
-        # has there been a previous run and was it successful?
-        previous_job = Session.query(HarvestJob) \
-            .filter(HarvestJob.source == harvest_job.source) \
-            .filter(HarvestJob.gather_finished.isnot(None)) \
-            .filter(HarvestJob.id != harvest_job.id) \
-            .order_by(HarvestJob.gather_finished.desc()) \
-            .limit(1).first()
-        if previous_job and not previous_job.gather_errors and previous_job.gather_started:
-            # optional 'force_all' config setting can be used to always download all files
-            force_all = self.config.get('force_all', False)
-
-            if not force_all:
-                # Request only the resources modified since last harvest job
-                for f in filelist_with_dataset[:]:
-                    filename, dataset = f
-                    modified_date = modified_dates.get(filename)
-
-                    try:
-                        context = {'model': model, 'session': Session, 'user': self._get_user_name()}
-                        existing_dataset = self._get_dataset(dataset)
-                    except NotFound:
-                        continue  # dataset for this year does not exist yet
-                    package = model.Package.get(existing_dataset['id'])
-                    existing_resources = map(lambda r: os.path.basename(r.url), package.resources_all)
-
-                    log.info('Existing resources on dataset with id {}: {}'.format(
-                        existing_dataset['id'], existing_resources)
-                    )
-
-                    # skip file if its older than last harvester run date and it actually exists on the dataset
-                    # only skip when file was already downloaded once
-                    if modified_date and modified_date < previous_job.gather_started and \
-                            munge_filename(os.path.basename(filename)) in existing_resources:
-                        # do not run the harvest for this file
-                        filelist_with_dataset.remove(f)
-
-                if not len(filelist_with_dataset):
-                    log.info('No files have been updated on the ftp/s3 aws server since the last harvest job')
-                    return []  # no files to harvest this time
-            else:
-                log.warning('force_all is activated, downloading all files from ftp/s3 without modification date checking')
-
-            # ------------------------------------------------------
+        # 1: only download the resources that have changed since they were last harvested
+        # optional 'force_all' config setting can be used to always download all files
+        if not self.config['force_all']:
+            filelist_with_dataset = self._skip_unchanged_files(harvest_job, filelist_with_dataset, remote_files,
+                                                               file_hashes)
+            if not len(filelist_with_dataset):
+                log.info('No files have been updated on the ftp/s3 aws server since the last harvest job')
+                return []  # no files to harvest this time
+        else:
+            log.warning('force_all is activated, downloading all files from ftp/s3 without change detection')
 
         infoplus_file = None
         if 'infoplus' in self.config:
@@ -187,13 +148,12 @@ class TimetableHarvester(SBBHarvester):
         for f in filelist_with_dataset:
             obj = HarvestObject(guid=self.harvester_name, job=harvest_job)
             # serialise and store the dirlist
-            obj.content = json.dumps({
-                'type': 'file',
-                'file': f[0],
-                'workingdir': workingdir,
-                'remotefolder': remotefolder,
-                'dataset': f[1],
-            })
+            data = self._get_file_harvest_object_data(f[0], f[1], workingdir, remotefolder)
+            data['file_state'] = self._get_file_state_data(remote_files[f[0]], file_hashes.get(f[0]))
+            if infoplus_file and infoplus_file == f[0]:
+                # the Info+ objects convert the local copy of the zip file, it is downloaded even when streaming
+                data['download'] = True
+            obj.content = json.dumps(data)
             # save it for the next step
             obj.save()
             object_ids.append(obj.id)
@@ -205,10 +165,6 @@ class TimetableHarvester(SBBHarvester):
 
         # ------------------------------------------------------
         # 3: Add finalizer tasks to queue
-        obj = HarvestObject(guid=self.harvester_name, job=harvest_job)
-        obj.content = json.dumps({'type': 'remove_tempdir', 'tempdir': tmpdirbase})
-        obj.save()
-        object_ids.append(obj.id)
 
         # get all (unique) datasets where a new file was found
         datasets = set(map(itemgetter(1), filelist_with_dataset))
@@ -218,6 +174,12 @@ class TimetableHarvester(SBBHarvester):
             obj.content = json.dumps({'type': 'finalizer', 'dataset': dataset})
             obj.save()
             object_ids.append(obj.id)
+
+        # the files are removed after the finalizers, which import them with grouped_import
+        obj = HarvestObject(guid=self.harvester_name, job=harvest_job)
+        obj.content = json.dumps({'type': 'remove_tempdir', 'tempdir': tmpdirbase})
+        obj.save()
+        object_ids.append(obj.id)
         # ------------------------------------------------------
         # send the jobs to the gather queue
         return object_ids
@@ -0,0 +1,89 @@
+# coding: utf-8
+"""
+Identifier index
+================
+
+Resolves the identifiers of the datasets to their package ids with the
+database, instead of a search in Solr. The `identifier` extras of the
+datasets have their own partial index, created by the command
+`paster ogdch initdb`, e.g.
+`
+    get_package_id(identifier)
+    get_packages(identifiers)
+`
+The ids are not cached: the indexed query is as fast as a check of a cached
+id, and it is never outdated by the changes of other processes.
+"""
+import logging
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = 'idx_ogdch_package_extra_identifier'
+# number of identifiers resolved by one query of get_packages
+QUERY_SIZE = 500
+
+
+def setup():
+    """
+    Create the partial index of the identifier extras if it does not exist
+    yet. Called by the command `paster ogdch initdb` only.
+    """
+    with model.meta.engine.begin() as connection:
+        exists = connection.execute(
+            "SELECT 1 FROM pg_indexes WHERE indexname = %s", INDEX_NAME
+        ).first()
+        if not exists:
+            connection.execute(
+                "CREATE INDEX %s ON package_extra (value) "
+                "WHERE key = 'identifier'" % INDEX_NAME
+            )
+            log.info('Created index %s', INDEX_NAME)
+
+
+def get_package_id(identifier):
+    """
+    Get the id of the active dataset with the given identifier
+
+    :returns: The package id, None if there is no dataset with this identifier
+    :rtype: str
+    """
+    row = _query_packages([identifier]).first()
+    return row.package_id if row is not None else None
+
+
+def get_packages(identifiers):
+    """
+    Get the id and name of the active datasets with the given identifiers,
+    public or private, with one query per QUERY_SIZE identifiers
+
+    :param identifiers: The identifiers of the datasets
+    :type identifiers: iterable of str
+
+    :returns: The id and name of the dataset of every identifier, the
+              identifiers without dataset are missing
+    :rtype: dict of dict
+    """
+    identifiers = list(set(identifiers))
+    packages = {}
+    for i in range(0, len(identifiers), QUERY_SIZE):
+        for row in _query_packages(identifiers[i:i + QUERY_SIZE]):
+            packages[row.identifier] = {
+                'id': row.package_id,
+                'name': row.name,
+                'identifier': row.identifier,
+            }
+    return packages
+
+
+def _query_packages(identifiers):
+    return model.Session.query(model.PackageExtra.value.label('identifier'),
+                               model.PackageExtra.package_id,
+                               model.Package.name) \
+        .join(model.Package, model.Package.id == model.PackageExtra.package_id) \
+        .filter(model.PackageExtra.key == 'identifier') \
+        .filter(model.PackageExtra.value.in_(identifiers)) \
+        .filter(model.PackageExtra.state == 'active') \
+        .filter(model.Package.state == 'active') \
+        .filter(model.Package.type == 'dataset')
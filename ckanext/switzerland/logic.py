@@ -9,6 +9,7 @@ from ckan.logic import NotFound, ValidationError
 from ckan.plugins.toolkit import get_or_bust, side_effect_free
 from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestSource
 from ckanext.switzerland.helpers import get_content_headers
+from ckanext.switzerland import identifier_index
 
 log = logging.getLogger(__name__)
 
@@ -95,16 +96,36 @@ def ogdch_dataset_terms_of_use(context, data_dict):
 
 @side_effect_free
 def ogdch_dataset_by_identifier(context, data_dict):
+    """
+    Return the dataset with the given identifier. The identifier is resolved
+    with the database (see identifier_index), not with a search in Solr.
+    The callers which only need the id use identifier_index.get_package_id
+    instead.
+    """
     user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
     context.update({'user': user['name']})
     identifier = get_or_bust(data_dict, 'identifier')
 
-    param = 'identifier:"%s"' % identifier
-    result = tk.get_action('package_search')(context, {'fq': param})
-    try:
-        return result['results'][0]
-    except (KeyError, IndexError, TypeError):
+    package_id = identifier_index.get_package_id(identifier)
+    if package_id is None:
         raise NotFound
+    dataset = tk.get_action('package_show')(context, {'id': package_id})
+    if dataset.get('identifier') != identifier:
+        # changed since the id was resolved
+        raise NotFound
+    return dataset
+
+
+@side_effect_free
+def ogdch_datasets_by_identifier(context, data_dict):
+    """
+    Return the id and name of the active datasets (public or private) with
+    the given identifiers, resolved with the database in batches (see
+    identifier_index) instead of a search in Solr. Identifiers without a
+    dataset are missing in the result.
+    """
+    identifiers = get_or_bust(data_dict, 'identifiers')
+    return identifier_index.get_packages(identifiers)
 
 
 def ogdch_cleanup_harvestjobs(context, data_dict):
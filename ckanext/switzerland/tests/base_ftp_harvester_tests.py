@@ -12,6 +12,7 @@ from ckanext.harvest import model as harvester_model
 from ckanext.harvest.tests.factories import HarvestJobObj
 from ckanext.harvest.tests.factories import HarvestSourceObj
 from ckanext.harvest.tests.lib import run_harvest_job
+from ckanext.switzerland.harvester import filestore_gc, harvest_state
 from fs.memoryfs import MemoryFS
 from nose.tools import assert_equal
 
@@ -22,7 +23,8 @@ class BaseSBBHarvesterTests(object):
     harvester_class = None
 
     def run_harvester(self, force_all=False, resource_regex=None, max_resources=None, dataset=data.dataset_name,
-                      timetable_regex=None, filter_regex=None, max_revisions=None, infoplus=None, ist_file=None):
+                      timetable_regex=None, filter_regex=None, max_revisions=None, infoplus=None, ist_file=None,
+                      grouped_import=None, defer_file_cleanup=None, streaming=None, object_errors=0):
         data.harvest_user()
         self.user = data.user()
         self.organization = data.organization(self.user)
@@ -50,6 +52,12 @@ class BaseSBBHarvesterTests(object):
             config['infoplus'] = infoplus
         if ist_file:
             config['ist_file'] = ist_file
+        if grouped_import:
+            config['grouped_import'] = grouped_import
+        if defer_file_cleanup:
+            config['defer_file_cleanup'] = defer_file_cleanup
+        if streaming:
+            config['streaming'] = streaming
 
         source = HarvestSourceObj(url='http://example.com/harvest', config=json.dumps(config),
                                   source_type=harvester.info()['name'], owner_org=self.organization['id'])
@@ -58,7 +66,7 @@ class BaseSBBHarvesterTests(object):
         run_harvest_job(job, harvester)
 
         assert_equal(harvester_model.HarvestGatherError.count(), 0)
-        assert_equal(harvester_model.HarvestObjectError.count(), 0)
+        assert_equal(harvester_model.HarvestObjectError.count(), object_errors)
 
     def get_dataset(self, name=data.dataset_name):
         return get_action('ogdch_dataset_by_identifier')({}, {'identifier': name})
@@ -95,6 +103,9 @@ class BaseSBBHarvesterTests(object):
 
     def _cleanup(self):
         model.repo.rebuild_db()  # clear database
+        # tables of the extension, see paster ogdch initdb
+        harvest_state.setup()
+        filestore_gc.setup()
         search.clear_all()  # clear solr search index
         if os.path.exists('/tmp/ckan_storage_path/'):
             shutil.rmtree('/tmp/ckan_storage_path/')
@@ -115,7 +115,7 @@ def dataset(slug=None):
 
 
 def resource(dataset, filename='filenamethatshouldnotmatch.csv'):
-    factories.Resource(package_id=dataset['id'],
+    return factories.Resource(package_id=dataset['id'],
                        identifier='AAAResource',
                        title={'de': 'AAAResource', 'en': 'AAAResource', 'fr': 'AAAResource',
                               'it': 'AAAResource'},
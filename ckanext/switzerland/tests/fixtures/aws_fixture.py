@@ -18,7 +18,7 @@ FILES_AT_ROOT = {
         'RetryAttempts': 0
     },
     'IsTruncated': False,
-    'Marker': '',
+    'KeyCount': 4,
     'Contents': [
         {
             'Key': 'file_01.pdf',
@@ -73,7 +73,7 @@ FILES_AT_FOLDER = {
         'RetryAttempts': 0
     },
     'IsTruncated': False,
-    'Marker': '',
+    'KeyCount': 5,
     'Contents': [
         {
             'Key': 'a/',
@@ -144,7 +144,7 @@ ALL = {
         'RetryAttempts': 0
     },
     'IsTruncated': False,
-    'Marker': '',
+    'KeyCount': 11,
     'Contents': [
         {
             'Key': 'a/',
@@ -283,7 +283,7 @@ ALL_AT_FOLDER = {
         'RetryAttempts': 0
     }, 
     'IsTruncated': False, 
-    'Marker': '', 
+    'KeyCount': 6,
     'Contents': [
         {
             'Key': 'a/', 
@@ -355,6 +355,58 @@ ALL_AT_FOLDER = {
 NO_CONTENT = {
 }
 
+FILES_AT_FOLDER_PAGE_1 = {
+    'IsTruncated': True,
+    'KeyCount': 2,
+    'NextContinuationToken': '1ueGcxLPRx1Tr/XYExHnhbYLgveDs2J/wm36Hy4vbOwM=',
+    'Contents': [
+        {
+            'Key': 'a/',
+            'LastModified': datetime.datetime(2022, 12, 21, 13, 52, 31, tzinfo=tzutc()),
+            'ETag': '"d41d8cd98f00b204e9800998ecf8427e"',
+            'Size': 0,
+            'StorageClass': 'STANDARD'
+        },
+        {
+            'Key': 'a/a_file_05.pdf',
+            'LastModified': datetime.datetime(2022, 12, 21, 13, 53, 8, tzinfo=tzutc()),
+            'ETag': '"0b6858a853073a7e5a3edb54a51154b1"',
+            'Size': 418809,
+            'StorageClass': 'STANDARD'
+        }
+    ],
+    'Name': 'bpy-odp-test',
+    'Prefix': 'a/',
+    'Delimiter': '/',
+    'MaxKeys': 2,
+    'EncodingType': 'url'
+}
+
+FILES_AT_FOLDER_PAGE_2 = {
+    'IsTruncated': False,
+    'KeyCount': 2,
+    'ContinuationToken': '1ueGcxLPRx1Tr/XYExHnhbYLgveDs2J/wm36Hy4vbOwM=',
+    'Contents': [
+        {
+            'Key': 'a/file_03.pdf',
+            'LastModified': datetime.datetime(2022, 12, 21, 13, 53, 9, tzinfo=tzutc()),
+            'ETag': '"9a45adfaa943bba12b0925695efd01e1"',
+            'Size': 418810,
+            'StorageClass': 'STANDARD'
+        }
+    ],
+    'Name': 'bpy-odp-test',
+    'Prefix': 'a/',
+    'Delimiter': '/',
+    'MaxKeys': 2,
+    'CommonPrefixes': [
+        {
+            'Prefix': 'a/sub_a/'
+        }
+    ],
+    'EncodingType': 'url'
+}
+
 HEAD_FILE_AT_FOLDER = {
     'ResponseMetadata': {
         'RequestId': 'N1BMBN9RRV02KCP0', 
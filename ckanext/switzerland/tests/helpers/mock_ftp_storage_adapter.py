@@ -1,6 +1,9 @@
 import os
+from io import BytesIO
 
 from ckanext.switzerland.harvester.ftp_helper import FTPStorageAdapter
+from ckanext.switzerland.harvester.storage_adapter_base import RemoteFile
+from ckanext.switzerland.harvester.streaming_file import StreamingFile
 
 
 class MockFTPStorageAdapter(FTPStorageAdapter):
@@ -25,6 +28,13 @@ class MockFTPStorageAdapter(FTPStorageAdapter):
             folder = self.cwd
         return self.filesystem.listdir(folder, files_only=True)
 
+    def iter_remote_files(self, folder=None):
+        if folder is None:
+            folder = self.cwd
+        for filename in self.get_remote_filelist(folder):
+            info = self.filesystem.getinfo(os.path.join(folder, filename))
+            yield RemoteFile(filename, info.get('size'), None, info.get('modified_time'))
+
     def get_remote_dirlist(self, folder=None):
         if folder is None:
             folder = self.cwd
@@ -45,3 +55,7 @@ class MockFTPStorageAdapter(FTPStorageAdapter):
         localfile.write(content)
         localfile.close()
         return '226 Transfer complete'
+
+    def open_remote_file(self, filename):
+        content = self.filesystem.getcontents(os.path.join(self.cwd, filename))
+        return StreamingFile(BytesIO(content), len(content))
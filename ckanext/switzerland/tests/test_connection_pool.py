@@ -0,0 +1,112 @@
+import unittest
+
+from nose.tools import assert_equal
+from mock import Mock, patch
+
+# The classes to test
+# -----------------------------------------------------------------------
+from ckanext.switzerland.harvester.connection_pool import ConnectionPool
+# -----------------------------------------------------------------------
+
+KEY = ('FTPStorageAdapter', 'ftp.example.com', 990)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_acquire_when_pool_empty_then_new_connection(self):
+        pool = ConnectionPool()
+        connect = Mock(return_value='connection')
+
+        connection = pool.acquire(KEY, connect, Mock(return_value=True), Mock(), 60)
+
+        assert_equal(connection, 'connection')
+        assert_equal(connect.call_count, 1)
+
+    def test_acquire_after_release_then_connection_is_reused(self):
+        pool = ConnectionPool()
+        connect = Mock(side_effect=['first', 'second'])
+        is_alive = Mock(return_value=True)
+        close = Mock()
+
+        connection = pool.acquire(KEY, connect, is_alive, close, 60)
+        pool.release(KEY, connection, close, 2)
+        reused = pool.acquire(KEY, connect, is_alive, close, 60)
+
+        assert_equal(reused, 'first')
+        assert_equal(connect.call_count, 1)
+        is_alive.assert_called_once_with('first')
+        assert not close.called
+
+    def test_acquire_when_other_key_then_connection_is_not_shared(self):
+        pool = ConnectionPool()
+        close = Mock()
+        pool.release(KEY, 'first', close, 2)
+
+        connection = pool.acquire(('S3StorageAdapter', 'bucket'), Mock(return_value='second'), Mock(return_value=True), close, 60)
+
+        assert_equal(connection, 'second')
+        assert_equal(pool.size(KEY), 1)
+
+    def test_acquire_when_connection_dead_then_closed_and_replaced(self):
+        pool = ConnectionPool()
+        close = Mock()
+        pool.release(KEY, 'dead', close, 2)
+
+        connection = pool.acquire(KEY, Mock(return_value='new'), Mock(return_value=False), close, 60)
+
+        assert_equal(connection, 'new')
+        close.assert_called_once_with('dead')
+
+    def test_acquire_when_connection_idle_too_long_then_closed_and_replaced(self):
+        pool = ConnectionPool()
+        close = Mock()
+        is_alive = Mock(return_value=True)
+        with patch('time.time', return_value=1000):
+            pool.release(KEY, 'old', close, 2)
+        with patch('time.time', return_value=1061):
+            connection = pool.acquire(KEY, Mock(return_value='new'), is_alive, close, 60)
+
+        assert_equal(connection, 'new')
+        close.assert_called_once_with('old')
+        # no need to check the liveness of an evicted connection
+        assert not is_alive.called
+
+    def test_release_when_pool_full_then_connection_is_closed(self):
+        pool = ConnectionPool()
+        close = Mock()
+
+        pool.release(KEY, 'first', close, 1)
+        pool.release(KEY, 'second', close, 1)
+
+        assert_equal(pool.size(KEY), 1)
+        close.assert_called_once_with('second')
+
+    def test_release_then_expired_connections_are_evicted(self):
+        pool = ConnectionPool()
+        close = Mock()
+        with patch('time.time', return_value=1000):
+            pool.release(KEY, 'old', close, 2, 60)
+        with patch('time.time', return_value=1061):
+            pool.release(KEY, 'recent', close, 2, 60)
+
+        assert_equal(pool.size(KEY), 1)
+        close.assert_called_once_with('old')
+
+    def test_release_when_close_fails_then_no_exception(self):
+        pool = ConnectionPool()
+        close = Mock(side_effect=EOFError())
+
+        pool.release(KEY, 'connection', close, 0)
+
+        close.assert_called_once_with('connection')
+
+    def test_clear_then_all_connections_are_closed(self):
+        pool = ConnectionPool()
+        close = Mock()
+        pool.release(KEY, 'first', close, 2)
+        pool.release(KEY, 'second', close, 2)
+
+        pool.clear()
+
+        assert_equal(pool.size(KEY), 0)
+        assert_equal(close.call_count, 2)
@@ -0,0 +1,109 @@
+import shutil
+import time
+import uuid
+
+import ckan.model as model
+import os
+from ckan.lib import search
+from ckan.lib import uploader
+from mock import patch
+from nose.tools import assert_equal, assert_false, assert_true
+
+# The classes to test
+# -----------------------------------------------------------------------
+from ckanext.switzerland.harvester import filestore_gc
+# -----------------------------------------------------------------------
+
+from . import data
+
+STORAGE_PATH = '/tmp/ckan_storage_path/'
+
+
+class TestFilestoreGC(object):
+
+    def _cleanup(self):
+        model.repo.rebuild_db()
+        filestore_gc.setup()
+        search.clear_all()
+        if os.path.exists(STORAGE_PATH):
+            shutil.rmtree(STORAGE_PATH)
+
+    def setUp(self):
+        self._cleanup()
+
+    def teardown(self):
+        self._cleanup()
+
+    def create_file(self, resource_id=None, age=filestore_gc.SCAN_MIN_AGE * 2):
+        resource_id = resource_id or str(uuid.uuid4())
+        path = uploader.ResourceUpload({}).get_path(resource_id)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write('content of %s' % resource_id)
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+        return resource_id, path
+
+    def create_active_resource(self):
+        data.user()
+        return data.resource(data.dataset())['id']
+
+    def test_mark_then_marked_once(self):
+        assert_equal(filestore_gc.mark(['a', 'b', 'a']), 2)
+        assert_equal(filestore_gc.mark(['b', 'c']), 1)
+        assert_equal(filestore_gc.mark([]), 0)
+
+    def test_collect_dryrun_then_files_kept(self):
+        id1, path1 = self.create_file()
+        id2, path2 = self.create_file()
+        filestore_gc.mark([id1, id2])
+
+        assert_equal(filestore_gc.collect(dryrun=True), (2, 0))
+        assert_true(os.path.exists(path1))
+        assert_true(os.path.exists(path2))
+
+    def test_collect_then_files_of_active_resources_kept(self):
+        active_id, active_path = self.create_file(self.create_active_resource())
+        orphan_id, orphan_path = self.create_file()
+        filestore_gc.mark([active_id, orphan_id])
+
+        assert_equal(filestore_gc.collect(batch_size=1), (2, 1))
+        assert_true(os.path.exists(active_path))
+        assert_false(os.path.exists(orphan_path))
+        # the collected marks are not processed again
+        assert_equal(filestore_gc.collect(), (0, 0))
+
+    def test_collect_with_rate_limit_then_sleeps_per_batch(self):
+        filestore_gc.mark([self.create_file()[0] for _ in range(3)])
+
+        with patch.object(filestore_gc.time, 'sleep') as sleep:
+            assert_equal(filestore_gc.collect(batch_size=1, rate_limit=2), (3, 3))
+
+        assert_equal(sleep.call_count, 3)
+        for call in sleep.call_args_list:
+            assert_true(0 <= call[0][0] <= 0.5)
+
+    def test_scan_then_unmarked_orphaned_files_removed(self):
+        _, active_path = self.create_file(self.create_active_resource())
+        _, orphan_path = self.create_file()
+        _, recent_path = self.create_file(age=0)
+
+        assert_equal(filestore_gc.scan(dryrun=True), (3, 1))
+        assert_true(os.path.exists(orphan_path))
+
+        assert_equal(filestore_gc.scan(batch_size=2), (3, 1))
+        assert_true(os.path.exists(active_path))
+        assert_false(os.path.exists(orphan_path))
+        # the file might belong to a resource which is being created
+        assert_true(os.path.exists(recent_path))
+
+    def test_scan_with_rate_limit_then_sleeps_per_batch_with_removed_files(self):
+        for _ in range(2):
+            self.create_file()
+
+        with patch.object(filestore_gc.time, 'sleep') as sleep:
+            assert_equal(filestore_gc.scan(batch_size=1, rate_limit=2), (2, 2))
+
+        assert_equal(sleep.call_count, 2)
+
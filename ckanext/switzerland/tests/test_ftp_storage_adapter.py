@@ -6,12 +6,15 @@ import unittest
 import os
 import shutil
 import ftplib
+import stat
+import datetime
+from io import BytesIO
 
 import logging
 log = logging.getLogger(__name__)
 
 from nose.tools import assert_equal, raises, nottest, with_setup
-from mock import patch, Mock, MagicMock, PropertyMock
+from mock import patch, Mock, MagicMock, PropertyMock, ANY
 from testfixtures import Replace
 
 from helpers.mock_config_resolver import MockConfigResolver
@@ -20,6 +23,8 @@ from ckanext.switzerland.harvester.exceptions.storage_adapter_configuration_exce
 # The classes to test
 # -----------------------------------------------------------------------
 from ckanext.switzerland.harvester.ftp_storage_adapter import FTPStorageAdapter
+from ckanext.switzerland.harvester.connection_pool import connection_pool
+from ckanext.switzerland.harvester.storage_adapter_base import RemoteFile
 # -----------------------------------------------------------------------
 
 CONFIG_SECTION = 'app:main'
@@ -218,7 +223,7 @@ class TestFTPStorageAdapter(unittest.TestCase):
             return 'cwd into %s' % str(folder)
         def quit(self):
             return 'Disconnected'
-        def retrbinary(self, remotepath, filepointer):
+        def retrbinary(self, remotepath, filepointer, blocksize=8192, rest=None):
             return ( remotepath, filepointer )
 
     @patch('ftplib.FTP', autospec=True)
@@ -281,6 +286,433 @@ class TestFTPStorageAdapter(unittest.TestCase):
         # assert_equal(str(type(arg2)), "<type 'builtin_function_or_method'>")
         assert_equal(str(arg2.__class__.__name__), "builtin_function_or_method")
 
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_fetch_with_partial_download(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.size.return_value = 11
+        mock_ftp_tls.sendcmd.return_value = '213 20160621123722'
+        def retrbinary(cmd, callback, blocksize=8192, rest=None):
+            callback('world')
+            return '226 Transfer complete'
+        mock_ftp_tls.retrbinary.side_effect = retrbinary
+        testfile = os.path.join(self.tmpfolder, 'foo.txt')
+
+        with self.__build_tested_object__('/') as ftph:
+            with open(testfile + '.part', 'wb') as f:
+                f.write('hello ')
+            status = ftph.fetch('foo.txt', localpath=testfile)
+
+        assert_equal(status, '226 Transfer complete')
+        mock_ftp_tls.retrbinary.assert_called_once_with('RETR foo.txt', ANY, rest=6)
+        with open(testfile) as f:
+            assert_equal(f.read(), 'hello world')
+        self.assertFalse(os.path.exists(testfile + '.part'))
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_fetch_with_partial_download_when_rest_not_supported(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.size.return_value = 11
+        mock_ftp_tls.sendcmd.return_value = '213 20160621123722'
+        def retrbinary(cmd, callback, blocksize=8192, rest=None):
+            if rest:
+                raise ftplib.error_perm('502 Command not implemented')
+            callback('hello world')
+            return '226 Transfer complete'
+        mock_ftp_tls.retrbinary.side_effect = retrbinary
+        testfile = os.path.join(self.tmpfolder, 'foo.txt')
+
+        with self.__build_tested_object__('/') as ftph:
+            with open(testfile + '.part', 'wb') as f:
+                f.write('hello ')
+            ftph.fetch('foo.txt', localpath=testfile)
+
+        assert_equal(mock_ftp_tls.retrbinary.call_count, 2)
+        with open(testfile) as f:
+            assert_equal(f.read(), 'hello world')
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_fetch_when_failing_then_partial_download_is_kept(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        def retrbinary(cmd, callback, blocksize=8192, rest=None):
+            callback('hello ')
+            raise EOFError()
+        mock_ftp_tls.retrbinary.side_effect = retrbinary
+        testfile = os.path.join(self.tmpfolder, 'foo.txt')
+        if os.path.exists(testfile):
+            os.remove(testfile)
+
+        with self.__build_tested_object__('/') as ftph:
+            self.assertRaises(EOFError, ftph.fetch, 'foo.txt', testfile)
+
+        self.assertFalse(os.path.exists(testfile))
+        with open(testfile + '.part') as f:
+            assert_equal(f.read(), 'hello ')
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_fetch_when_failing_then_partial_download_kept_in_source_folder(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        def retrbinary(cmd, callback, blocksize=8192, rest=None):
+            callback('hello ')
+            raise EOFError()
+        mock_ftp_tls.retrbinary.side_effect = retrbinary
+        workingdir = os.path.join(self.tmpfolder, 'job')
+        partialdir = os.path.join(self.tmpfolder, 'partial_downloads', 'source-id')
+        for folder in [workingdir, partialdir]:
+            shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(workingdir)
+
+        with self.__build_tested_object__('/') as ftph:
+            ftph.keep_partial_downloads('source-id')
+            self.assertRaises(EOFError, ftph.fetch, 'foo.txt', os.path.join(workingdir, 'foo.txt'))
+
+        self.assertFalse(os.path.exists(os.path.join(workingdir, 'foo.txt.part')))
+        with open(os.path.join(partialdir, 'foo.txt.part')) as f:
+            assert_equal(f.read(), 'hello ')
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_fetch_with_partial_download_when_remote_file_changed(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.size.return_value = 11
+        mock_ftp_tls.sendcmd.return_value = '213 20160621123722.123'
+        def retrbinary(cmd, callback, blocksize=8192, rest=None):
+            callback('HELLO WORLD')
+            return '226 Transfer complete'
+        mock_ftp_tls.retrbinary.side_effect = retrbinary
+        testfile = os.path.join(self.tmpfolder, 'foo.txt')
+
+        with self.__build_tested_object__('/') as ftph:
+            with open(testfile + '.part', 'wb') as f:
+                f.write('hello ')
+            # the partial download was written before the remote file was modified
+            os.utime(testfile + '.part', (1466000000, 1466000000))
+            ftph.fetch('foo.txt', localpath=testfile)
+
+        mock_ftp_tls.retrbinary.assert_called_once_with('RETR foo.txt', ANY, rest=None)
+        with open(testfile) as f:
+            assert_equal(f.read(), 'HELLO WORLD')
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_fetch_with_partial_download_larger_than_remote_file(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.size.return_value = 3
+        mock_ftp_tls.sendcmd.return_value = '213 20160621123722'
+        def retrbinary(cmd, callback, blocksize=8192, rest=None):
+            callback('new')
+            return '226 Transfer complete'
+        mock_ftp_tls.retrbinary.side_effect = retrbinary
+        testfile = os.path.join(self.tmpfolder, 'foo.txt')
+
+        with self.__build_tested_object__('/') as ftph:
+            with open(testfile + '.part', 'wb') as f:
+                f.write('hello ')
+            ftph.fetch('foo.txt', localpath=testfile)
+
+        mock_ftp_tls.retrbinary.assert_called_once_with('RETR foo.txt', ANY, rest=None)
+        with open(testfile) as f:
+            assert_equal(f.read(), 'new')
+
+    @patch('pysftp.Connection', autospec=True)
+    def test_fetch_sftp_with_partial_download_when_remote_file_changed(self, MockConnection):
+        remotefile = MockConnection.return_value.open.return_value
+        remotefile.read.side_effect = ['HELLO WORLD', '']
+        MockConnection.return_value.stat.return_value = Mock(st_size=11, st_mtime=1466512642)
+        self.ckan_config_resolver = MockConfigResolver(self.ini_file_path, CONFIG_SECTION)
+        self.ckan_config_resolver._config[CONFIG_SECTION]['ckan.ftp.mainserver.port'] = '22'
+        testfile = os.path.join(self.tmpfolder, 'foo.txt')
+
+        with FTPStorageAdapter(self.ckan_config_resolver, dict(self.config), '/') as ftph:
+            with open(testfile + '.part', 'wb') as f:
+                f.write('hello ')
+            os.utime(testfile + '.part', (1466000000, 1466000000))
+            ftph.fetch('foo.txt', localpath=testfile)
+
+        remotefile.seek.assert_called_once_with(0)
+        with open(testfile) as f:
+            assert_equal(f.read(), 'HELLO WORLD')
+
+    @patch('pysftp.Connection', autospec=True)
+    def test_fetch_sftp_with_partial_download(self, MockConnection):
+        remotefile = MockConnection.return_value.open.return_value
+        MockConnection.return_value.stat.return_value = Mock(st_size=11, st_mtime=1466512642)
+        remotefile.read.side_effect = ['world', '']
+        self.ckan_config_resolver = MockConfigResolver(self.ini_file_path, CONFIG_SECTION)
+        self.ckan_config_resolver._config[CONFIG_SECTION]['ckan.ftp.mainserver.port'] = '22'
+        testfile = os.path.join(self.tmpfolder, 'foo.txt')
+
+        with FTPStorageAdapter(self.ckan_config_resolver, dict(self.config), '/') as ftph:
+            with open(testfile + '.part', 'wb') as f:
+                f.write('hello ')
+            status = ftph.fetch('foo.txt', localpath=testfile)
+
+        assert_equal(status, '226 Transfer complete')
+        MockConnection.return_value.open.assert_called_once_with('foo.txt', 'rb')
+        remotefile.seek.assert_called_once_with(6)
+        with open(testfile) as f:
+            assert_equal(f.read(), 'hello world')
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_open_remote_file(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.size.return_value = 11
+        connection = mock_ftp_tls.transfercmd.return_value
+        connection.makefile.return_value = BytesIO(b'hello world')
+
+        with self.__build_tested_object__('/') as ftph:
+            with ftph.open_remote_file('foo.txt') as remotefile:
+                assert_equal(remotefile.size, 11)
+                assert_equal(remotefile.read(), b'hello world')
+
+        mock_ftp_tls.transfercmd.assert_called_once_with('RETR foo.txt')
+        self.assertTrue(connection.close.called)
+        self.assertTrue(mock_ftp_tls.voidresp.called)
+
+    @patch('pysftp.Connection', autospec=True)
+    def test_open_remote_file_sftp(self, MockConnection):
+        remotefile = MockConnection.return_value.open.return_value
+        remotefile.stat.return_value.st_size = 11
+        remotefile.read.side_effect = [b'hello world', b'']
+        self.ckan_config_resolver = MockConfigResolver(self.ini_file_path, CONFIG_SECTION)
+        self.ckan_config_resolver._config[CONFIG_SECTION]['ckan.ftp.mainserver.port'] = '22'
+
+        with FTPStorageAdapter(self.ckan_config_resolver, dict(self.config), '/') as ftph:
+            with ftph.open_remote_file('foo.txt') as streaming_file:
+                assert_equal(streaming_file.size, 11)
+                assert_equal(streaming_file.read(1024), b'hello world')
+
+        MockConnection.return_value.open.assert_called_once_with('foo.txt', 'rb')
+        self.assertTrue(remotefile.close.called)
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_get_remote_file_metadata_ftps(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mlsd = [
+            'type=cdir;modify=20160621123722; .',
+            'type=dir;modify=20160621123722; subfolder',
+            'type=file;size=1024;modify=20160621123722; filea.txt',
+            'Type=file;Size=2048;Modify=20160622101010.123; fileb.zip',
+        ]
+        mock_ftp_tls.retrlines.side_effect = lambda cmd, callback: map(callback, mlsd)
+
+        with self.__build_tested_object__('/') as ftph:
+            metadata = ftph.get_remote_file_metadata()
+
+        assert_equal(sorted(metadata.keys()), ['filea.txt', 'fileb.zip'])
+        assert_equal(metadata['filea.txt'].size, 1024)
+        assert_equal(metadata['filea.txt'].modified_date, datetime.datetime(2016, 6, 21, 12, 37, 22))
+        assert_equal(metadata['fileb.zip'].modified_date, datetime.datetime(2016, 6, 22, 10, 10, 10))
+        # the modified dates are taken from the listing
+        self.assertFalse(mock_ftp_tls.sendcmd.called)
+
+    def test_get_remote_file_metadata_sftp(self):
+        ftph = self.__build_tested_object__('/test/')
+        ftph.sftp = Mock()
+        ftph.sftp.listdir_attr.return_value = [
+            Mock(filename='subfolder', st_size=0, st_mtime=1667384100, st_mode=stat.S_IFDIR),
+            Mock(filename='filea.txt', st_size=1024, st_mtime=1667384100, st_mode=stat.S_IFREG),
+        ]
+
+        metadata = ftph.get_remote_file_metadata(filter_regex='.*\\.txt')
+
+        ftph.sftp.listdir_attr.assert_called_with('/test')
+        assert_equal(metadata.keys(), ['filea.txt'])
+        assert_equal(metadata['filea.txt'].size, 1024)
+        assert_equal(metadata['filea.txt'].modified_date, datetime.datetime.fromtimestamp(1667384100))
+        self.assertFalse(ftph.sftp.stat.called)
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_get_remote_file_hash(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.sendcmd.return_value = '213 SHA-256 0-49 169CD22282DA7F147CB491E559E9DD filea.txt'
+
+        with self.__build_tested_object__('/') as ftph:
+            file_hash = ftph.get_remote_file_hash(RemoteFile('filea.txt', 50, None, None))
+
+        mock_ftp_tls.sendcmd.assert_called_with('HASH filea.txt')
+        assert_equal(file_hash, 'sha-256:169cd22282da7f147cb491e559e9dd')
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_get_remote_file_hash_when_hash_not_supported_then_xcrc(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        commands = []
+
+        def sendcmd(cmd):
+            commands.append(cmd)
+            if cmd.startswith('HASH'):
+                raise ftplib.error_perm('502 Command not implemented')
+            return '250 B0B45BE4'
+        mock_ftp_tls.sendcmd.side_effect = sendcmd
+
+        with self.__build_tested_object__('/') as ftph:
+            first_hash = ftph.get_remote_file_hash(RemoteFile('filea.txt', 50, None, None))
+            second_hash = ftph.get_remote_file_hash(RemoteFile('fileb.txt', 50, None, None))
+
+        assert_equal(first_hash, 'crc32:b0b45be4')
+        assert_equal(second_hash, 'crc32:b0b45be4')
+        # HASH is not tried again for the second file
+        assert_equal(commands, ['HASH filea.txt', 'XCRC filea.txt', 'XCRC fileb.txt'])
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_get_remote_file_hash_when_not_supported_then_none(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.sendcmd.side_effect = ftplib.error_perm('500 Unknown command')
+
+        with self.__build_tested_object__('/') as ftph:
+            file_hash = ftph.get_remote_file_hash(RemoteFile('filea.txt', 50, None, None))
+
+        assert_equal(file_hash, None)
+
+    def test_get_remote_file_hash_sftp(self):
+        ftph = self.__build_tested_object__('/test/')
+        ftph.sftp = Mock()
+
+        assert_equal(ftph.get_remote_file_hash(RemoteFile('filea.txt', 50, None, None)), None)
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_fetch_many(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        retrieved = []
+        def retrbinary(cmd, callback, blocksize=8192, rest=None):
+            # the call count of the mock is not thread safe, list.append is
+            retrieved.append(cmd)
+            return '226 Transfer complete'
+        mock_ftp_tls.retrbinary.side_effect = retrbinary
+        filenames = ['file%d.txt' % i for i in range(10)]
+
+        ftph = self.__build_tested_object__('/')
+        results = ftph.fetch_many(filenames, self.tmpfolder, concurrency=3)
+
+        assert_equal(sorted(results.keys()), filenames)
+        for status in results.values():
+            assert_equal(status, '226 Transfer complete')
+        # one connection per worker, not per file
+        assert_equal(MockFTP_TLS.call_count, 3)
+        assert_equal(len(retrieved), 10)
+        assert_equal(mock_ftp_tls.quit.call_count, 3)
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_fetch_many_with_error(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.retrbinary.side_effect = ftplib.error_perm('550 File not found')
+
+        ftph = self.__build_tested_object__('/')
+        results = ftph.fetch_many(['missing.txt'], self.tmpfolder, concurrency=2)
+
+        assert isinstance(results['missing.txt'], ftplib.error_perm)
+        # no more workers than files
+        assert_equal(MockFTP_TLS.call_count, 1)
+
+    def __build_pooled_tested_object__(self, remote_dir, pool_size):
+        self.ckan_config_resolver = MockConfigResolver(self.ini_file_path, CONFIG_SECTION)
+        self.ckan_config_resolver._config[CONFIG_SECTION]['ckan.ftp.mainserver.pool_size'] = str(pool_size)
+        return FTPStorageAdapter(self.ckan_config_resolver, dict(self.config), remote_dir)
+
+    def test_pool_size_defaults_to_zero(self):
+        ftph = self.__build_tested_object__('/')
+        assert_equal(ftph._config['pool_size'], 0)
+        assert_equal(ftph._config['pool_max_idle_time'], 60)
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_pooled_connection_is_reused(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        try:
+            with self.__build_pooled_tested_object__('/', 2):
+                pass
+            with self.__build_pooled_tested_object__('/', 2):
+                pass
+
+            # the second adapter got the connection of the first one, after checking it is alive
+            assert_equal(MockFTP_TLS.call_count, 1)
+            mock_ftp_tls.voidcmd.assert_called_once_with('NOOP')
+            self.assertFalse(mock_ftp_tls.quit.called)
+        finally:
+            connection_pool.clear()
+        self.assertTrue(mock_ftp_tls.quit.called)
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_pooled_connection_when_dead_then_reconnect(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.voidcmd.side_effect = EOFError()
+        try:
+            with self.__build_pooled_tested_object__('/', 2):
+                pass
+            with self.__build_pooled_tested_object__('/', 2):
+                pass
+
+            assert_equal(MockFTP_TLS.call_count, 2)
+        finally:
+            connection_pool.clear()
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_open_remote_file_read_to_the_end_then_connection_pooled(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.size.return_value = 11
+        mock_ftp_tls.transfercmd.return_value.makefile.return_value = BytesIO(b'hello world')
+        try:
+            ftph = self.__build_pooled_tested_object__('/', 2)
+            with ftph:
+                with ftph.open_remote_file('foo.txt') as remotefile:
+                    remotefile.read()
+
+            self.assertTrue(mock_ftp_tls.voidresp.called)
+            assert_equal(connection_pool.size(ftph._get_pool_key()), 1)
+        finally:
+            connection_pool.clear()
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_open_remote_file_closed_before_the_end_then_connection_closed(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.size.return_value = 11
+        mock_ftp_tls.transfercmd.return_value.makefile.return_value = BytesIO(b'hello world')
+        try:
+            ftph = self.__build_pooled_tested_object__('/', 2)
+            with ftph:
+                with ftph.open_remote_file('foo.txt') as remotefile:
+                    remotefile.read(5)
+
+            # the pending '426' reply is never read, the connection is not reused
+            self.assertFalse(mock_ftp_tls.voidresp.called)
+            self.assertTrue(mock_ftp_tls.close.called)
+            assert_equal(connection_pool.size(ftph._get_pool_key()), 0)
+
+            with self.__build_pooled_tested_object__('/', 2):
+                pass
+            assert_equal(MockFTP_TLS.call_count, 2)
+        finally:
+            connection_pool.clear()
+
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_fetch_many_with_pool(self, MockFTP_TLS, MockFTP):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.retrbinary.return_value = '226 Transfer complete'
+        filenames = ['file%d.txt' % i for i in range(10)]
+        try:
+            ftph = self.__build_pooled_tested_object__('/', 3)
+            ftph.fetch_many(filenames, self.tmpfolder, concurrency=3)
+            ftph.fetch_many(filenames, self.tmpfolder, concurrency=3)
+
+            # the second batch reuses the connections of the first one
+            self.assertLessEqual(MockFTP_TLS.call_count, 3)
+        finally:
+            connection_pool.clear()
+
     @patch('ftplib.FTP', autospec=True)
     @patch('ftplib.FTP_TLS', autospec=True)
     def test_unzip(self, MockFTP_TLS, MockFTP):
@@ -0,0 +1,98 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+# The classes to test
+# -----------------------------------------------------------------------
+from ckanext.switzerland.harvester import harvest_logging
+# -----------------------------------------------------------------------
+
+
+class TestHarvestLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.logger = logging.getLogger('ckanext.switzerland.test_harvest_logging')
+        self.logger.setLevel(logging.WARNING)
+        self.original_handler = logging.NullHandler()
+        self.logger.handlers = [self.original_handler]
+
+    def tearDown(self):
+        harvest_logging.teardown_job_logging()
+        self.logger.handlers = []
+        shutil.rmtree(self.log_dir)
+
+    def log_file(self, name):
+        return os.path.join(self.log_dir, 'source', name)
+
+    def test_setup_then_records_written_to_job_log(self):
+        harvest_logging.setup_job_logging('job-1', self.log_file('job-1.log'))
+
+        self.assertEqual(logging.DEBUG, self.logger.level)
+        self.logger.debug('Imported %s', 'file.csv')
+        harvest_logging.teardown_job_logging()
+
+        with open(self.log_file('job-1.log')) as f:
+            self.assertIn('[ckanext.switzerland.test_harvest_logging] Imported file.csv', f.read())
+
+    def test_setup_same_job_twice_then_installed_once(self):
+        job_logging = harvest_logging.setup_job_logging('job-1', self.log_file('job-1.log'))
+
+        self.assertIs(job_logging, harvest_logging.setup_job_logging('job-1', self.log_file('job-1.log')))
+        self.assertEqual([job_logging.handler], self.logger.handlers)
+
+    def test_setup_for_the_objects_of_a_job_then_handler_and_listener_reused(self):
+        first = harvest_logging.setup_job_logging('job-1', self.log_file('job-1.log'))
+        listener_thread = first._listener._thread
+
+        second = harvest_logging.setup_job_logging('job-1', self.log_file('job-1.log'))
+
+        self.assertIs(first.handler, second.handler)
+        self.assertIs(listener_thread, second._listener._thread)
+        self.assertTrue(listener_thread.is_alive())
+        self.assertEqual(logging.DEBUG, self.logger.level)
+
+    def test_setup_next_job_then_previous_job_removed(self):
+        first = harvest_logging.setup_job_logging('job-1', self.log_file('job-1.log'))
+        second = harvest_logging.setup_job_logging('job-2', self.log_file('job-2.log'))
+
+        self.assertIsNot(first, second)
+        self.assertEqual([second.handler], self.logger.handlers)
+
+    def test_teardown_then_levels_and_handlers_restored(self):
+        harvest_logging.setup_job_logging('job-1', self.log_file('job-1.log'))
+        harvest_logging.teardown_job_logging()
+
+        self.assertEqual(logging.WARNING, self.logger.level)
+        self.assertEqual([self.original_handler], self.logger.handlers)
+
+    def test_exception_is_formatted_in_the_record(self):
+        harvest_logging.setup_job_logging('job-1', self.log_file('job-1.log'))
+        try:
+            raise ValueError('broken file')
+        except ValueError:
+            self.logger.exception('Import failed')
+        harvest_logging.teardown_job_logging()
+
+        with open(self.log_file('job-1.log')) as f:
+            content = f.read()
+        self.assertIn('Import failed', content)
+        self.assertIn('ValueError: broken file', content)
+
+    def test_setup_with_level_then_ckan_loggers_set_to_level(self):
+        harvest_logging.setup_job_logging('job-1', self.log_file('job-1.log'), logging.INFO)
+
+        self.assertEqual(logging.INFO, self.logger.level)
+
+    def test_counters_are_added_per_dataset_and_reset(self):
+        harvest_logging.count('job-1', 'dataset-a', files_fetched=1, bytes_fetched=10)
+        harvest_logging.count('job-1', 'dataset-a', files_fetched=1, bytes_fetched=5)
+        harvest_logging.count('job-1', 'dataset-b', files_fetched=1)
+
+        counters = harvest_logging.pop_counters('job-1', 'dataset-a')
+
+        self.assertEqual({'files_fetched': 2, 'bytes_fetched': 15}, dict(counters))
+        self.assertEqual({}, dict(harvest_logging.pop_counters('job-1', 'dataset-a')))
+        self.assertEqual({'files_fetched': 1}, dict(harvest_logging.pop_counters('job-1', 'dataset-b')))
@@ -0,0 +1,47 @@
+import unittest
+from datetime import datetime
+
+from mock import Mock
+
+# The classes to test
+# -----------------------------------------------------------------------
+from ckanext.switzerland.harvester.harvest_state import is_unchanged
+# -----------------------------------------------------------------------
+
+MODIFIED = datetime(2016, 9, 1, 12, 0, 0)
+
+
+def file_state(size=1024, file_hash=None, modified_date=MODIFIED):
+    return Mock(size=size, hash=file_hash, modified_date=modified_date)
+
+
+class TestIsUnchanged(unittest.TestCase):
+
+    def test_never_imported_then_changed(self):
+        self.assertFalse(is_unchanged(None, 1024, 'sha-256:abc', MODIFIED))
+
+    def test_same_hash_then_unchanged(self):
+        # the hash wins over a different size or modification date, e.g. a file uploaded again
+        state = file_state(file_hash='sha-256:abc')
+
+        self.assertTrue(is_unchanged(state, 2048, 'sha-256:abc', datetime(2016, 9, 2)))
+
+    def test_different_hash_then_changed(self):
+        state = file_state(file_hash='sha-256:abc')
+
+        self.assertFalse(is_unchanged(state, 1024, 'sha-256:def', MODIFIED))
+
+    def test_hash_unknown_then_size_and_modified_date_compared(self):
+        self.assertTrue(is_unchanged(file_state(file_hash='sha-256:abc'), 1024, None, MODIFIED))
+        self.assertTrue(is_unchanged(file_state(), 1024, 'sha-256:abc', MODIFIED))
+
+    def test_hash_unknown_and_size_changed_then_changed(self):
+        self.assertFalse(is_unchanged(file_state(), 2048, None, MODIFIED))
+
+    def test_hash_unknown_and_modified_date_changed_then_changed(self):
+        self.assertFalse(is_unchanged(file_state(), 1024, None, datetime(2016, 9, 2)))
+
+    def test_hash_size_or_modified_date_unknown_then_changed(self):
+        self.assertFalse(is_unchanged(file_state(), None, None, MODIFIED))
+        self.assertFalse(is_unchanged(file_state(), 1024, None, None))
+        self.assertFalse(is_unchanged(file_state(size=None, modified_date=None), None, None, None))
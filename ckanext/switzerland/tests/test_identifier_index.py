@@ -0,0 +1,77 @@
+import unittest
+
+from mock import Mock, patch
+from nose.tools import assert_equal, assert_true
+
+# The classes to test
+# -----------------------------------------------------------------------
+from ckanext.switzerland import identifier_index
+# -----------------------------------------------------------------------
+
+
+def package_row(identifier, package_id):
+    row = Mock(identifier=identifier, package_id=package_id)
+    row.name = 'name-' + package_id
+    return row
+
+
+class TestIdentifierIndex(unittest.TestCase):
+
+    def mock_query(self, model):
+        query = model.Session.query.return_value
+        query.join.return_value = query
+        query.filter.return_value = query
+        return query
+
+    @patch('ckanext.switzerland.identifier_index.model')
+    def test_get_package_id_then_queried_every_time(self, model):
+        query = self.mock_query(model)
+        query.first.return_value = package_row('DiDok', 'package-id')
+
+        assert_equal(identifier_index.get_package_id('DiDok'), 'package-id')
+        assert_equal(identifier_index.get_package_id('DiDok'), 'package-id')
+
+        # not cached, a change of another process is seen at once
+        assert_equal(query.first.call_count, 2)
+
+    @patch('ckanext.switzerland.identifier_index.model')
+    def test_get_package_id_when_not_found_then_none(self, model):
+        self.mock_query(model).first.return_value = None
+
+        assert_equal(identifier_index.get_package_id('DiDok'), None)
+
+    @patch('ckanext.switzerland.identifier_index.QUERY_SIZE', 2)
+    @patch('ckanext.switzerland.identifier_index.model')
+    def test_get_packages_then_one_query_per_batch(self, model):
+        query = self.mock_query(model)
+        query.__iter__ = Mock(side_effect=[
+            iter([package_row('DiDok', 'didok-id'), package_row('Timetable 2016', 'timetable-id')]),
+            iter([]),
+        ])
+
+        packages = identifier_index.get_packages(['DiDok', 'Timetable 2016', 'Missing', 'DiDok'])
+
+        assert_equal(packages, {
+            'DiDok': {'id': 'didok-id', 'name': 'name-didok-id', 'identifier': 'DiDok'},
+            'Timetable 2016': {'id': 'timetable-id', 'name': 'name-timetable-id', 'identifier': 'Timetable 2016'},
+        })
+        assert_equal(query.__iter__.call_count, 2)
+
+    @patch('ckanext.switzerland.identifier_index.model')
+    def test_setup_when_index_exists_then_not_created(self, model):
+        connection = model.meta.engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value.first.return_value = (1,)
+
+        identifier_index.setup()
+
+        assert_equal(connection.execute.call_count, 1)
+
+    @patch('ckanext.switzerland.identifier_index.model')
+    def test_setup_when_index_missing_then_created(self, model):
+        connection = model.meta.engine.begin.return_value.__enter__.return_value
+        connection.execute.return_value.first.return_value = None
+
+        identifier_index.setup()
+
+        assert_equal(connection.execute.call_count, 2)
+        assert_true('CREATE INDEX idx_ogdch_package_extra_identifier' in connection.execute.call_args[0][0])
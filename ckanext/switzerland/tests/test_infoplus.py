@@ -1,9 +1,16 @@
+# coding=utf-8
 import json
+import shutil
+import tempfile
+import threading
+import unittest
+from io import BytesIO
 from zipfile import ZipFile
 
 import os
 from StringIO import StringIO
 
+from ckanext.switzerland.harvester import infoplus
 from ckanext.switzerland.harvester.timetable_harvester import TimetableHarvester
 from ckanext.switzerland.tests import data
 from ckanext.switzerland.tests.helpers.mock_ftp_storage_adapter import MockFTPStorageAdapter
@@ -80,3 +87,228 @@ class TestInfoplusHarvester(BaseSBBHarvesterTests):
 
         assert_equal(dataset['resources'][0]['identifier'], 'BAHNHOF.csv')
         self.assert_resource_data(dataset['resources'][0]['id'], data.bahnhof_file_csv)
+
+    def test_streaming_then_infoplus_zip_file_downloaded(self):
+        """
+        The other timetable files are streamed, the zip file of the Info+ files is downloaded for their conversion
+        """
+        filesystem = self.get_filesystem(filename='FP2016_Jahresfahrplan.zip')
+        MockFTPStorageAdapter.filesystem = filesystem
+
+        path = os.path.join(data.environment, data.folder, 'FP2015_Fahrplan_20151001.zip')
+        f = StringIO()
+        zipfile = ZipFile(f, 'w')
+        zipfile.writestr('BAHNHOF', data.bahnhof_file)
+        zipfile.close()
+        filesystem.setcontents(path, f.getvalue())
+
+        self.run_harvester(
+            dataset='Timetable {year}',
+            timetable_regex='FP(\d{4}).*\.zip',
+            resource_regex='FP(\d{4})_Fahrplan_\d{8}\.zip',
+            infoplus={
+                'year': 2015,
+                'dataset': 'Station List',
+                'files': {
+                    'BAHNHOF': data.infoplus_config
+                }
+            },
+            streaming=True,
+        )
+
+        dataset = self.get_dataset(name='Station List')
+        assert_equal(dataset['resources'][0]['identifier'], 'BAHNHOF.csv')
+        self.assert_resource_data(dataset['resources'][0]['id'], data.bahnhof_file_csv)
+
+        dataset = self.get_dataset(name='Timetable 2016')
+        assert_equal(dataset['resources'][0]['identifier'], 'FP2016_Jahresfahrplan.zip')
+        self.assert_resource_data(dataset['resources'][0]['id'], data.dataset_content_1)
+
+    @unittest.skipIf(infoplus.pyarrow is None, 'pyarrow is not installed')
+    def test_columnar_formats(self):
+        filesystem = self.get_filesystem(filename='FP2016_Jahresfahrplan.zip')
+        MockFTPStorageAdapter.filesystem = filesystem
+
+        path = os.path.join(data.environment, data.folder, 'FP2015_Fahrplan_20151001.zip')
+        f = StringIO()
+        zipfile = ZipFile(f, 'w')
+        zipfile.writestr('BAHNHOF', data.bahnhof_file)
+        zipfile.close()
+        filesystem.setcontents(path, f.getvalue())
+
+        self.run_harvester(
+            dataset='Timetable {year}',
+            timetable_regex='FP(\d{4}).*\.zip',
+            resource_regex='FP(\d{4})_Fahrplan_\d{8}\.zip',
+            infoplus={
+                'year': 2015,
+                'dataset': 'Station List',
+                'files': {
+                    'BAHNHOF': data.infoplus_config
+                },
+                'formats': ['parquet'],
+            }
+        )
+
+        dataset = self.get_dataset(name='Station List')
+
+        resources = dict((r['identifier'], r) for r in dataset['resources'])
+        assert_equal(sorted(resources), ['BAHNHOF.csv', 'BAHNHOF.parquet'])
+        assert_equal(resources['BAHNHOF.parquet']['format'], 'PARQUET')
+        self.assert_resource_data(resources['BAHNHOF.csv']['id'], data.bahnhof_file_csv)
+
+
+class TestInfoplusConversion(unittest.TestCase):
+    """
+    Unit tests of the streaming fixed width to CSV conversion
+    """
+
+    def convert(self, content):
+        out = BytesIO()
+        rows = infoplus.convert_fixed_width(BytesIO(content), out, data.infoplus_config)
+        return rows, out.getvalue()
+
+    def test_convert_latin1_file(self):
+        rows, csv = self.convert(data.bahnhof_file)
+
+        assert_equal(rows, 13)
+        assert_equal(csv, data.bahnhof_file_csv)
+
+    def test_convert_utf8_file_with_trailing_line_break(self):
+        rows, csv = self.convert(data.bahnhof_file.decode('iso-8859-1').encode('utf-8') + '\n')
+
+        assert_equal(rows, 13)
+        assert_equal(csv, data.bahnhof_file_csv)
+
+    def test_lines_split_across_chunks(self):
+        content = u'0000024 Bümpliz\n0000025 Egghölzli'.encode('utf-8')
+
+        lines = list(infoplus.iter_lines(BytesIO(content), chunk_size=1))
+
+        assert_equal(lines, [u'0000024 Bümpliz', u'0000025 Egghölzli'])
+
+    def test_slice_plan(self):
+        plan = infoplus.get_slice_plan(data.infoplus_config)
+
+        assert_equal(plan[0], slice(0, 7))
+        assert_equal(plan[-1], slice(39, None))
+
+    def create_zip(self, tmpfolder, members):
+        zip_path = os.path.join(tmpfolder, 'FP2015_Fahrplan_20151001.zip')
+        with ZipFile(zip_path, 'w') as zipfile:
+            for member in members:
+                zipfile.writestr(member, data.bahnhof_file)
+        return zip_path
+
+    def assert_extracted(self, processes):
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            zip_path = self.create_zip(tmpfolder, ['BAHNHOF', 'BFKOORD'])
+            files_config = {'BAHNHOF': data.infoplus_config, 'BFKOORD': data.infoplus_config}
+
+            infoplus.extract_members(zip_path, tmpfolder, files_config, processes)
+
+            for member in files_config:
+                with open(os.path.join(tmpfolder, member + '.csv'), 'rb') as f:
+                    assert_equal(f.read(), data.bahnhof_file_csv)
+            assert_equal(sorted(os.listdir(tmpfolder)),
+                         ['BAHNHOF.csv', 'BFKOORD.csv', 'FP2015_Fahrplan_20151001.zip'])
+        finally:
+            shutil.rmtree(tmpfolder)
+
+    def test_extract_members_in_one_process(self):
+        self.assert_extracted(processes=1)
+
+    def test_extract_members_in_process_pool(self):
+        self.assert_extracted(processes=2)
+
+    def test_extract_members_at_the_same_time_then_converted_once(self):
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            zip_path = self.create_zip(tmpfolder, ['BAHNHOF', 'BFKOORD'])
+            files_config = {'BAHNHOF': data.infoplus_config, 'BFKOORD': data.infoplus_config}
+
+            with patch.object(infoplus, '_convert_member', wraps=infoplus._convert_member) as convert_member:
+                threads = [threading.Thread(target=infoplus.extract_members,
+                                            args=(zip_path, tmpfolder, files_config, 1)) for _ in range(2)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+            assert_equal(convert_member.call_count, 2)
+            assert_equal(sorted(os.listdir(tmpfolder)),
+                         ['BAHNHOF.csv', 'BFKOORD.csv', 'FP2015_Fahrplan_20151001.zip'])
+        finally:
+            shutil.rmtree(tmpfolder)
+
+    def test_conversion_fails_then_no_file_left(self):
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            zip_path = self.create_zip(tmpfolder, ['BAHNHOF'])
+
+            with patch.object(infoplus, 'convert_fixed_width', side_effect=IOError('disk full')):
+                with self.assertRaises(IOError):
+                    infoplus.extract_members(zip_path, tmpfolder, {'BAHNHOF': data.infoplus_config}, 1)
+
+            assert_equal(os.listdir(tmpfolder), ['FP2015_Fahrplan_20151001.zip'])
+        finally:
+            shutil.rmtree(tmpfolder)
+
+    @unittest.skipIf(infoplus.pyarrow is None, 'pyarrow is not installed')
+    def test_extract_members_to_columnar_formats(self):
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            zip_path = self.create_zip(tmpfolder, ['BAHNHOF'])
+            columns = [dict(column) for column in data.infoplus_config]
+            columns[0]['type'] = 'int'
+            columns[1]['type'] = columns[2]['type'] = 'float'
+
+            infoplus.extract_members(zip_path, tmpfolder, {'BAHNHOF': columns}, 1, formats=['parquet', 'arrow'])
+
+            parquet = infoplus.pyarrow.parquet.read_table(os.path.join(tmpfolder, 'BAHNHOF.parquet'))
+            with open(os.path.join(tmpfolder, 'BAHNHOF.arrow'), 'rb') as f:
+                arrow = infoplus.pyarrow.ipc.open_file(f).read_all()
+            for table in [parquet, arrow]:
+                assert_equal(table.num_rows, 13)
+                assert_equal(table.schema.names[:3], ['StationID', 'Longitude', 'Latitude'])
+                assert_equal(str(table.schema.types[0]), 'int64')
+                assert_equal(str(table.schema.types[1]), 'double')
+                assert_equal(str(table.schema.types[4]), 'string')
+                rows = table.to_pydict()
+                assert_equal(rows['StationID'][0], 6)
+                assert_equal(rows['Longitude'][0], 7.549783)
+                assert_equal(rows['Remark'][0], u'St. Katharinen')
+        finally:
+            shutil.rmtree(tmpfolder)
+
+    @unittest.skipIf(infoplus.pyarrow is None, 'pyarrow is not installed')
+    def test_columnar_writer_writes_invalid_numbers_as_null(self):
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpfolder, 'BAHNHOF.parquet')
+            writer = infoplus.ColumnarWriter(path, 'parquet', [{'from': 1, 'to': 7, 'name': 'a', 'type': 'int'}])
+            writer.write([[u'1', u'', u'x']])
+            writer.close()
+
+            assert_equal(writer.invalid_cells, 1)
+            assert_equal(infoplus.pyarrow.parquet.read_table(path).to_pydict()['a'], [1, None, None])
+        finally:
+            shutil.rmtree(tmpfolder)
+
+    def test_file_filter_uses_the_files_already_extracted(self):
+        tmpfolder = tempfile.mkdtemp()
+        try:
+            zip_path = self.create_zip(tmpfolder, ['BAHNHOF', 'BFKOORD'])
+            config = {'infoplus': {'files': {'BAHNHOF': data.infoplus_config, 'BFKOORD': data.infoplus_config}}}
+            harvester_obj = {'tmpfolder': tmpfolder, 'file': os.path.basename(zip_path)}
+
+            with patch.object(infoplus, 'extract_members', wraps=infoplus.extract_members) as extract_members:
+                bahnhof = infoplus.file_filter(dict(harvester_obj, infoplus_filename='BAHNHOF'), config)
+                bfkoord = infoplus.file_filter(dict(harvester_obj, infoplus_filename='BFKOORD'), config)
+
+            assert_equal(extract_members.call_count, 1)
+            assert_equal(bahnhof['file'], os.path.join(tmpfolder, 'BAHNHOF.csv'))
+            assert_equal(bfkoord['file'], os.path.join(tmpfolder, 'BFKOORD.csv'))
+        finally:
+            shutil.rmtree(tmpfolder)
@@ -1,8 +1,13 @@
 import os
+import shutil
+import tempfile
+import unittest
+
+from ckanext.switzerland.harvester import ist_file
 from ckanext.switzerland.harvester.sbb_harvester import SBBHarvester
 from ckanext.switzerland.tests.helpers.mock_ftp_storage_adapter import MockFTPStorageAdapter
 from mock import patch
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_false, assert_raises, assert_true
 
 from . import data
 from .base_ftp_harvester_tests import BaseSBBHarvesterTests
@@ -31,3 +36,100 @@ class TestIstFileHarvester(BaseSBBHarvesterTests):
 
         assert_equal(dataset['resources'][0]['identifier'], 'ist_file.csv')
         self.assert_resource_data(dataset['resources'][0]['id'], data.ist_file_output)
+
+
+class TestIstFileFilter(unittest.TestCase):
+    """
+    Unit tests of the chunked Ist-File filter
+    """
+
+    def setUp(self):
+        self.tmpfolder = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpfolder, 'ist_file.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpfolder)
+
+    def filter(self, content, **kwargs):
+        with open(self.path, 'wb') as f:
+            f.write(content)
+        result = ist_file.filter_ist_file(self.path, **kwargs)
+        with open(self.path, 'rb') as f:
+            return result, f.read()
+
+    def test_filter_in_one_process(self):
+        result, content = self.filter(data.ist_file, processes=1)
+
+        assert_equal(content, data.ist_file_output)
+        assert_equal(result, (11, 9))
+        assert_equal(os.listdir(self.tmpfolder), ['ist_file.csv'])
+
+    def test_filter_chunks_in_process_pool(self):
+        result, content = self.filter(data.ist_file, processes=2, chunk_size=500)
+
+        assert_equal(content, data.ist_file_output)
+        assert_equal(result, (11, 9))
+        assert_equal(os.listdir(self.tmpfolder), ['ist_file.csv'])
+
+    def test_chunks_end_on_line_boundaries(self):
+        with open(self.path, 'wb') as f:
+            f.write(data.ist_file)
+
+        with open(self.path, 'rb') as f:
+            chunks = ist_file.get_chunks(f, 0, 100)
+
+        assert_equal(chunks[0][0], 0)
+        assert_equal(chunks[-1][1], len(data.ist_file))
+        for (_, end), (start, _) in zip(chunks, chunks[1:]):
+            assert_equal(end, start)
+            assert_equal(data.ist_file[end - 1], '\n')
+
+    def test_bpuic_first_column(self):
+        _, content = self.filter('BPUIC;NAME\r\n8503000:7;Z\xfcrich HB\r\n8014428;Weil am Rhein\r\n', processes=1)
+
+        assert_equal(content, 'BPUIC;NAME\r\n8503000;Z\xfcrich HB\r\n')
+
+    def test_bpuic_after_byte_order_mark(self):
+        _, content = self.filter('\xef\xbb\xbfBPUIC;NAME\n850300007;Z\xc3\xbcrich HB\n', processes=1)
+
+        assert_equal(content, '\xef\xbb\xbfBPUIC;NAME\r\n8503000;Z\xc3\xbcrich HB\r\n')
+
+    def test_missing_bpuic_column(self):
+        with assert_raises(Exception):
+            self.filter('NAME;STATION\n8503000;Z\xfcrich HB\n', processes=1)
+
+    def test_quoted_lines_and_short_lines(self):
+        _, content = self.filter('NAME;BPUIC\n"Z\xfcrich; HB";85030007\n\n"Bern";8507000\nBasel\n', processes=1)
+
+        assert_equal(content, 'NAME;BPUIC\r\n"Z\xfcrich; HB";8503000\r\nBern;8507000\r\n')
+
+    def test_filter_by_default_then_no_process_pool(self):
+        with patch.object(ist_file.multiprocessing, 'Pool') as pool:
+            result, content = self.filter(data.ist_file, chunk_size=500)
+
+        assert_false(pool.called)
+        assert_equal(content, data.ist_file_output)
+        assert_equal(result, (11, 9))
+
+    def test_quoted_value_with_line_break(self):
+        result, content = self.filter('NAME;BPUIC\n"Z\xfcrich\nHB";85030007\n"Basel\r\nSBB";8000000\n')
+
+        assert_equal(content, 'NAME;BPUIC\r\n"Z\xfcrich\nHB";8503000\r\n')
+        assert_equal(result, (2, 1))
+
+    def test_quoted_value_with_line_break_across_chunks_then_filtered_in_one_process(self):
+        source = 'NAME;BPUIC\n"Z\xfcrich\n' + 'HB\n' * 50 + '";85030007\nBern;8507000\n'
+
+        result, content = self.filter(source, processes=2, chunk_size=20)
+
+        assert_equal(content, 'NAME;BPUIC\r\n"Z\xfcrich\n' + 'HB\n' * 50 + '";8503000\r\nBern;8507000\r\n')
+        assert_equal(result, (2, 2))
+        assert_equal(os.listdir(self.tmpfolder), ['ist_file.csv'])
+
+    def test_ends_in_quoted_field(self):
+        assert_true(ist_file._ends_in_quoted_field('Bern;"Z\xfcrich'))
+        assert_true(ist_file._ends_in_quoted_field('Bern;"Z\xfcrich ""HB'))
+        assert_false(ist_file._ends_in_quoted_field('Bern;"Z\xfcrich ""HB"""'))
+        assert_false(ist_file._ends_in_quoted_field('Bern;Z\xfcrich "HB;8503000'))
+        assert_false(ist_file._ends_in_quoted_field('HB";8503000', ist_file._IN_QUOTED_FIELD))
+        assert_true(ist_file._ends_in_quoted_field('HB', ist_file._IN_QUOTED_FIELD))
@@ -0,0 +1,36 @@
+import unittest
+
+from nose.tools import assert_equal
+
+# The classes to test
+# -----------------------------------------------------------------------
+from ckanext.switzerland.harvester.lru_cache import LRUCache
+# -----------------------------------------------------------------------
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_set_when_full_then_least_recently_used_is_dropped(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+
+        cache.set('c', 3)
+
+        assert_equal(cache.get('a'), 1)
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('c'), 3)
+        assert_equal(len(cache), 2)
+
+    def test_remove_value_then_all_keys_of_the_value_are_removed(self):
+        cache = LRUCache(10)
+        cache.set('old identifier', 'package-id')
+        cache.set('new identifier', 'package-id')
+        cache.set('other identifier', 'other-package-id')
+
+        cache.remove_value('package-id')
+
+        assert_equal(cache.get('old identifier'), None)
+        assert_equal(cache.get('new identifier'), None)
+        assert_equal(cache.get('other identifier'), 'other-package-id')
@@ -0,0 +1,53 @@
+import unittest
+
+# The classes to test
+# -----------------------------------------------------------------------
+from ckanext.switzerland.harvester.resource_ordering import ResourceOrdering, get_resource_ordering
+# -----------------------------------------------------------------------
+
+
+def resources(*identifiers):
+    return [{'identifier': identifier} for identifier in identifiers]
+
+
+def identifiers(resource_list):
+    return [r['identifier'] for r in resource_list]
+
+
+class TestResourceOrdering(unittest.TestCase):
+
+    def test_order_by_identifier(self):
+        ordering = ResourceOrdering('\\d{8}.csv')
+
+        ordered, unmatched = ordering.order(resources('20160901.csv', 'README.txt', '20160903.csv', '20160902.csv'))
+
+        self.assertEqual(['20160903.csv', '20160902.csv', '20160901.csv'], identifiers(ordered))
+        self.assertEqual(['README.txt'], identifiers(unmatched))
+
+    def test_resource_regex_is_case_insensitive(self):
+        ordering = ResourceOrdering('data_.*')
+
+        ordered, unmatched = ordering.order(resources('DATA_1.CSV', 'other.csv'))
+
+        self.assertEqual(['DATA_1.CSV'], identifiers(ordered))
+        self.assertEqual(['other.csv'], identifiers(unmatched))
+
+    def test_order_by_date_pattern(self):
+        ordering = ResourceOrdering('.*', '\\d{4}-\\d{2}-\\d{2}')
+
+        ordered, _ = ordering.order(resources('b_2016-09-01.csv', 'a_2016-09-03.csv', 'c_2016-09-02.csv'))
+
+        self.assertEqual(['a_2016-09-03.csv', 'c_2016-09-02.csv', 'b_2016-09-01.csv'], identifiers(ordered))
+
+    def test_date_pattern_not_found_then_ordered_last(self):
+        ordering = ResourceOrdering('.*', '\\d{4}-\\d{2}-\\d{2}')
+
+        ordered, _ = ordering.order(resources('a.csv', 'x_2016-09-01.csv', 'b.csv', 'y_2016-09-02.csv'))
+
+        self.assertEqual(['y_2016-09-02.csv', 'x_2016-09-01.csv', 'b.csv', 'a.csv'], identifiers(ordered))
+
+    def test_get_resource_ordering_is_cached(self):
+        ordering = get_resource_ordering('\\d{8}.csv', None)
+
+        self.assertIs(ordering, get_resource_ordering('\\d{8}.csv', None))
+        self.assertIsNot(ordering, get_resource_ordering('\\d{8}.csv', '\\d{8}'))
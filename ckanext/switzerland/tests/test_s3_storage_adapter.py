@@ -5,18 +5,21 @@ import datetime
 
 from helpers.mock_config_resolver import MockConfigResolver
 from ckanext.switzerland.harvester.exceptions.storage_adapter_configuration_exception import StorageAdapterConfigurationException
-from fixtures.aws_fixture import FILES_AT_ROOT, FILE_CONTENT, FILES_AT_FOLDER, HEAD_FILE_AT_FOLDER, HEAD_FILE_AT_ROOT, NO_CONTENT, ALL, ALL_AT_FOLDER
+from fixtures.aws_fixture import FILES_AT_ROOT, FILE_CONTENT, FILES_AT_FOLDER, HEAD_FILE_AT_FOLDER, HEAD_FILE_AT_ROOT, NO_CONTENT, ALL, ALL_AT_FOLDER, FILES_AT_FOLDER_PAGE_1, FILES_AT_FOLDER_PAGE_2
 import boto3
 from dateutil.tz import tzutc
-from botocore.stub import Stubber
+from botocore.stub import Stubber, ANY
+from botocore.response import StreamingBody
+from io import BytesIO
 from numpy.testing import assert_array_equal
 
 # The classes to test
 # -----------------------------------------------------------------------
 from ckanext.switzerland.harvester.s3_storage_adapter import S3StorageAdapter
+from ckanext.switzerland.harvester.connection_pool import connection_pool
 # -----------------------------------------------------------------------
 
-from ckanext.switzerland.harvester.aws_keys import (
+from ckanext.switzerland.harvester.keys import (
     AWS_SECRET_KEY,
     AWS_ACCESS_KEY,
     AWS_REGION_NAME,
@@ -111,6 +114,20 @@ class TestS3StorageAdapter(unittest.TestCase):
 
         self.assertIsNotNone(storage_adapter._aws_client)
 
+    def test_connect_with_pool_then_client_is_reused(self):
+        config_resolver = MockConfigResolver(self.ini_file_path, CONFIG_SECTION)
+        config_resolver._config[CONFIG_SECTION]['ckan.s3.main_bucket.pool_size'] = '1'
+        first = S3StorageAdapter(config_resolver, dict(self.config), self.remote_folder)
+        second = S3StorageAdapter(config_resolver, dict(self.config), self.remote_folder)
+        try:
+            with first:
+                client = first._aws_client
+            self.assertIsNone(first._aws_client)
+            with second:
+                self.assertIs(client, second._aws_client)
+        finally:
+            connection_pool.clear()
+
     def test_cdremote_then_working_directory_is_stored(self):
         storage_adapter = self.__build_tested_object__()
         storage_adapter.cdremote('/foo/')
@@ -163,7 +180,7 @@ class TestS3StorageAdapter(unittest.TestCase):
     def test_get_remote_filelist_at_root_then_returns_correct_list(self):
         storage_adapter = self.__build_tested_object__()
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", FILES_AT_ROOT, {
+        stubber.add_response("list_objects_v2", FILES_AT_ROOT, {
                                 'Bucket': TEST_BUCKET_NAME,
                                 'Delimiter': '/',
                                 'Prefix': ''
@@ -182,7 +199,7 @@ class TestS3StorageAdapter(unittest.TestCase):
         storage_adapter = self.__build_tested_object__()
         storage_adapter.cdremote('a')
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", FILES_AT_FOLDER, {
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '/',
                                 'Prefix': 'a/'
@@ -201,7 +218,7 @@ class TestS3StorageAdapter(unittest.TestCase):
     def test_get_remote_filelist_with_folder_then_returns_the_correct_names(self):
         storage_adapter = self.__build_tested_object__()
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", FILES_AT_FOLDER, {
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '/',
                                 'Prefix': 'a/'
@@ -221,7 +238,7 @@ class TestS3StorageAdapter(unittest.TestCase):
         storage_adapter = self.__build_tested_object__()
         storage_adapter.cdremote('empty')
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", NO_CONTENT, {
+        stubber.add_response("list_objects_v2", NO_CONTENT, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '/',
                                 'Prefix': 'empty/'
@@ -234,7 +251,7 @@ class TestS3StorageAdapter(unittest.TestCase):
     def test_get_remote_dirlist_when_no_dir_then_returns_empty_list(self):
         storage_adapter = self.__build_tested_object__()
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", NO_CONTENT, {
+        stubber.add_response("list_objects_v2", NO_CONTENT, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '/',
                                 'Prefix': ''
@@ -248,7 +265,7 @@ class TestS3StorageAdapter(unittest.TestCase):
     def test_get_remote_dirlist_then_returns_correct_list(self):
         storage_adapter = self.__build_tested_object__()
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", FILES_AT_ROOT, {
+        stubber.add_response("list_objects_v2", FILES_AT_ROOT, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '/',
                                 'Prefix': ''
@@ -269,7 +286,7 @@ class TestS3StorageAdapter(unittest.TestCase):
         storage_adapter = self.__build_tested_object__()
         storage_adapter.cdremote('a')
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", FILES_AT_FOLDER, {
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '/',
                                 'Prefix': 'a/'
@@ -289,7 +306,7 @@ class TestS3StorageAdapter(unittest.TestCase):
     def test_get_remote_dirlist_with_folder_then_returns_correct_list(self):
         storage_adapter = self.__build_tested_object__()
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", FILES_AT_FOLDER, {
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '/',
                                 'Prefix': 'a/'
@@ -309,7 +326,7 @@ class TestS3StorageAdapter(unittest.TestCase):
     def test_get_remote_dirlist_all_when_no_dir_then_returns_empty_list(self):
         storage_adapter = self.__build_tested_object__()
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", NO_CONTENT, {
+        stubber.add_response("list_objects_v2", NO_CONTENT, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '',
                                 'Prefix': ''
@@ -323,7 +340,7 @@ class TestS3StorageAdapter(unittest.TestCase):
     def test_get_remote_dirlist_all_then_returns_correct_list(self):
         storage_adapter = self.__build_tested_object__()
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", ALL, {
+        stubber.add_response("list_objects_v2", ALL, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '',
                                 'Prefix': ''
@@ -351,7 +368,7 @@ class TestS3StorageAdapter(unittest.TestCase):
         storage_adapter = self.__build_tested_object__()
         storage_adapter.cdremote('a')
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", ALL_AT_FOLDER, {
+        stubber.add_response("list_objects_v2", ALL_AT_FOLDER, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '',
                                 'Prefix': 'a/'
@@ -372,7 +389,7 @@ class TestS3StorageAdapter(unittest.TestCase):
     def test_get_remote_dirlist_all_with_folder_then_returns_correct_list(self):
         storage_adapter = self.__build_tested_object__()
         stubber = self.__stub_aws_client__(storage_adapter)
-        stubber.add_response("list_objects", ALL_AT_FOLDER, {
+        stubber.add_response("list_objects_v2", ALL_AT_FOLDER, {
                                 'Bucket': TEST_BUCKET_NAME, 
                                 'Delimiter': '',
                                 'Prefix': 'a/'
@@ -390,6 +407,234 @@ class TestS3StorageAdapter(unittest.TestCase):
         ]
         assert_array_equal(expected_dir_list, dir_list)
     
+    def test_get_remote_dirlist_when_truncated_then_all_pages_are_listed(self):
+        storage_adapter = self.__build_tested_object__()
+        stubber = self.__stub_aws_client__(storage_adapter)
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER_PAGE_1, {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Delimiter': '/',
+                                'Prefix': 'a/'
+                            })
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER_PAGE_2, {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Delimiter': '/',
+                                'Prefix': 'a/',
+                                'ContinuationToken': FILES_AT_FOLDER_PAGE_1['NextContinuationToken']
+                            })
+        stubber.activate()
+
+        dir_list = storage_adapter.get_remote_dirlist('a')
+
+        expected_dir_list = [
+            "a_file_05.pdf",
+            "file_03.pdf",
+            "sub_a/"
+        ]
+        assert_array_equal(expected_dir_list, dir_list)
+        stubber.assert_no_pending_responses()
+
+    def test_iter_remote_files_when_truncated_then_yields_files_of_all_pages(self):
+        storage_adapter = self.__build_tested_object__()
+        stubber = self.__stub_aws_client__(storage_adapter)
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER_PAGE_1, {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Delimiter': '/',
+                                'Prefix': 'a/'
+                            })
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER_PAGE_2, {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Delimiter': '/',
+                                'Prefix': 'a/',
+                                'ContinuationToken': FILES_AT_FOLDER_PAGE_1['NextContinuationToken']
+                            })
+        stubber.activate()
+
+        remote_files = list(storage_adapter.iter_remote_files('a'))
+
+        self.assertEqual(['a_file_05.pdf', 'file_03.pdf'], [f.name for f in remote_files])
+        self.assertEqual(418810, remote_files[1].size)
+        self.assertEqual('9a45adfaa943bba12b0925695efd01e1', remote_files[1].etag)
+        self.assertEqual(datetime.datetime(2022, 12, 21, 13, 53, 9), remote_files[1].modified_date)
+
+    def test_iter_remote_files_then_listing_is_lazy(self):
+        storage_adapter = self.__build_tested_object__()
+        stubber = self.__stub_aws_client__(storage_adapter)
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER_PAGE_1, {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Delimiter': '/',
+                                'Prefix': 'a/'
+                            })
+        stubber.activate()
+
+        remote_files = storage_adapter.iter_remote_files('a')
+
+        # only the first page is requested to get the first file
+        self.assertEqual('a_file_05.pdf', next(remote_files).name)
+        stubber.assert_no_pending_responses()
+
+    def test_get_remote_file_metadata_then_metadata_is_taken_from_listing(self):
+        storage_adapter = self.__build_tested_object__()
+        stubber = self.__stub_aws_client__(storage_adapter)
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER, {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Delimiter': '/',
+                                'Prefix': 'a/'
+                            })
+        stubber.activate()
+
+        metadata = storage_adapter.get_remote_file_metadata('a', filter_regex='file_.*')
+
+        # no head_object request is stubbed, so the stubber would fail if one was made
+        self.assertEqual(['file_03.pdf', 'file_04.pdf'], sorted(metadata.keys()))
+        self.assertEqual(datetime.datetime(2022, 12, 21, 13, 53, 8), metadata['file_03.pdf'].modified_date)
+        self.assertEqual(418809, metadata['file_03.pdf'].size)
+        self.assertEqual('0b6858a853073a7e5a3edb54a51154b1', metadata['file_03.pdf'].etag)
+
+    def test_get_remote_file_hash_then_etag_of_listing(self):
+        storage_adapter = self.__build_tested_object__()
+        stubber = self.__stub_aws_client__(storage_adapter)
+        stubber.add_response("list_objects_v2", FILES_AT_FOLDER, {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Delimiter': '/',
+                                'Prefix': 'a/'
+                            })
+        stubber.activate()
+
+        metadata = storage_adapter.get_remote_file_metadata('a', filter_regex='file_.*')
+
+        self.assertEqual('etag:0b6858a853073a7e5a3edb54a51154b1',
+                         storage_adapter.get_remote_file_hash(metadata['file_03.pdf']))
+
+    def __get_object_response__(self, content):
+        return {'Body': StreamingBody(BytesIO(content), len(content)), 'ContentLength': len(content)}
+
+    def __local_path__(self, filename):
+        localpath = os.path.join(self.temp_folder, filename)
+        for path in [localpath, localpath + '.part']:
+            if os.path.exists(path):
+                os.remove(path)
+        return localpath
+
+    def __stub_download__(self, stubber, key, content):
+        # boto3 transfers start with a HEAD request to decide if the object is downloaded in parts
+        stubber.add_response("head_object", {'ContentLength': len(content)}, {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Key': key
+                            })
+        stubber.add_response("get_object", self.__get_object_response__(content), {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Key': key
+                            })
+
+    def test_fetch_then_file_is_downloaded(self):
+        storage_adapter = self.__build_tested_object__()
+        storage_adapter.cdremote('a')
+        stubber = self.__stub_aws_client__(storage_adapter)
+        self.__stub_download__(stubber, 'a/file_01.csv', FILE_CONTENT)
+        stubber.activate()
+        localpath = self.__local_path__('file_01.csv')
+
+        status = storage_adapter.fetch('file_01.csv', localpath)
+
+        self.assertEqual('226 Transfer complete', status)
+        with open(localpath, 'rb') as f:
+            self.assertEqual(FILE_CONTENT, f.read())
+        self.assertFalse(os.path.exists(localpath + '.part'))
+
+    def test_fetch_large_file_then_file_is_downloaded_in_parts(self):
+        config_resolver = MockConfigResolver(self.ini_file_path, CONFIG_SECTION)
+        config_resolver._config[CONFIG_SECTION]['ckan.s3.main_bucket.multipart_threshold'] = '8'
+        config_resolver._config[CONFIG_SECTION]['ckan.s3.main_bucket.part_size'] = '10'
+        config_resolver._config[CONFIG_SECTION]['ckan.s3.main_bucket.use_threads'] = 'false'
+        storage_adapter = S3StorageAdapter(config_resolver, dict(self.config), self.remote_folder)
+        storage_adapter.cdremote('a')
+        stubber = self.__stub_aws_client__(storage_adapter)
+        stubber.add_response("head_object", {'ContentLength': len(FILE_CONTENT)}, {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Key': 'a/file_01.csv'
+                            })
+        # the last range is open ended
+        for part_range, part in [('bytes=0-9', FILE_CONTENT[:10]), ('bytes=10-', FILE_CONTENT[10:])]:
+            stubber.add_response("get_object", self.__get_object_response__(part), {
+                                    'Bucket': TEST_BUCKET_NAME,
+                                    'Key': 'a/file_01.csv',
+                                    'Range': part_range
+                                })
+        stubber.activate()
+        localpath = self.__local_path__('file_01.csv')
+
+        storage_adapter.fetch('file_01.csv', localpath)
+
+        stubber.assert_no_pending_responses()
+        with open(localpath, 'rb') as f:
+            self.assertEqual(FILE_CONTENT, f.read())
+
+    def test_transfer_config_defaults(self):
+        storage_adapter = self.__build_tested_object__()
+
+        self.assertEqual(8 * 1024 * 1024, storage_adapter._config['multipart_threshold'])
+        self.assertEqual(8 * 1024 * 1024, storage_adapter._config['part_size'])
+        self.assertEqual(10, storage_adapter._config['max_concurrency'])
+        self.assertTrue(storage_adapter._config['use_threads'])
+
+    def test_transfer_config_with_invalid_use_threads_then_error(self):
+        config_resolver = MockConfigResolver(self.ini_file_path, CONFIG_SECTION)
+        config_resolver._config[CONFIG_SECTION]['ckan.s3.main_bucket.use_threads'] = 'maybe'
+
+        self.assertRaises(StorageAdapterConfigurationException, S3StorageAdapter, config_resolver, dict(self.config), self.remote_folder)
+
+    def test_open_remote_file_then_content_is_streamed(self):
+        storage_adapter = self.__build_tested_object__()
+        storage_adapter.cdremote('a')
+        stubber = self.__stub_aws_client__(storage_adapter)
+        stubber.add_response("get_object", self.__get_object_response__(FILE_CONTENT), {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Key': 'a/file_01.csv'
+                            })
+        stubber.activate()
+
+        with storage_adapter.open_remote_file('file_01.csv') as remote_file:
+            self.assertEqual(len(FILE_CONTENT), remote_file.size)
+            self.assertEqual(FILE_CONTENT, remote_file.read())
+
+    def test_fetch_with_partial_download_then_download_is_continued(self):
+        storage_adapter = self.__build_tested_object__()
+        storage_adapter.cdremote('a')
+        stubber = self.__stub_aws_client__(storage_adapter)
+        stubber.add_response("get_object", self.__get_object_response__(FILE_CONTENT[8:]), {
+                                'Bucket': TEST_BUCKET_NAME,
+                                'Key': 'a/file_01.csv',
+                                'Range': 'bytes=8-',
+                                'IfUnmodifiedSince': ANY
+                            })
+        stubber.activate()
+        localpath = self.__local_path__('file_01.csv')
+        with open(localpath + '.part', 'wb') as f:
+            f.write(FILE_CONTENT[:8])
+
+        storage_adapter.fetch('file_01.csv', localpath)
+
+        stubber.assert_no_pending_responses()
+        with open(localpath, 'rb') as f:
+            self.assertEqual(FILE_CONTENT, f.read())
+        self.assertFalse(os.path.exists(localpath + '.part'))
+
+    def test_fetch_with_outdated_partial_download_then_download_is_restarted(self):
+        storage_adapter = self.__build_tested_object__()
+        storage_adapter.cdremote('a')
+        stubber = self.__stub_aws_client__(storage_adapter)
+        stubber.add_client_error("get_object", service_error_code='PreconditionFailed', http_status_code=412)
+        self.__stub_download__(stubber, 'a/file_01.csv', FILE_CONTENT)
+        stubber.activate()
+        localpath = self.__local_path__('file_01.csv')
+        with open(localpath + '.part', 'wb') as f:
+            f.write(b'outdated content')
+
+        storage_adapter.fetch('file_01.csv', localpath)
+
+        with open(localpath, 'rb') as f:
+            self.assertEqual(FILE_CONTENT, f.read())
+
     def test_get_modified_date_file_at_root_then_date_is_correct(self):
         storage_adapter = self.__build_tested_object__()
         stubber = self.__stub_aws_client__(storage_adapter)
@@ -1,14 +1,20 @@
+import hashlib
 import json
+import shutil
+import tempfile
 from datetime import datetime
 
 import os
 from ckan.lib.munge import munge_name
+from ckan.lib.search.index import PackageSearchIndex
 from ckan.logic import get_action, NotFound
 from ckanext.harvest import model as harvester_model
+from ckanext.switzerland.harvester import base_sbb_harvester, filestore_gc, harvest_logging, harvest_state
 from ckanext.switzerland.harvester.sbb_harvester import SBBHarvester
+from ckanext.switzerland.tests.helpers.mock_config_resolver import MockConfigResolver
 from ckanext.switzerland.tests.helpers.mock_ftp_storage_adapter import MockFTPStorageAdapter
-from mock import patch
-from nose.tools import assert_equal, assert_raises
+from mock import ANY, Mock, patch
+from nose.tools import assert_equal, assert_false, assert_raises
 
 from . import data
 from .base_ftp_harvester_tests import BaseSBBHarvesterTests
@@ -105,6 +111,145 @@ class TestSBBHarvester(BaseSBBHarvesterTests):
         assert_equal(len(package.resources), 1)
         assert_equal(len(package.resources_all), 1)
 
+    def test_harvest_state_is_stored(self):
+        """
+        The finalizer stores the state of the imported files, which is used instead of the previous harvest job
+        """
+        MockFTPStorageAdapter.filesystem = self.get_filesystem()
+        self.run_harvester()
+
+        source = harvester_model.Session.query(harvester_model.HarvestSource).one()
+        file_states = harvest_state.get_file_states(source.id)
+        package = self.get_package()
+
+        assert_equal(file_states.keys(), [data.filename])
+        assert_equal(file_states[data.filename].resource_id, package.resources[0].id)
+        assert_equal(file_states[data.filename].size, len(data.dataset_content_1))
+        assert_equal(file_states[data.filename].modified_date, datetime(2000, 1, 1))
+
+    def test_grouped_import(self):
+        """
+        With grouped_import, the files of the dataset are imported by the finalizer in one package update
+        """
+        filesystem = self.get_filesystem(filename='20160901.csv')
+        MockFTPStorageAdapter.filesystem = filesystem
+        path = os.path.join(data.environment, data.folder, '20160902.csv')
+        filesystem.setcontents(path, data.dataset_content_2)
+        self.run_harvester(grouped_import=True)
+
+        path = os.path.join(data.environment, data.folder, '20160901.csv')
+        filesystem.setcontents(path, data.dataset_content_3)
+        filesystem.settimes(path, modified_time=datetime.now())
+
+        with patch('ckanext.switzerland.harvester.base_sbb_harvester.get_action',
+                   wraps=base_sbb_harvester.get_action) as get_action:
+            self.run_harvester(grouped_import=True)
+
+        action_names = [c[0][0] for c in get_action.call_args_list]
+        assert 'resource_create' not in action_names
+        assert 'resource_delete' not in action_names
+        assert_equal(action_names.count('package_update'), 1)
+
+        package = self.get_package()
+        assert_equal(len(package.resources), 2)
+        assert_equal(len(package.resources_all), 3)
+        self.assert_resource_data(package.resources[0].id, data.dataset_content_2)
+        self.assert_resource_data(package.resources[1].id, data.dataset_content_3)
+
+    def test_grouped_import_when_package_update_fails_then_errors_of_the_grouped_objects(self):
+        """
+        If the package update of the finalizer fails, the harvest objects of the grouped files get the error
+        """
+        filesystem = self.get_filesystem(filename='20160901.csv')
+        MockFTPStorageAdapter.filesystem = filesystem
+        path = os.path.join(data.environment, data.folder, '20160902.csv')
+        filesystem.setcontents(path, data.dataset_content_2)
+
+        original_get_action = base_sbb_harvester.get_action
+
+        def get_action(name):
+            if name == 'package_update':
+                return Mock(side_effect=Exception('package_update failed'))
+            return original_get_action(name)
+
+        with patch('ckanext.switzerland.harvester.base_sbb_harvester.get_action', side_effect=get_action):
+            # the errors of the two grouped objects, and the one of the finalizer
+            self.run_harvester(grouped_import=True, object_errors=3)
+
+        grouped_objects = [harvest_object for harvest_object in harvester_model.HarvestObject.filter()
+                           if json.loads(harvest_object.content).get('grouped_import')]
+        assert_equal(len(grouped_objects), 2)
+        for harvest_object in grouped_objects:
+            assert_equal(harvest_object.state, 'ERROR')
+            assert_equal(len(harvest_object.errors), 1)
+            assert 'package_update failed' in harvest_object.errors[0].message
+
+    def test_grouped_import_replacing_and_adding_resources(self):
+        """
+        The resources created by the package update of the grouped import are matched to their files by filename,
+        whatever their order in the dataset
+        """
+        filesystem = self.get_filesystem(filename='20160901.csv')
+        MockFTPStorageAdapter.filesystem = filesystem
+        self.run_harvester(grouped_import=True)
+
+        contents = {
+            '20160901.csv': data.dataset_content_2,
+            '20160902.csv': data.dataset_content_3,
+            '20160903.csv': data.dataset_content_4,
+        }
+        for filename, content in contents.items():
+            path = os.path.join(data.environment, data.folder, filename)
+            filesystem.setcontents(path, content)
+            filesystem.settimes(path, modified_time=datetime.now())
+        self.run_harvester(grouped_import=True)
+
+        package = self.get_package()
+        assert_equal(len(package.resources), 3)
+        assert_equal(len(package.resources_all), 4)
+        for resource in package.resources:
+            content = contents[resource.extras['identifier']]
+            self.assert_resource_data(resource.id, content)
+            assert_equal(resource.hash, hashlib.md5(content).hexdigest())
+
+    def test_objects_of_a_job_then_job_logging_installed_once(self):
+        filesystem = self.get_filesystem(filename='20160901.csv')
+        MockFTPStorageAdapter.filesystem = filesystem
+        path = os.path.join(data.environment, data.folder, '20160902.csv')
+        filesystem.setcontents(path, data.dataset_content_2)
+
+        install = harvest_logging.JobLogging.install
+        with patch.object(harvest_logging.JobLogging, 'install', autospec=True, side_effect=install) as job_install:
+            self.run_harvester()
+
+        # the gather stage installs the logging, the fetch and import stages of the objects reuse it
+        assert_equal(job_install.call_count, 1)
+        assert_equal(len(self.get_package().resources), 2)
+
+    def test_dataset_is_indexed_once_by_the_finalizer(self):
+        filesystem = self.get_filesystem(filename='20160901.csv')
+        MockFTPStorageAdapter.filesystem = filesystem
+        path = os.path.join(data.environment, data.folder, '20160902.csv')
+        filesystem.setcontents(path, data.dataset_content_2)
+
+        indexed_datasets = []
+        index_package = PackageSearchIndex.index_package
+
+        def count_index_package(index, pkg_dict, *args, **kwargs):
+            if pkg_dict.get('type') == 'dataset':
+                indexed_datasets.append(pkg_dict['id'])
+            return index_package(index, pkg_dict, *args, **kwargs)
+
+        with patch.object(PackageSearchIndex, 'index_package', autospec=True, side_effect=count_index_package):
+            self.run_harvester()
+
+        package = self.get_package()
+        assert_equal(indexed_datasets, [package.id])
+
+        # the index is up to date
+        result = get_action('package_search')({}, {'fq': 'identifier:"%s"' % data.dataset_name})
+        assert_equal(len(result['results'][0]['resources']), 2)
+
     def test_force_all(self):
         """
         When modified date of file is older than the last harvester run date, the file should not be harvested again
@@ -303,6 +448,37 @@ class TestSBBHarvester(BaseSBBHarvesterTests):
             else:
                 self.assert_resource_exists(resource)
 
+    def test_max_resources_with_single_package_update(self):
+        """
+        The finalizer deletes the old resources, reorders the resources and sets the permalink with one update
+        """
+        filesystem = self.get_filesystem(filename='20160901.csv')
+        MockFTPStorageAdapter.filesystem = filesystem
+        path = os.path.join(data.environment, data.folder, '20160902.csv')
+        filesystem.setcontents(path, data.dataset_content_2)
+        self.run_harvester(max_resources=1, grouped_import=True)
+
+        with patch('ckanext.switzerland.harvester.base_sbb_harvester.get_action',
+                   wraps=base_sbb_harvester.get_action) as get_action:
+            self.run_harvester(max_resources=1, force_all=True, grouped_import=True)
+
+        action_names = [c[0][0] for c in get_action.call_args_list]
+        for action_name in ['package_patch', 'package_resource_reorder', 'resource_delete']:
+            assert action_name not in action_names
+        # the grouped import, then the finalizer
+        assert_equal(action_names.count('package_update'), 2)
+
+        package = self.get_package()
+        assert_equal(len(package.resources), 1)
+        assert_equal(package.resources[0].extras['identifier'], '20160902.csv')
+        assert_equal(package.permalink, 'http://odp.test/dataset/{}/resource/{}/download/20160902.csv'.format(
+            package.id, package.resources[0].id))
+        for resource in package.resources_all:
+            if resource.id == package.resources[0].id:
+                self.assert_resource_exists(resource)
+            else:
+                self.assert_resource_deleted(resource)
+
     def test_max_resources_revisions(self):
         """
         there are multiple revisions of file 20160901.csv, all of them should be deleted
@@ -410,6 +586,76 @@ class TestSBBHarvester(BaseSBBHarvesterTests):
         self.assert_resource_exists(package.resources[0])
         self.assert_resource_data(package.resources[0].id, data.dataset_content_4)
 
+    def test_resource_versions_index(self):
+        """
+        The revisions of the resources are indexed by filename with one query, the newest first
+        """
+        filesystem = self.get_filesystem()
+        MockFTPStorageAdapter.filesystem = filesystem
+        path = os.path.join(data.environment, data.folder, data.filename)
+        self.run_harvester(max_revisions=1)
+
+        filesystem.settimes(path, modified_time=datetime.now())
+        filesystem.setcontents(path, data.dataset_content_2)
+        self.run_harvester(max_revisions=1)
+
+        package = self.get_package()
+        versions = SBBHarvester()._get_resource_versions(package.id)
+        assert_equal(versions.keys(), [data.filename])
+        assert_equal([resource_id for resource_id, _ in versions[data.filename]],
+                     [r.id for r in sorted(package.resources_all, key=lambda r: r.created, reverse=True)])
+        assert_equal(versions[data.filename][0][0], package.resources[0].id)
+
+        old_revision = [r for r in package.resources_all if r.id != package.resources[0].id][0]
+        self.assert_resource_deleted(old_revision)
+        self.assert_resource_exists(package.resources[0])
+
+    def test_deferred_file_cleanup(self):
+        """
+        With defer_file_cleanup, the files of the old revisions are removed by the filestore gc
+        """
+        filesystem = self.get_filesystem()
+        MockFTPStorageAdapter.filesystem = filesystem
+        path = os.path.join(data.environment, data.folder, data.filename)
+        self.run_harvester(max_revisions=1, defer_file_cleanup=True)
+
+        filesystem.settimes(path, modified_time=datetime.now())
+        filesystem.setcontents(path, data.dataset_content_2)
+        self.run_harvester(max_revisions=1, defer_file_cleanup=True)
+
+        package = self.get_package()
+        old_revision = [r for r in package.resources_all if r.id != package.resources[0].id][0]
+        self.assert_resource_exists(old_revision)
+
+        assert_equal(filestore_gc.collect(dryrun=True), (1, 0))
+        assert_equal(filestore_gc.collect(batch_size=1), (1, 1))
+        self.assert_resource_deleted(old_revision)
+        self.assert_resource_exists(package.resources[0])
+
+        # the collected revision is not marked again, only the one replaced by this import
+        self.run_harvester(max_revisions=1, defer_file_cleanup=True, force_all=True)
+        assert_equal(filestore_gc.collect(), (1, 1))
+
+    def test_source_config_is_loaded_once(self):
+        """
+        The config of a harvest source is only validated again when it changed
+        """
+        harvester = SBBHarvester()
+        config = {'dataset': data.dataset_name, 'folder': data.folder, 'filter_regex': '\d{8}.csv'}
+        source = Mock(id='source-id', config=json.dumps(config))
+
+        with patch.object(SBBHarvester, 'load_config', autospec=True, side_effect=SBBHarvester.load_config) as load:
+            first = harvester._load_source_config(source)
+            first['localpath'] = '/tmp'  # set by the storage adapters
+            second = harvester._load_source_config(source)
+            assert_equal(load.call_count, 1)
+            assert 'localpath' not in second
+            assert harvester._regexes['filter_regex'].match('20160901.csv')
+
+            source.config = json.dumps(dict(config, max_revisions=2))
+            assert_equal(harvester._load_source_config(source)['max_revisions'], 2)
+            assert_equal(load.call_count, 2)
+
     def test_filter_regex(self):
         filesystem = self.get_filesystem(filename='File.zip')
         MockFTPStorageAdapter.filesystem = filesystem
@@ -445,3 +691,124 @@ class TestSBBHarvester(BaseSBBHarvesterTests):
             'folder': data.folder,
             'filter_regex': '.*',
         }))
+
+
+class TestDeferredIndexing(object):
+
+    @patch.object(base_sbb_harvester, 'ckanconf', {'ckan.search.automatic_indexing': 'true'})
+    def test_overlapping_blocks_then_setting_restored_by_the_last_one(self):
+        first = base_sbb_harvester.deferred_indexing()
+        second = base_sbb_harvester.deferred_indexing()
+
+        first.__enter__()
+        second.__enter__()
+        first.__exit__(None, None, None)
+        assert_equal(base_sbb_harvester.ckanconf['ckan.search.automatic_indexing'], 'false')
+        second.__exit__(None, None, None)
+
+        assert_equal(base_sbb_harvester.ckanconf['ckan.search.automatic_indexing'], 'true')
+
+    @patch.object(base_sbb_harvester, 'ckanconf', {})
+    def test_block_without_setting_then_setting_removed(self):
+        with base_sbb_harvester.deferred_indexing():
+            assert_equal(base_sbb_harvester.ckanconf['ckan.search.automatic_indexing'], 'false')
+
+        assert_false('ckan.search.automatic_indexing' in base_sbb_harvester.ckanconf)
+
+    @patch.object(base_sbb_harvester, 'ckanconf', {})
+    def test_disabled_then_setting_untouched(self):
+        with base_sbb_harvester.deferred_indexing(False):
+            assert_false('ckan.search.automatic_indexing' in base_sbb_harvester.ckanconf)
+
+
+@patch.object(base_sbb_harvester, 'ckanconf', MockConfigResolver('./ckanext/switzerland/tests/config/nosetest.ini',
+                                                                 'app:main'))
+@patch.object(SBBHarvester, '_setup_logging', Mock())
+@patch.object(SBBHarvester, '_save_object_error', Mock())
+class TestFetchStage(object):
+    localpath = '/tmp/ftpharvest/tests/'
+    config = {
+        'ftp_server': 'mainserver',
+        'environment': 'Test',
+        'folder': 'DiDok',
+        'dataset': 'DiDok',
+        'fetch_retries': 0,
+        'streaming': False,
+    }
+
+    def setup(self):
+        shutil.rmtree(self.localpath, ignore_errors=True)
+        os.makedirs(self.localpath)
+
+    def teardown(self):
+        shutil.rmtree(self.localpath, ignore_errors=True)
+
+    def get_harvest_object(self, filename, workingdir):
+        harvest_object = Mock(content=json.dumps({
+            'type': 'file',
+            'file': filename,
+            'workingdir': workingdir,
+            'remotefolder': '/Test/DiDok',
+            'dataset': 'DiDok',
+        }))
+        harvest_object.job.id = 'job-id'
+        harvest_object.job.source.id = 'source-id'
+        return harvest_object
+
+    def fetch_stage(self, harvester):
+        """ Fetch a file in a new working folder, removed afterwards like by the remove_tempdir object of a job """
+        workingdir = tempfile.mkdtemp(dir=self.localpath)
+        harvest_object = self.get_harvest_object('foo.txt', workingdir)
+        try:
+            if not harvester.fetch_stage(harvest_object):
+                return None
+            with open(os.path.join(workingdir, 'foo.txt')) as f:
+                return f.read()
+        finally:
+            shutil.rmtree(workingdir)
+
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_failed_fetch_then_continued_by_the_next_job(self, MockFTP_TLS):
+        mock_ftp_tls = MockFTP_TLS.return_value
+        mock_ftp_tls.size.return_value = 11
+        mock_ftp_tls.sendcmd.return_value = '213 20160621123722'
+
+        def retrbinary(cmd, callback, blocksize=8192, rest=None):
+            if not rest:
+                # the connection is lost during the first download
+                callback('hello ')
+                raise EOFError()
+            callback('world')
+            return '226 Transfer complete'
+        mock_ftp_tls.retrbinary.side_effect = retrbinary
+        harvester = SBBHarvester()
+
+        with patch.object(harvester, '_load_source_config', return_value=dict(self.config)):
+            assert_equal(self.fetch_stage(harvester), None)
+            assert_equal(self.fetch_stage(harvester), 'hello world')
+
+        mock_ftp_tls.retrbinary.assert_called_with('RETR foo.txt', ANY, rest=6)
+        assert_false(os.listdir(os.path.join(self.localpath, 'partial_downloads', 'source-id')))
+
+    @patch('ftplib.FTP_TLS', autospec=True)
+    def test_fetch_concurrency_then_files_of_the_job_fetched_by_the_first_object(self, MockFTP_TLS):
+        def retrbinary(cmd, callback, blocksize=8192, rest=None):
+            callback(cmd[len('RETR '):])
+            return '226 Transfer complete'
+        MockFTP_TLS.return_value.retrbinary.side_effect = retrbinary
+        workingdir = tempfile.mkdtemp(dir=self.localpath)
+        harvest_objects = [self.get_harvest_object(filename, workingdir) for filename in ['a.txt', 'b.txt']]
+        harvester = SBBHarvester()
+
+        with patch.object(harvester, '_load_source_config', return_value=dict(self.config, fetch_concurrency=2)), \
+                patch.object(base_sbb_harvester, 'Session') as Session:
+            # the gathered objects of the job
+            Session.query.return_value.filter.return_value = [(o.content,) for o in harvest_objects]
+            for harvest_object in harvest_objects:
+                assert harvester.fetch_stage(harvest_object)
+
+        # both files are downloaded by the first object, the second one finds its file
+        assert_equal(MockFTP_TLS.return_value.retrbinary.call_count, 2)
+        for filename in ['a.txt', 'b.txt']:
+            with open(os.path.join(workingdir, filename)) as f:
+                assert_equal(f.read(), filename)
@@ -0,0 +1,66 @@
+import hashlib
+import os
+import unittest
+from io import BytesIO
+
+from mock import Mock
+
+# The classes to test
+# -----------------------------------------------------------------------
+from ckanext.switzerland.harvester.streaming_file import StreamingFile
+# -----------------------------------------------------------------------
+
+CONTENT = b'This;is;a;csv;file\n'
+
+
+class TestStreamingFile(unittest.TestCase):
+
+    def test_read_then_hash_and_bytes_are_counted(self):
+        streaming_file = StreamingFile(BytesIO(CONTENT), len(CONTENT))
+
+        data = streaming_file.read(5) + streaming_file.read()
+
+        self.assertEqual(CONTENT, data)
+        self.assertEqual(len(CONTENT), streaming_file.bytes_read)
+        self.assertEqual(hashlib.md5(CONTENT).hexdigest(), streaming_file.hexdigest())
+
+    def test_seek_like_ckan_uploader(self):
+        streaming_file = StreamingFile(BytesIO(CONTENT), len(CONTENT))
+
+        # the uploader gets the size, then goes back to the start
+        streaming_file.seek(0, os.SEEK_END)
+        self.assertEqual(len(CONTENT), streaming_file.tell())
+        streaming_file.seek(0)
+        self.assertEqual(0, streaming_file.tell())
+
+        self.assertEqual(CONTENT, streaming_file.read())
+
+    def test_seek_backwards_after_read_then_error(self):
+        streaming_file = StreamingFile(BytesIO(CONTENT), len(CONTENT))
+        streaming_file.read(5)
+
+        self.assertRaises(IOError, streaming_file.seek, 0)
+
+    def test_read_when_stream_ends_too_early_then_error(self):
+        streaming_file = StreamingFile(BytesIO(CONTENT[:5]), len(CONTENT))
+        streaming_file.read(5)
+
+        self.assertRaises(IOError, streaming_file.read, 5)
+
+    def test_read_when_size_unknown_then_no_error(self):
+        streaming_file = StreamingFile(BytesIO(CONTENT), None)
+
+        self.assertEqual(CONTENT, streaming_file.read())
+        self.assertEqual(b'', streaming_file.read(5))
+
+    def test_close_then_stream_closed_and_callbacks_called(self):
+        stream = Mock()
+        callback = Mock()
+        streaming_file = StreamingFile(stream, 0)
+        streaming_file.on_close(callback)
+
+        with streaming_file:
+            pass
+
+        self.assertTrue(stream.close.called)
+        self.assertTrue(callback.called)
@@ -1,5 +1,9 @@
 import os
+from datetime import datetime
 
+from ckan import model
+from ckanext.harvest import model as harvester_model
+from ckanext.switzerland.harvester import base_sbb_harvester, harvest_state
 from ckanext.switzerland.harvester.timetable_harvester import TimetableHarvester
 from ckanext.switzerland.tests import data
 from ckanext.switzerland.tests.helpers.mock_ftp_storage_adapter import MockFTPStorageAdapter
@@ -45,3 +49,31 @@ class TestTimetableHarvester(BaseSBBHarvesterTests):
         dataset2 = self.get_dataset(name='Timetable 2015')
         assert_equal(len(dataset2['resources']), 1)
         self.assert_resource_data(dataset2['resources'][0]['id'], data.dataset_content_3)
+
+    def test_multi_year_without_harvest_state_then_existing_resources_are_not_harvested_again(self):
+        """
+        Files harvested before the harvest state was stored are found in the resources of their datasets
+        """
+        filesystem = self.get_filesystem(filename='FP2016_Jahresfahrplan.zip')
+        MockFTPStorageAdapter.filesystem = filesystem
+
+        path = os.path.join(data.environment, data.folder, 'FP2015_Jahresfahrplan.zip')
+        filesystem.setcontents(path, data.dataset_content_3)
+        filesystem.settimes(path, modified_time=datetime(2000, 1, 1))
+
+        self.run_harvester(dataset='Timetable {year}', timetable_regex='FP(\d\d\d\d).*')
+        model.Session.query(harvest_state.HarvestFileState).delete()
+        model.Session.commit()
+
+        with patch('ckanext.switzerland.harvester.base_sbb_harvester.get_action',
+                   wraps=base_sbb_harvester.get_action) as get_action:
+            self.run_harvester(dataset='Timetable {year}', timetable_regex='FP(\d\d\d\d).*')
+
+        # both datasets are searched at once
+        get_action.assert_any_call('ogdch_datasets_by_identifier')
+        for name in ['Timetable 2015', 'Timetable 2016']:
+            package = self.get_package(name=name)
+            assert_equal(len(package.resources_all), 1)
+        # the harvest state of the files is stored again
+        source = harvester_model.Session.query(harvester_model.HarvestSource).one()
+        assert_equal(len(harvest_state.get_file_states(source.id)), 2)
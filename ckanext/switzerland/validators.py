@@ -4,8 +4,8 @@ import re
 from ckan.plugins.toolkit import missing, _
 import ckan.lib.navl.dictization_functions as df
 from ckanext.scheming.validation import scheming_validator
+from ckanext.switzerland import identifier_index
 from ckanext.switzerland.helpers import parse_json
-from ckan.logic import NotFound, get_action
 import json
 import datetime
 import logging
@@ -302,17 +302,12 @@ def ogdch_unique_identifier(field, schema):
     def validator(key, data, errors, context):
         id = data.get(key[:-1] + ('id',))
         identifier = data.get(key[:-1] + ('identifier',))
-        try:
-            result = get_action('ogdch_dataset_by_identifier')(
-                {},
-                {'identifier': identifier}
+        # only the id is needed, the dataset is not shown
+        package_id = identifier_index.get_package_id(identifier)
+        if package_id is not None and id != package_id:
+            raise df.Invalid(
+                _('Identifier is already in use, it must be unique.')
             )
-            if id != result['id']:
-                raise df.Invalid(
-                    _('Identifier is already in use, it must be unique.')
-                )
-        except NotFound:
-            pass
 
     return validator
 